@@ -0,0 +1,9 @@
+import sys
+
+
+# the pipeline Config parses the command line when it is created, but the benchmarks have their own arguments
+_argv, sys.argv = sys.argv, sys.argv[:1]
+import taranis_ds.config  # noqa: E402, F401
+
+
+sys.argv = _argv
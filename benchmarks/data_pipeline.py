@@ -0,0 +1,155 @@
+"""
+data_pipeline.py
+
+Time and memory-profile the data handling of the pipeline (preprocess, save_df_to_table, update_row and main.save_to_db)
+on synthetic Taranis AI exports of increasing size
+"""
+
+import argparse
+import json
+import platform
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.synthetic import generate_taranis_export, parse_language_mix, to_processed_df
+from taranis_ds import main as taranis_main
+from taranis_ds.config import Config
+from taranis_ds.misc import DATASET_SUFFIXES, save_df_to_table, write_stories
+from taranis_ds.persist import init_db, insert_column, update_row
+from taranis_ds.preprocess import preprocess_taranis_dataset
+
+
+STAGES = ["preprocess", "save_df_to_table", "update_row", "save_to_db"]
+
+
+def measure(func, *args, trace_memory: bool = True, **kwargs) -> tuple[dict, object]:
+    # tracemalloc slows down allocation heavy code, so the time is only comparable between runs with the same setting
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        error = None
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    duration = time.perf_counter() - start
+    measurement = {"seconds": round(duration, 3)}
+    if trace_memory:
+        measurement["peak_mib"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+    if error:
+        measurement["error"] = error
+    return measurement, result
+
+
+def update_rows(db_path: str, news_item_ids: list[str]) -> int:
+    # all LLM steps update their results by news_item_id, the primary key of the results table
+    connection = sqlite3.Connection(db_path)
+    for news_item_id in news_item_ids:
+        update_row(connection, "results", news_item_id, ["summary", "summary_status"], ["A short synthetic summary.", "OK"], "news_item_id")
+    connection.close()
+    return len(news_item_ids)
+
+
+def save_to_table(db_path: str, df) -> int:
+    init_db(db_path, "results")
+    connection = sqlite3.Connection(db_path)
+    written_rows = save_df_to_table(df, connection)
+    connection.close()
+    return written_rows
+
+
+def save_to_db(db_path: str, processed_path: str):
+    Config.DB_PATH = db_path
+    Config.PROCESSED_DATASET_PATH = processed_path
+    taranis_main.save_to_db()
+
+
+def benchmark_size(n_items: int, args: argparse.Namespace, tmp_dir: Path) -> dict:
+    result = {"items": n_items}
+    stories = generate_taranis_export(
+        max(1, round(n_items / args.items_per_story)),
+        args.items_per_story,
+        args.words,
+        parse_language_mix(args.languages),
+        args.duplicate_rate,
+        seed=args.seed,
+    )
+    export_path = tmp_dir / f"export_{n_items}{args.dataset_format}"
+    result["write_export"], _ = measure(write_stories, stories, str(export_path), trace_memory=args.trace_memory)
+    result["export_mib"] = round(export_path.stat().st_size / 2**20, 1)
+
+    df = None
+    if "preprocess" in args.stages:
+        result["preprocess"], df = measure(
+            preprocess_taranis_dataset, str(export_path), args.tokenizer, clean=args.clean, trace_memory=args.trace_memory
+        )
+    if df is None:
+        # without (a working) preprocess the later stages run on the generated items directly
+        df = to_processed_df(stories)
+        df = df[~df["content"].duplicated()]
+    result["rows"] = len(df)
+    del stories
+
+    db_path = str(tmp_dir / f"results_{n_items}.db")
+    if "save_df_to_table" in args.stages:
+        result["save_df_to_table"], _ = measure(save_to_table, db_path, df, trace_memory=args.trace_memory)
+
+    if "update_row" in args.stages and Path(db_path).exists():
+        connection = sqlite3.Connection(db_path)
+        for column in ["summary", "summary_status"]:
+            insert_column(connection, "results", column, "TEXT")
+        connection.close()
+        sample = df.sample(min(args.updates, len(df)), random_state=args.seed)
+        result["update_row"], _ = measure(update_rows, db_path, sample["news_item_id"].to_list(), trace_memory=args.trace_memory)
+        result["update_row"]["ms_per_update"] = round(1000 * result["update_row"]["seconds"] / max(len(sample), 1), 3)
+
+    if "save_to_db" in args.stages:
+        processed_path = tmp_dir / f"processed_{n_items}.json"
+        df.to_json(processed_path)
+        result["save_to_db"], _ = measure(
+            save_to_db, str(tmp_dir / f"converted_{n_items}.db"), str(processed_path), trace_memory=args.trace_memory
+        )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data handling steps on synthetic Taranis AI exports")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Number of news items per run")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--items-per-story", type=float, default=1.0, help="Mean number of news items per story")
+    parser.add_argument("--words", type=int, default=300, help="Mean number of words per news item")
+    parser.add_argument("--languages", default="en=0.6,de=0.3,fr=0.05,es=0.05", help="Language mix, e.g. en=0.7,de=0.3")
+    parser.add_argument("--duplicate-rate", type=float, default=0.02)
+    parser.add_argument("--tokenizer", default=Config.PREPROCESS_TOKENIZER)
+    parser.add_argument("--dataset-format", default=".json", choices=DATASET_SUFFIXES, help="Format of the synthetic export")
+    parser.add_argument("--clean", action="store_true", help="Clean the news item content in preprocess")
+    parser.add_argument("--updates", type=int, default=1000, help="Number of rows updated with update_row")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false", help="Only measure time, without tracemalloc")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    report = {
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": vars(args),
+        "runs": [],
+    }
+    for n_items in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_result = benchmark_size(n_items, args, Path(tmp_dir))
+        print(json.dumps(run_result))
+        report["runs"].append(run_result)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
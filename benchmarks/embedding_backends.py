@@ -0,0 +1,89 @@
+"""
+embedding_backends.py
+
+Compare the backends of the summary quality embedding model: time per summary on CPU
+and agreement of the cosine scores and threshold decisions with the full precision model
+"""
+
+import argparse
+import json
+import random
+import time
+from pathlib import Path
+
+import torch
+
+from benchmarks.synthetic import WORDS, synthetic_text
+from taranis_ds.config import Config
+from taranis_ds.embeddings import EMBEDDING_BACKENDS, backend_available, cosine_similarity, get_embedding_model
+
+
+def create_reference_pairs(n_pairs: int, n_words: int, seed: int) -> list[dict]:
+    # good summaries are the first sentences of the text, bad ones the start of an unrelated text of the same language
+    rng = random.Random(seed)
+    pairs = []
+    for i in range(n_pairs):
+        language = list(WORDS)[i % len(WORDS)]
+        text = synthetic_text(rng, n_words, language, cyber=rng.random() < 0.3)
+        summary_source = text if i % 2 == 0 else synthetic_text(rng, n_words, language)
+        pairs.append({"text": text, "summary": " ".join(summary_source.split()[:50])})
+    return pairs
+
+
+def score_pairs(backend: str, pairs: list[dict], cache_dir: str) -> tuple[list[float], dict]:
+    start = time.perf_counter()
+    model = get_embedding_model(backend, cache_dir=cache_dir)
+    load_seconds = time.perf_counter() - start
+    # one warm-up pair, the first forward pass allocates the buffers
+    cosine_similarity(model, pairs[0]["text"], pairs[0]["summary"])
+
+    start = time.perf_counter()
+    scores = [cosine_similarity(model, pair["text"], pair["summary"]) for pair in pairs]
+    seconds = time.perf_counter() - start
+    return scores, {"load_seconds": round(load_seconds, 2), "ms_per_summary": round(1000 * seconds / len(pairs), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPU backends of the summary quality embedding model")
+    parser.add_argument("--backends", nargs="+", default=EMBEDDING_BACKENDS, choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--pairs", type=int, default=200, help="Number of synthetic text/summary pairs")
+    parser.add_argument("--words", type=int, default=300, help="Words per synthetic text")
+    parser.add_argument("--reference", default="", help="JSON list of {text, summary} pairs to use instead of synthetic ones")
+    parser.add_argument("--threshold", type=float, default=Config.SUMMARY_QUALITY_THRESHOLD)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--cache-dir", default=Config.SUMMARY_QUALITY_CACHE_DIR)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="", help="Write the report as JSON to this path")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    pairs = json.loads(Path(args.reference).read_text()) if args.reference else create_reference_pairs(args.pairs, args.words, args.seed)
+
+    # the full precision model is the reference for the scores of the other backends
+    reference_scores, reference_timing = score_pairs("torch", pairs, args.cache_dir)
+    report = {"config": vars(args), "backends": {"torch": reference_timing}}
+    for backend in [backend for backend in args.backends if backend != "torch"]:
+        if not backend_available(backend):
+            # get_embedding_model would fall back to int8, whose numbers must not be reported for this backend
+            print(f"Skipping the {backend} backend, it requires pip install taranis-dataset-tools[{backend}]")
+            report["backends"][backend] = {"skipped": "not installed"}
+            continue
+        scores, timing = score_pairs(backend, pairs, args.cache_dir)
+        differences = [abs(score - reference) for score, reference in zip(scores, reference_scores)]
+        agreement = sum((score >= args.threshold) == (reference >= args.threshold) for score, reference in zip(scores, reference_scores))
+        report["backends"][backend] = {
+            **timing,
+            "speedup": round(reference_timing["ms_per_summary"] / timing["ms_per_summary"], 2),
+            "max_score_difference": round(max(differences), 4),
+            "mean_score_difference": round(sum(differences) / len(differences), 4),
+            "threshold_agreement": round(agreement / len(pairs), 4),
+        }
+
+    print(json.dumps(report["backends"], indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
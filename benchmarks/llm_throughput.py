@@ -0,0 +1,156 @@
+"""
+llm_throughput.py
+
+Run the summary and cybersec_class steps against the offline stub server on a synthetic database
+and report items/s, requests per item and p50/p95/p99 latencies
+"""
+
+import argparse
+import json
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from langchain_mistralai import ChatMistralAI
+
+from benchmarks.stub_server import StubLLMServer
+from benchmarks.synthetic import synthetic_text
+from taranis_ds import cybersec_class, summary
+from taranis_ds.llm_tools import HedgedChatModel
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def create_benchmark_db(db_path: str, n_items: int, n_words: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n_items):
+        content = synthetic_text(rng, n_words, "en", cyber=rng.random() < 0.3)
+        rows.append({"id": str(i), "news_item_id": str(i), "content": content, "language": "en", "tokens": len(content) // 4})
+
+    connection = sqlite3.Connection(db_path)
+    connection.execute(
+        "CREATE TABLE results(id TEXT, news_item_id TEXT PRIMARY KEY, title TEXT, content TEXT, tokens INTEGER, language TEXT, "
+        "summary TEXT, summary_status TEXT, cybersecurity TEXT, cybersecurity_status TEXT)"
+    )
+    with connection:
+        connection.executemany(
+            "INSERT INTO results (id, news_item_id, title, content, tokens, language) VALUES (?, ?, '', ?, ?, ?)",
+            [(row["id"], row["news_item_id"], row["content"], row["tokens"], row["language"]) for row in rows],
+        )
+    connection.close()
+    return rows
+
+
+@contextmanager
+def timed_prompts(module, latencies: list[float]):
+    # measure the client side latency of every news item, including retries
+    original = module.prompt_model_with_retry
+
+    def prompt_model_with_retry(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    module.prompt_model_with_retry = prompt_model_with_retry
+    try:
+        yield
+    finally:
+        module.prompt_model_with_retry = original
+
+
+def run_stage(stage: str, server: StubLLMServer, db_path: str, news_items: list[dict], max_length: int, hedge: bool = False) -> dict:
+    connection = sqlite3.Connection(db_path)
+    chat_model = ChatMistralAI(model="stub", api_key="stub", endpoint=server.url, max_tokens=max_length * 2)
+    if hedge:
+        chat_model = HedgedChatModel(model=chat_model, min_timeout=1.0)
+    requests_before = server.stats["requests"]
+    rate_limited_before = server.stats["rate_limited"]
+    malformed_before = server.stats["malformed"]
+    request_latencies_before = len(server.stats["latencies"])
+    item_latencies = []
+
+    start = time.perf_counter()
+    if stage == "summary":
+        with timed_prompts(summary, item_latencies):
+            summary.create_summaries_for_news_items(chat_model, news_items, connection, max_length, 0.0, 0.0)
+        status_column = "summary_status"
+    else:
+        with timed_prompts(cybersec_class, item_latencies):
+            cybersec_class.classify_news_item_cybersecurity(chat_model, news_items, connection, 0.0)
+        status_column = "cybersecurity_status"
+    duration = time.perf_counter() - start
+
+    statuses = Counter(row[0] for row in connection.execute(f"SELECT {status_column} FROM results"))
+    connection.close()
+
+    requests = server.stats["requests"] - requests_before
+    request_latencies = server.stats["latencies"][request_latencies_before:]
+    return {
+        "items": len(news_items),
+        "seconds": round(duration, 3),
+        "items_per_s": round(len(news_items) / duration, 2),
+        "requests": requests,
+        "requests_per_item": round(requests / max(len(news_items), 1), 3),
+        "rate_limited": server.stats["rate_limited"] - rate_limited_before,
+        "malformed": server.stats["malformed"] - malformed_before,
+        "item_latency_p50": round(percentile(item_latencies, 50), 4),
+        "item_latency_p95": round(percentile(item_latencies, 95), 4),
+        "item_latency_p99": round(percentile(item_latencies, 99), 4),
+        "request_latency_p50": round(percentile(request_latencies, 50), 4),
+        "request_latency_p95": round(percentile(request_latencies, 95), 4),
+        "statuses": dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LLM steps against the offline stub server")
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--words", type=int, default=300, help="Words per synthetic news item")
+    parser.add_argument("--max-length", type=int, default=50, help="Maximum summary length in words")
+    parser.add_argument("--stages", nargs="+", default=["summary", "cybersec_class"], choices=["summary", "cybersec_class"])
+    parser.add_argument("--latency-median", type=float, default=0.05)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--hedge", action="store_true", help="Send a duplicate request when a request takes longer than p95")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="", help="Write the report as JSON to this path")
+    args = parser.parse_args()
+
+    report = {"config": vars(args), "stages": {}}
+    with (
+        tempfile.TemporaryDirectory() as tmp_dir,
+        StubLLMServer(
+            latency_median=args.latency_median,
+            latency_sigma=args.latency_sigma,
+            rate_limit_rate=args.rate_limit_rate,
+            malformed_rate=args.malformed_rate,
+            seed=args.seed,
+        ) as server,
+    ):
+        db_path = str(Path(tmp_dir) / "benchmark.db")
+        news_items = create_benchmark_db(db_path, args.items, args.words, args.seed)
+        for stage in args.stages:
+            report["stages"][stage] = run_stage(stage, server, db_path, news_items, args.max_length, args.hedge)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
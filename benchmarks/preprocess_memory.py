@@ -0,0 +1,123 @@
+"""
+preprocess_memory.py
+
+Measure the peak RSS of reading and deduplicating a synthetic Taranis AI export in preprocess,
+with the Arrow-backed columns and with the former object (Python str) columns, every run in a fresh process.
+With --tokenizer the rest of preprocess (cleaning, tokens, language) is measured as well
+"""
+
+import argparse
+import json
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.synthetic import generate_taranis_export, parse_language_mix
+from taranis_ds import preprocess
+from taranis_ds.config import Config
+from taranis_ds.misc import DATASET_SUFFIXES, is_jsonl, write_stories
+
+
+STRING_STORAGES = ["arrow", "object"]
+
+
+def peak_rss_mib() -> float:
+    # VmHWM starts from zero in the child, unlike ru_maxrss which keeps the high-water mark of the forked parent
+    status = Path("/proc/self/status")
+    if status.exists():
+        return int(re.search(r"VmHWM:\s+(\d+)", status.read_text())[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20  # bytes on macOS
+
+
+def read_object_strings(ds_path: str) -> pd.DataFrame:
+    # the former implementation: explode the stories and copy the fields out of the news item dicts
+    df = pd.read_json(ds_path, lines=is_jsonl(ds_path))
+    df = df.explode("news_items", ignore_index=True)
+    df["content"] = df["news_items"].apply(lambda item: item["content"])
+    df["title"] = df["news_items"].apply(lambda item: item["title"])
+    df["news_item_id"] = df["news_items"].apply(lambda item: item["id"])
+    df = df[~df["news_items"].apply(lambda item: item["content"] is None or item["content"] == "")]
+    return df[~df["content"].duplicated()].reset_index(drop=True)
+
+
+def run_child(args: argparse.Namespace):
+    baseline = peak_rss_mib()
+    start = time.perf_counter()
+    if args.string_storage == "object":
+        df = read_object_strings(args.dataset)
+    else:
+        df = preprocess.read_taranis_dataset(args.dataset, args.block_size)
+        df = df[preprocess.first_occurrences(df["content"])].reset_index(drop=True)
+    if args.tokenizer:
+        df = preprocess.process_news_items(df, args.tokenizer, clean=args.clean)
+    result = {
+        "rows": len(df),
+        "seconds": round(time.perf_counter() - start, 3),
+        "frame_mib": round(df.memory_usage(deep=True).sum() / 2**20, 1),
+        "peak_rss_mib": round(peak_rss_mib(), 1),
+        "peak_rss_increase_mib": round(peak_rss_mib() - baseline, 1),
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the peak RSS of reading an export in preprocess with Arrow and object string columns"
+    )
+    parser.add_argument("--items", type=int, default=100_000, help="Number of news items of the synthetic export")
+    parser.add_argument("--items-per-story", type=float, default=1.0)
+    parser.add_argument("--words", type=int, default=300, help="Mean number of words per news item")
+    parser.add_argument("--languages", default="en=0.6,de=0.3,fr=0.05,es=0.05")
+    parser.add_argument("--dataset-format", default=".jsonl", choices=DATASET_SUFFIXES)
+    parser.add_argument("--string-storages", nargs="+", default=STRING_STORAGES, choices=STRING_STORAGES)
+    parser.add_argument("--block-size", type=int, default=Config.PREPROCESS_BLOCK_SIZE)
+    parser.add_argument("--tokenizer", default="", help="Also clean, tokenize and detect the language, e.g. facebook/bart-large-cnn")
+    parser.add_argument("--clean", action="store_true", help="Clean the content with --tokenizer")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="", help="Write the report as JSON to this path")
+    parser.add_argument("--dataset", help=argparse.SUPPRESS)
+    parser.add_argument("--string-storage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.dataset:
+        run_child(args)
+        return
+
+    report = {"config": vars(args), "runs": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset = str(Path(tmp_dir) / f"export{args.dataset_format}")
+        stories = generate_taranis_export(
+            max(1, round(args.items / args.items_per_story)),
+            args.items_per_story,
+            args.words,
+            parse_language_mix(args.languages),
+            seed=args.seed,
+        )
+        write_stories(stories, dataset)
+        del stories
+
+        child_args = [f"--block-size={args.block_size}", f"--dataset={dataset}", f"--tokenizer={args.tokenizer}"]
+        if args.clean:
+            child_args.append("--clean")
+        for storage in args.string_storages:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.preprocess_memory", *child_args, f"--string-storage={storage}"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            report["runs"][storage] = json.loads(output.strip().splitlines()[-1])
+            print(storage, json.dumps(report["runs"][storage]))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+stub_server.py
+
+Offline OpenAI/Mistral compatible chat completions server that imitates the LLM endpoints of the pipeline
+with configurable latency, rate limiting (429), server errors (500), malformed and overlong outputs
+and streamed (SSE) completions
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CYBERSEC_KEYWORDS_RE = re.compile(r"cyber|malware|ransomware|vulnerabilit|exploit|phishing|CVE-|hacker|botnet|breach", re.IGNORECASE)
+TEXT_RE = re.compile(r"following (?:part of a longer )?text:\n(.*?)\. Your response must be in", re.DOTALL)
+LABELLED_TEXT_RE = re.compile(r"\nText: (.*?)(?:\nCompletion:|$)", re.DOTALL)
+MAX_WORDS_RE = re.compile(r"not be longer than (\d+) words")
+MALFORMED_ANSWERS = ["Sure! Here is what you asked for:", "I am sorry, but I cannot help with that request.", "{'summary': "]
+
+
+def extract_text(prompt: str) -> str:
+    if match := TEXT_RE.search(prompt) or LABELLED_TEXT_RE.search(prompt):
+        return match[1]
+    return prompt
+
+
+def generate_answer(prompt: str, verbose: bool = False) -> str:
+    # answer like a well-behaved model: summaries are the first words of the text, so they are in the language of the text
+    # a verbose model ignores the requested length and repeats the whole text
+    text = extract_text(prompt)
+    category = "cybersecurity" if CYBERSEC_KEYWORDS_RE.search(text) else "non-cybersecurity"
+    max_words = int(match[1]) if (match := MAX_WORDS_RE.search(prompt)) else 50
+    if verbose:
+        max_words = len(text.split())
+    summary = " ".join(text.split()[: max(1, round(max_words * 0.8))])
+
+    if "JSON object" in prompt:
+        return json.dumps({"summary": summary, "category": category}, ensure_ascii=False)
+    if "classify the following text" in prompt:
+        return category
+    return summary
+
+
+class StubLLMServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_median: float = 0.2,
+        latency_sigma: float = 0.5,
+        rate_limit_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        seed: int | None = None,
+        error_rate: float = 0.0,
+        verbose_rate: float = 0.0,
+        token_latency: float = 0.0,
+    ):
+        # latencies follow a log-normal distribution with the given median (s) and sigma
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.error_rate = error_rate
+        self.verbose_rate = verbose_rate
+        # delay between the words of a streamed completion, the log-normal latency is the time to the first word
+        self.token_latency = token_latency
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "connections": 0,
+            "rate_limited": 0,
+            "errors": 0,
+            "malformed": 0,
+            "verbose": 0,
+            "streamed_words": 0,
+            "aborted_streams": 0,
+            "latencies": [],
+        }
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubLLMServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _draw(self) -> tuple[float, bool, bool, bool, bool]:
+        with self.lock:
+            latency = self.latency_median * math.exp(self.rng.gauss(0, self.latency_sigma)) if self.latency_median > 0 else 0.0
+            return (
+                latency,
+                self.rng.random() < self.rate_limit_rate,
+                self.rng.random() < self.error_rate,
+                self.rng.random() < self.malformed_rate,
+                self.rng.random() < self.verbose_rate,
+            )
+
+    def _record(self, key: str | None = None, latency: float | None = None):
+        with self.lock:
+            self.stats["requests"] += 1
+            if key:
+                self.stats[key] += 1
+            if latency is not None:
+                self.stats["latencies"].append(latency)
+
+    def complete(self, request: dict) -> tuple[int, dict]:
+        latency, rate_limited, error, malformed, verbose = self._draw()
+        if rate_limited:
+            self._record("rate_limited")
+            return 429, {"object": "error", "message": "Too many requests", "type": "rate_limit_exceeded", "code": 429}
+        if error:
+            self._record("errors")
+            return 500, {"object": "error", "message": "Internal server error", "type": "internal_error", "code": 500}
+
+        start = time.perf_counter()
+        time.sleep(latency)
+        prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+        if malformed:
+            with self.lock:
+                answer = self.rng.choice(MALFORMED_ANSWERS)
+        else:
+            answer = generate_answer(prompt, verbose)
+        self._record("malformed" if malformed else "verbose" if verbose else None, time.perf_counter() - start)
+
+        prompt_tokens, completion_tokens = len(prompt) // 4 + 1, len(answer) // 4 + 1
+        return 200, {
+            "id": uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                # called once per TCP connection, keep-alive requests reuse it
+                super().setup()
+                with server.lock:
+                    server.stats["connections"] += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not self.path.endswith("/chat/completions"):
+                    self._send(404, {"message": f"Unknown path {self.path}"})
+                    return
+                try:
+                    request = json.loads(body)
+                except json.JSONDecodeError:
+                    self._send(400, {"message": "Invalid JSON"})
+                    return
+                status, payload = server.complete(request)
+                if status == 200 and request.get("stream"):
+                    self._stream(payload)
+                else:
+                    self._send(status, payload)
+
+            def _stream(self, payload: dict):
+                # send the answer word by word as server-sent events, like the streaming chat completions API
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                answer = payload["choices"][0]["message"]["content"]
+                words = answer.split(" ")
+                chunk = {key: payload[key] for key in ["id", "created", "model"]} | {"object": "chat.completion.chunk"}
+                try:
+                    for i, word in enumerate(words):
+                        if i and server.token_latency:
+                            time.sleep(server.token_latency)
+                        delta = {"role": "assistant", "content": word if i == 0 else f" {word}"}
+                        event = chunk | {"choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                        self.wfile.flush()
+                        with server.lock:
+                            server.stats["streamed_words"] += 1
+                    event = chunk | {
+                        "choices": [{"index": 0, "delta": {"content": ""}, "finish_reason": "stop"}],
+                        "usage": payload["usage"],
+                    }
+                    self.wfile.write(f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n".encode())
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped reading, e.g. because it aborted an invalid completion
+                    with server.lock:
+                        server.stats["aborted_streams"] += 1
+
+            def _send(self, status: int, payload: dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an offline stub of the LLM chat completions endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=0.2, help="Median latency per request in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Sigma of the log-normal latency distribution")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Share of requests answered with invalid output")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--verbose-rate", type=float, default=0.0, help="Share of summaries that ignore the requested length")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Delay between the words of streamed completions")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = StubLLMServer(
+        args.host,
+        args.port,
+        args.latency_median,
+        args.latency_sigma,
+        args.rate_limit_rate,
+        args.malformed_rate,
+        args.seed,
+        args.error_rate,
+        args.verbose_rate,
+        args.token_latency,
+    )
+    print(f"Serving stub chat completions at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
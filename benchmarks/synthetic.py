@@ -0,0 +1,132 @@
+"""
+synthetic.py
+
+Seeded generator of synthetic Taranis AI story exports for benchmarks
+"""
+
+import argparse
+import random
+import uuid
+
+import pandas as pd
+
+from taranis_ds.misc import write_stories
+
+
+WORDS = {
+    "en": (
+        "the government announced new rules for energy prices on monday while the city council debated the budget for schools "
+        "and hospitals in the region where many people work in small companies that export food and machines to other countries"
+    ).split(),
+    "de": (
+        "die regierung hat am montag neue regeln für die energiepreise angekündigt während der gemeinderat über das budget für "
+        "schulen und spitäler in der region diskutierte wo viele menschen in kleinen firmen arbeiten die lebensmittel exportieren"
+    ).split(),
+    "fr": (
+        "le gouvernement a annoncé lundi de nouvelles règles pour les prix de l'énergie pendant que le conseil municipal débattait "
+        "du budget des écoles et des hôpitaux de la région où beaucoup de gens travaillent dans des petites entreprises"
+    ).split(),
+    "es": (
+        "el gobierno anunció el lunes nuevas reglas para los precios de la energía mientras el consejo de la ciudad debatía el "
+        "presupuesto de las escuelas y los hospitales de la región donde muchas personas trabajan en pequeñas empresas"
+    ).split(),
+}
+CYBER_WORDS = "attackers exploited a critical vulnerability to deploy ransomware and malware against the company network".split()
+
+
+def parse_language_mix(value: str) -> dict[str, float]:
+    # "en=0.7,de=0.3" -> {"en": 0.7, "de": 0.3}
+    mix = {}
+    for part in value.split(","):
+        language, _, weight = part.partition("=")
+        if language not in WORDS:
+            raise ValueError(f"Unknown language {language}, choose from {', '.join(WORDS)}")
+        mix[language] = float(weight or 1)
+    return mix
+
+
+def synthetic_text(rng: random.Random, n_words: int, language: str = "en", cyber: bool = False) -> str:
+    vocabulary = WORDS[language] + CYBER_WORDS if cyber else WORDS[language]
+    sentences = []
+    word_count = 0
+    while word_count < n_words:
+        words = rng.choices(vocabulary, k=rng.randint(8, 16))
+        sentences.append(" ".join(words).capitalize() + ".")
+        word_count += len(words)
+    # group sentences into paragraphs like scraped articles
+    paragraphs = [" ".join(sentences[i : i + 4]) for i in range(0, len(sentences), 4)]
+    return "\n".join(paragraphs)
+
+
+def random_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def generate_taranis_export(
+    n_stories: int,
+    items_per_story: float = 1.0,
+    content_words: int = 300,
+    language_mix: dict[str, float] | None = None,
+    duplicate_rate: float = 0.0,
+    cyber_rate: float = 0.3,
+    seed: int = 42,
+) -> list[dict]:
+    # stories in the format of the Taranis AI export endpoint: [{"id": ..., "news_items": [{"id", "title", "content", "language"}]}]
+    rng = random.Random(seed)
+    language_mix = language_mix or {"en": 1.0}
+    languages, weights = list(language_mix), list(language_mix.values())
+    contents = []
+    stories = []
+    for _ in range(n_stories):
+        # number of items varies around items_per_story, with at least one item per story
+        n_items = max(1, round(rng.uniform(1, 2 * items_per_story - 1))) if items_per_story > 1 else 1
+        language = rng.choices(languages, weights)[0]
+        news_items = []
+        for _ in range(n_items):
+            if contents and rng.random() < duplicate_rate:
+                content = rng.choice(contents)
+            else:
+                n_words = max(10, round(rng.gauss(content_words, content_words / 4)))
+                content = synthetic_text(rng, n_words, language, cyber=rng.random() < cyber_rate)
+                contents.append(content)
+            news_items.append({"id": random_id(rng), "title": content.split(".")[0][:80], "content": content, "language": language})
+        stories.append({"id": random_id(rng), "news_items": news_items})
+    return stories
+
+
+def to_processed_df(stories: list[dict]) -> pd.DataFrame:
+    # the columns preprocess produces, with an estimated token count instead of running the tokenizer
+    rows = [
+        {
+            "id": story["id"],
+            "news_item_id": item["id"],
+            "title": item["title"],
+            "content": item["content"],
+            "tokens": len(item["content"]) // 4,
+            "language": item["language"],
+        }
+        for story in stories
+        for item in story["news_items"]
+    ]
+    return pd.DataFrame(rows, columns=["id", "news_item_id", "title", "content", "tokens", "language"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Taranis AI story export")
+    parser.add_argument("output", help="Path of the export, .json or .jsonl(.gz/.zst)")
+    parser.add_argument("--stories", type=int, default=1000)
+    parser.add_argument("--items-per-story", type=float, default=1.0, help="Mean number of news items per story")
+    parser.add_argument("--words", type=int, default=300, help="Mean number of words per news item")
+    parser.add_argument("--languages", default="en=0.6,de=0.3,fr=0.05,es=0.05", help="Language mix, e.g. en=0.7,de=0.3")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of news items that repeat an earlier content")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    stories = generate_taranis_export(
+        args.stories, args.items_per_story, args.words, parse_language_mix(args.languages), args.duplicate_rate, seed=args.seed
+    )
+    write_stories(stories, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from taranis_ds import cybersec_class, load, preprocess, summary
+from taranis_ds import cybersec_class, export, load, preprocess, summary, summary_cybersec_class
 
 
-__all__ = ["load", "preprocess", "summary", "cybersec_class"]
+__all__ = ["load", "preprocess", "summary", "cybersec_class", "summary_cybersec_class", "export"]
@@ -4,13 +4,14 @@ from pydantic import ValidationInfo, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
-VALID_TASKS = ["load", "preprocess", "summary", "cybersec_class"]
+VALID_TASKS = ["load", "preprocess", "summary", "cybersec_class", "summary_cybersec_class", "export"]
+DEFAULT_TASKS = ["load", "preprocess", "summary", "cybersec_class"]
 
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore", cli_parse_args=True)
 
-    TASKS: list = VALID_TASKS
+    TASKS: list = DEFAULT_TASKS
 
     TARANIS_INSTANCE_URL: str = ""
     TARANIS_AUTH_ENDPOINT: str = "/api/auth/login"
@@ -18,29 +19,129 @@ class Settings(BaseSettings):
     TARANIS_ADMIN_USERNAME: str = ""
     TARANIS_ADMIN_PASSWORD: str = ""
 
+    # .json, or JSON Lines with one story per line: .jsonl, .jsonl.gz or .jsonl.zst (requires zstandard)
     TARANIS_DATASET_PATH: str = ""
 
     PREPROCESS_TOKENIZER: str = "facebook/bart-large-cnn"
     PREPROCESS_MAX_TOKENS: int = 1e5
+    # remove HTML, tracking parameters and boilerplate lines from the content, the original is kept in the content column
+    PREPROCESS_CLEAN_CONTENT: bool = False
+    # short lines that appear in the news items of at least this many different stories are removed as boilerplate
+    PREPROCESS_REPEATED_LINE_MIN_COUNT: int = 5
+    # bytes of a .jsonl(.gz/.zst) dataset parsed at a time, must be larger than the longest story
+    PREPROCESS_BLOCK_SIZE: int = 16 * 2**20
 
     PROCESSED_DATASET_PATH: str = ""
 
     SUMMARY_MODEL: str = "Mistral-Nemo-Instruct-2407"
     SUMMARY_ENDPOINT: str = "https://mistral-nemo-instruct-2407.endpoints.kepler.ai.cloud.ovh.net/api/openai_compat/v1"
     SUMMARY_API_KEY: str = ""
+    # several endpoints/API keys of the same model, the requests are spread across them (overrides SUMMARY_ENDPOINT/SUMMARY_API_KEY)
+    SUMMARY_ENDPOINTS: list[str] = []
+    SUMMARY_API_KEYS: list[str] = []
+    SUMMARY_ENDPOINT_WEIGHTS: list[float] = []
     SUMMARY_MAX_LENGTH: int = 50
     SUMMARY_TEMPERATURE: float = 0.7
+    # 0 disables the embedding based quality check of the summaries
     SUMMARY_QUALITY_THRESHOLD: float = 0.6
+    # embedding model backend of the quality check: torch, int8 (dynamic quantization) or onnx (requires the onnx extra)
+    SUMMARY_QUALITY_BACKEND: str = "torch"
+    # the ONNX export of the embedding model is cached here
+    SUMMARY_QUALITY_CACHE_DIR: str = ".cache/embeddings"
     SUMMARY_MIN_WAIT_TIME: float = 0.06
+    SUMMARY_TOKENS_PER_MINUTE: int = 0
+    SUMMARY_REQUESTS_PER_MINUTE: int = 0
+    # news items with more tokens than this are split into chunks that are summarized in parallel (0 disables it)
+    SUMMARY_LONG_DOC_THRESHOLD: int = 0
+    SUMMARY_CHUNK_TOKENS: int = 2000
+    SUMMARY_CHUNK_CONCURRENCY: int = 4
+    # stream the summaries and abort a generation as soon as it is too long or in the wrong language
+    SUMMARY_STREAMING: bool = False
 
     CYBERSEC_CLASS_MODEL: str = "Mixtral-8x7B-Instruct-v0.1"
     CYBERSEC_CLASS_ENDPOINT: str = "https://mixtral-8x7b-instruct-v01.endpoints.kepler.ai.cloud.ovh.net/api/openai_compat/v1"
     CYBERSEC_CLASS_API_KEY: str = ""
+    CYBERSEC_CLASS_ENDPOINTS: list[str] = []
+    CYBERSEC_CLASS_API_KEYS: list[str] = []
+    CYBERSEC_CLASS_ENDPOINT_WEIGHTS: list[float] = []
     CYBERSEC_CLASS_TEMPERATURE: float = 0.7
     CYBERSEC_CLASS_MIN_WAIT_TIME: float = 0.06
+    CYBERSEC_CLASS_TOKENS_PER_MINUTE: int = 0
+    CYBERSEC_CLASS_REQUESTS_PER_MINUTE: int = 0
+    # classify one news item per story and copy its label to the other news items of the story
+    CYBERSEC_CLASS_PROPAGATE_STORY_LABEL: bool = False
+    # share of stories for which one additional news item is classified to check the propagated labels
+    CYBERSEC_CLASS_PROPAGATION_SAMPLE_RATE: float = 0.05
+
+    SUMMARY_CYBERSEC_CLASS_MODEL: str = "Mistral-Nemo-Instruct-2407"
+    SUMMARY_CYBERSEC_CLASS_ENDPOINT: str = "https://mistral-nemo-instruct-2407.endpoints.kepler.ai.cloud.ovh.net/api/openai_compat/v1"
+    SUMMARY_CYBERSEC_CLASS_API_KEY: str = ""
+    SUMMARY_CYBERSEC_CLASS_ENDPOINTS: list[str] = []
+    SUMMARY_CYBERSEC_CLASS_API_KEYS: list[str] = []
+    SUMMARY_CYBERSEC_CLASS_ENDPOINT_WEIGHTS: list[float] = []
+    SUMMARY_CYBERSEC_CLASS_TEMPERATURE: float = 0.7
+    SUMMARY_CYBERSEC_CLASS_MIN_WAIT_TIME: float = 0.06
+    SUMMARY_CYBERSEC_CLASS_TOKENS_PER_MINUTE: int = 0
+    SUMMARY_CYBERSEC_CLASS_REQUESTS_PER_MINUTE: int = 0
+
+    # connection pool shared by the load step and all LLM clients, HTTP/2 is used if the h2 package is installed
+    HTTP_MAX_CONNECTIONS: int = 20
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    HTTP_KEEPALIVE_EXPIRY: float = 60.0
+    HTTP_CONNECT_TIMEOUT: float = 10.0
+    HTTP_READ_TIMEOUT: float = 120.0
+    HTTP2: bool = True
+
+    # duplicate LLM requests that take longer than the HEDGE_QUANTILE of the recent latencies of their endpoint
+    # and stop waiting after ADAPTIVE_TIMEOUT_MULTIPLIER * p99 (at most HTTP_READ_TIMEOUT)
+    HEDGE_REQUESTS: bool = False
+    HEDGE_QUANTILE: float = 0.95
+    HEDGE_MAX_RATIO: float = 0.1
+    # no duplicates are sent while this many requests that lost the race or timed out are still being stopped
+    HEDGE_MAX_ABANDONED: int = 8
+    ADAPTIVE_TIMEOUT_MULTIPLIER: float = 3.0
+    ADAPTIVE_TIMEOUT_MIN: float = 5.0
+
+    # consecutive errors after which an endpoint of a pool is skipped for ENDPOINT_RESET_TIMEOUT seconds (a 429 skips it right away)
+    ENDPOINT_FAILURE_THRESHOLD: int = 3
+    ENDPOINT_RESET_TIMEOUT: float = 30.0
+
+    # only estimate requests, tokens and duration of the LLM steps without sending any requests
+    DRY_RUN: bool = False
 
     DEBUG: bool = False
 
+    # write metrics of the run to this file, as JSON if it ends with .json, otherwise in the Prometheus text format
+    METRICS_PATH: str = ""
+    # profile every step with cProfile and tracemalloc and write the reports to PROFILE_DIR
+    PROFILE: bool = False
+    PROFILE_DIR: str = "profiles"
+
+    # directory the results table is exported to, as "parquet" or "arrow" (IPC) files
+    EXPORT_PATH: str = ""
+    EXPORT_FORMAT: str = "parquet"
+    # column to partition the export by, e.g. language or summary_status
+    EXPORT_PARTITION_BY: str = ""
+    EXPORT_BATCH_SIZE: int = 50_000
+    # zstd, lz4 or snappy (parquet only), empty for none
+    EXPORT_COMPRESSION: str = "zstd"
+
+    # keep an FTS5 full-text index (results_fts) over title and content of the results table
+    FTS_INDEX: bool = False
+    # FTS5 query, e.g. "ransomware OR phishing", the LLM steps and taranis_ds_search only select matching news items
+    SUBSET_QUERY: str = ""
+    # only select news items in this language, e.g. "de"
+    SUBSET_LANGUAGE: str = ""
+    SEARCH_LIMIT: int = 100
+
+    # retry news items whose request failed (ERROR, TOO_MANY_REQUESTS) from a queue in the database later in the same run
+    # instead of blocking the step, waiting RETRY_BASE_DELAY * 2^(attempt - 1) seconds (at most RETRY_MAX_DELAY) between attempts
+    # news items that failed RETRY_MAX_ATTEMPTS times are marked DEAD_LETTER and not selected again
+    RETRY_QUEUE: bool = False
+    RETRY_MAX_ATTEMPTS: int = 5
+    RETRY_BASE_DELAY: float = 5.0
+    RETRY_MAX_DELAY: float = 120.0
+
     DB_PATH: str = "taranis_data_pipeline.db"
 
     @field_validator("DB_PATH", mode="before")
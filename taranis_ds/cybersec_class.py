@@ -4,24 +4,35 @@ cybersec_class.py
 Classify news items in Cybersecurity/Non-Cybersecurity
 """
 
+import random
 import re
 import sqlite3
-import time
+from collections import defaultdict
 from typing import Dict, List
 
 from langchain.globals import set_debug
-from langchain.output_parsers import RetryWithErrorOutputParser
 from langchain.prompts import PromptTemplate
 from langchain.schema import OutputParserException
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.output_parsers import BaseOutputParser
-from langchain_mistralai import ChatMistralAI
 
 from taranis_ds.config import Config
-from taranis_ds.llm_tools import create_chain, prompt_model_with_retry
+from taranis_ds.endpoint_pool import create_chat_model, get_endpoints
+from taranis_ds.llm_tools import RepairingOutputParser, create_chain, create_retry_parser, prompt_model_with_retry, strip_formatting
 from taranis_ds.log import get_logger
+from taranis_ds.metrics import MetricsCallbackHandler, record_item
 from taranis_ds.misc import check_config, convert_language
-from taranis_ds.persist import check_column_exists, get_db_connection, insert_column, run_query, update_row
+from taranis_ds.persist import (
+    check_column_exists,
+    get_content_column,
+    get_db_connection,
+    get_subset_filter,
+    insert_column,
+    run_query,
+    update_row,
+)
+from taranis_ds.retry_queue import RetryQueue, create_retry_queue
+from taranis_ds.scheduler import TokenBudgetScheduler, estimate_tokens
 
 
 logger = get_logger(__name__)
@@ -34,6 +45,8 @@ CYBERSEC_CLASS_PROMPT_TEMPLATE = (
     "Text: {text}"
 )
 
+SPACED_LABEL_RE = re.compile(r"\b(non|not)?[\s_-]*c(yb|by)er[\s_-]+security\b", re.IGNORECASE)
+
 
 def process_answer(text):
     if match := re.search(r"(non-)?c(yb|by)er(s)?ecurity", text, re.IGNORECASE):
@@ -48,6 +61,31 @@ class CategoryOutputParser(BaseOutputParser):
         else:
             raise OutputParserException(f"Invalid output: {text}. The output should be only one of 'cybersecurity' or 'non-cybersecurity'")
 
+    def repair(self, text: str) -> str:
+        # e.g. "**Cyber Security**" or "non cyber-security"
+        return SPACED_LABEL_RE.sub(lambda match: "non-cybersecurity" if match[1] else "cybersecurity", strip_formatting(text))
+
+
+def group_by_story(news_items: List[Dict]) -> List[List[Dict]]:
+    stories = defaultdict(list)
+    for row in news_items:
+        stories[row["id"]].append(row)
+    return list(stories.values())
+
+
+def select_propagation_items(stories: List[List[Dict]], sample_rate: float, rng: random.Random) -> tuple[List[Dict], List[Dict]]:
+    # one representative per story with the median token count, so neither stubs nor the longest items are picked
+    # for a sample of stories one additional sibling is classified to measure how consistent the propagated labels are
+    representatives, samples = [], []
+    for story in stories:
+        by_tokens = sorted(story, key=lambda row: row.get("tokens") or 0)
+        representative = by_tokens[(len(by_tokens) - 1) // 2]
+        representatives.append(representative)
+        siblings = [row for row in story if row is not representative]
+        if siblings and rng.random() < sample_rate:
+            samples.append(rng.choice(siblings))
+    return representatives, samples
+
 
 def classify_news_item_cybersecurity(
     chat_model: BaseChatModel,
@@ -55,54 +93,108 @@ def classify_news_item_cybersecurity(
     connection: sqlite3.Connection,
     min_wait: float,
     debug: bool = False,
-):
+    scheduler: TokenBudgetScheduler | None = None,
+    propagate: bool = False,
+    sample_rate: float = 0.0,
+    rng: random.Random | None = None,
+    retry_queue: RetryQueue | None = None,
+) -> dict:
     if debug:
         set_debug(True)
 
-    category_parser = CategoryOutputParser()
-    retry_parser = RetryWithErrorOutputParser.from_llm(parser=category_parser, llm=chat_model, max_retries=3)
+    scheduler = scheduler or TokenBudgetScheduler(min_wait=min_wait)
+    repairing_parser = RepairingOutputParser(parser=CategoryOutputParser())
+    retry_parser = create_retry_parser(repairing_parser, chat_model, max_retries=3)
 
     prompt = PromptTemplate(template=CYBERSEC_CLASS_PROMPT_TEMPLATE, input_variables=["language", "text"])
 
-    attempt = 0
-    cooldown_count = 0
-
-    for i, row in enumerate(news_items):
-        logger.info("Classifying news item %s/%s", i + 1, len(news_items))
+    items_to_classify = news_items
+    if propagate:
+        stories = group_by_story(news_items)
+        representatives, samples = select_propagation_items(stories, sample_rate, rng or random.Random())
+        items_to_classify = representatives + samples
+        logger.info("Classifying %s representatives of %s stories and %s sampled siblings", len(representatives), len(stories), len(samples))
+
+    labels = {}
+    # with a retry queue a failed news item is retried later instead of blocking the others
+    max_retries = 1 if retry_queue else 3
+    items = retry_queue.iter_items(scheduler.order(items_to_classify)) if retry_queue else scheduler.order(items_to_classify)
+    for i, row in enumerate(items):
+        logger.info("Classifying news item %s/%s", i + 1, len(items_to_classify))
+        scheduler.wait(row)
         prompt_lang = convert_language(row["language"])
         chain = create_chain(chat_model, prompt, retry_parser)
 
-        category, status = prompt_model_with_retry(chain, {"language": prompt_lang, "text": row["content"]})
-
-        if status == "TOO_MANY_REQUESTS":
-            logger.error("Got TOO_MANY_REQUESTS response. Continuing to next item and increasing the wait time.")
-            attempt += 1
-            cooldown_count = 0
+        category, status = prompt_model_with_retry(chain, {"language": prompt_lang, "text": row["content"]}, max_retries)
+        scheduler.report(status)
+        if retry_queue:
+            status = retry_queue.update(str(row["news_item_id"]), row, status)
 
+        labels[row["news_item_id"]] = (category, status)
         logger.info("STATUS: %s", status)
+        record_item(status)
         try:
-            update_row(connection, "results", row["id"], ["cybersecurity", "cybersecurity_status"], [category, status])
+            update_row(
+                connection, "results", row["news_item_id"], ["cybersecurity", "cybersecurity_status"], [category, status], "news_item_id"
+            )
         except RuntimeError as e:
             logger.error(e)
 
-        sleep_time = min(10.0, max(min_wait, min_wait * (2**attempt)))
-        logger.debug("Waiting %s s before next request", sleep_time)
-        time.sleep(sleep_time)
-        cooldown_count += 1
-        if cooldown_count == 5:
-            cooldown_count = 0
-            if attempt > 0:
-                attempt -= 1
+    repairing_parser.log_stats()
+    stats = {"classified": len(labels), "propagated": 0, "sampled": 0, "agreeing": 0}
+    if propagate:
+        propagate_story_labels(connection, stories, representatives, labels, stats)
 
     set_debug(False)
+    return stats
+
+
+def propagate_story_labels(connection: sqlite3.Connection, stories: List[List[Dict]], representatives: List[Dict], labels: dict, stats: dict):
+    for story, representative in zip(stories, representatives):
+        category, status = labels[representative["news_item_id"]]
+        if status != "OK":
+            # siblings stay unclassified and are picked up again in the next run
+            continue
+
+        for row in story:
+            if row is representative:
+                continue
+            if row["news_item_id"] in labels:
+                sampled_category, sampled_status = labels[row["news_item_id"]]
+                if sampled_status == "OK":
+                    stats["sampled"] += 1
+                    stats["agreeing"] += sampled_category == category
+                continue
+
+            try:
+                update_row(
+                    connection,
+                    "results",
+                    row["news_item_id"],
+                    ["cybersecurity", "cybersecurity_status"],
+                    [category, "PROPAGATED"],
+                    "news_item_id",
+                )
+                stats["propagated"] += 1
+                record_item("PROPAGATED")
+            except RuntimeError as e:
+                logger.error(e)
+
+    logger.info("Propagated story labels to %s news items", stats["propagated"])
+    if stats["sampled"]:
+        logger.info(
+            "Propagation consistency: %s of %s sampled siblings agree with the story label (%.1f%%)",
+            stats["agreeing"],
+            stats["sampled"],
+            100 * stats["agreeing"] / stats["sampled"],
+        )
 
 
 def run():
     logger.info("Running cybersecurity classification step")
-    for conf_name, conf_type in [("CYBERSEC_CLASS_MODEL", str), ("CYBERSEC_CLASS_API_KEY", str), ("CYBERSEC_CLASS_ENDPOINT", str)]:
-        if not check_config(conf_name, conf_type):
-            logger.error("Skipping cybersecurity classification step")
-            return
+    if not check_config("CYBERSEC_CLASS_MODEL", str) or not (endpoints := get_endpoints("CYBERSEC_CLASS")):
+        logger.error("Skipping cybersecurity classification step")
+        return
 
     connection = get_db_connection(Config.DB_PATH, "results")
 
@@ -110,22 +202,33 @@ def run():
         if not check_column_exists(connection, "results", col):
             insert_column(connection, "results", col, "TEXT")
     try:
+        subset_filter, params = get_subset_filter(connection, "results", Config.SUBSET_QUERY, Config.SUBSET_LANGUAGE)
         query_result = run_query(
             connection,
-            "SELECT id, content, language FROM results WHERE cybersecurity_status IS NOT 'OK'",
+            f"SELECT id, news_item_id, {get_content_column(connection, 'results')}, language, tokens FROM results "
+            f"WHERE (cybersecurity_status IS NULL OR cybersecurity_status NOT IN ('OK', 'PROPAGATED', 'DEAD_LETTER')){subset_filter}",
+            params,
         )
     except RuntimeError as e:
         logger.error(e)
         return
     logger.info("Classifying %s news items into Cybersecurity/Non-Cybersecurity", len(query_result))
-    news_items = [{"id": row[0], "content": row[1], "language": row[2]} for row in query_result]
-
-    chat_model = ChatMistralAI(
-        model=Config.CYBERSEC_CLASS_MODEL,
-        api_key=Config.CYBERSEC_CLASS_API_KEY,
-        endpoint=Config.CYBERSEC_CLASS_ENDPOINT,
-        max_tokens=10,
+    news_items = [{"id": row[0], "news_item_id": row[1], "content": row[2], "language": row[3], "tokens": row[4]} for row in query_result]
+
+    scheduler = TokenBudgetScheduler(
+        tokens_per_minute=Config.CYBERSEC_CLASS_TOKENS_PER_MINUTE,
+        requests_per_minute=Config.CYBERSEC_CLASS_REQUESTS_PER_MINUTE,
+        min_wait=Config.CYBERSEC_CLASS_MIN_WAIT_TIME,
+        prompt_overhead=estimate_tokens(CYBERSEC_CLASS_PROMPT_TEMPLATE),
+        completion_tokens=10,
     )
+    if Config.DRY_RUN:
+        if Config.CYBERSEC_CLASS_PROPAGATE_STORY_LABEL:
+            news_items = select_propagation_items(group_by_story(news_items), 0.0, random.Random())[0]
+        scheduler.log_estimate(news_items, "cybersecurity classification")
+        return
+
+    chat_model = create_chat_model(Config.CYBERSEC_CLASS_MODEL, endpoints, callbacks=[MetricsCallbackHandler()], max_tokens=10)
 
     classify_news_item_cybersecurity(
         chat_model,
@@ -133,6 +236,10 @@ def run():
         connection,
         Config.CYBERSEC_CLASS_MIN_WAIT_TIME,
         Config.DEBUG,
+        scheduler,
+        Config.CYBERSEC_CLASS_PROPAGATE_STORY_LABEL,
+        Config.CYBERSEC_CLASS_PROPAGATION_SAMPLE_RATE,
+        retry_queue=create_retry_queue(connection, "cybersec_class"),
     )
 
 
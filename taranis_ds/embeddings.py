@@ -0,0 +1,71 @@
+"""
+embeddings.py
+
+Load the sentence embedding model of the summary quality check, in full precision (torch)
+or with a faster CPU backend: dynamic int8 quantization (int8) or an exported ONNX Runtime model (onnx)
+"""
+
+import importlib.util
+from functools import lru_cache
+from pathlib import Path
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+from taranis_ds.log import get_logger
+
+
+logger = get_logger(__name__)
+
+EMBEDDING_MODEL = "sentence-transformers/xlm-r-100langs-bert-base-nli-stsb-mean-tokens"
+EMBEDDING_BACKENDS = ["torch", "int8", "onnx"]
+
+
+def quantize_model(model: torch.nn.Module) -> torch.nn.Module:
+    # int8 weights for the linear layers, the activations are quantized on the fly, returns a quantized copy
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def backend_available(backend: str) -> bool:
+    # the onnx backend needs the packages of the onnx extra, the others only torch
+    if backend == "onnx":
+        return importlib.util.find_spec("onnxruntime") is not None and importlib.util.find_spec("optimum") is not None
+    return True
+
+
+def load_onnx_model(model_name: str, cache_dir: str) -> SentenceTransformer:
+    # exporting the model to ONNX takes a while, so the exported model is saved once and loaded from cache_dir afterwards
+    cache_path = Path(cache_dir) / f"{model_name.replace('/', '--')}-onnx"
+    if cache_path.exists():
+        return SentenceTransformer(str(cache_path), device="cpu", backend="onnx")
+
+    logger.info("Exporting %s to ONNX, saving it to %s", model_name, cache_path)
+    model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+    model.save_pretrained(str(cache_path))
+    return model
+
+
+@lru_cache
+def get_embedding_model(
+    backend: str = "torch", model_name: str = EMBEDDING_MODEL, cache_dir: str = ".cache/embeddings"
+) -> SentenceTransformer:
+    # loaded once per process instead of once per summary
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Embedding backend must be one of {EMBEDDING_BACKENDS}")
+
+    if not backend_available(backend):
+        logger.warning("The %s backend requires pip install taranis-dataset-tools[%s], falling back to int8", backend, backend)
+        backend = "int8"
+    if backend == "onnx":
+        return load_onnx_model(model_name, cache_dir)
+
+    logger.info("Loading embedding model %s with the %s backend", model_name, backend)
+    if backend == "int8":
+        return quantize_model(SentenceTransformer(model_name, device="cpu"))
+    return SentenceTransformer(model_name)
+
+
+def cosine_similarity(model: SentenceTransformer, text: str, other_text: str) -> float:
+    # both texts are encoded in one batch, mean pooling ignores the padding of the shorter one
+    embeddings = model.encode([text, other_text], convert_to_tensor=True)
+    return torch.nn.CosineSimilarity(dim=0)(embeddings[0], embeddings[1]).item()
@@ -0,0 +1,234 @@
+"""
+endpoint_pool.py
+
+Spread the requests of an LLM step across several endpoints/API keys
+with weighted least-outstanding-requests balancing and a circuit breaker per endpoint
+"""
+
+import threading
+import time
+from typing import Annotated, Any, Callable, Iterator
+
+import httpx
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_mistralai import ChatMistralAI
+from pydantic import PrivateAttr, SkipValidation
+
+from taranis_ds.config import Config
+from taranis_ds.http_client import create_llm_clients
+from taranis_ds.llm_tools import HedgedChatModel
+from taranis_ds.log import get_logger
+from taranis_ds.metrics import metrics
+
+
+logger = get_logger(__name__)
+
+
+class CircuitBreaker:
+    # closed: requests pass, open: endpoint is skipped, half-open: one trial request decides whether to close again
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "open" and self.clock() - self.opened_at >= self.reset_timeout:
+            self.state = "half-open"
+        return self.state != "open"
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self, rate_limited: bool = False):
+        # a 429 opens the circuit right away, the quota of this endpoint is used up for now
+        self.failures += 1
+        if rate_limited or self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = self.clock()
+
+
+class Endpoint:
+    def __init__(self, model: BaseChatModel, weight: float, breaker: CircuitBreaker, name: str):
+        self.model = model
+        self.weight = weight
+        self.breaker = breaker
+        self.name = name
+        self.outstanding = 0
+        self.served = 0
+
+
+class PooledChatModel(BaseChatModel):
+    models: list[Annotated[BaseChatModel, SkipValidation()]]
+    weights: list[float] = []
+    failure_threshold: int = 3
+    reset_timeout: float = 30.0
+    clock: Annotated[Callable[[], float], SkipValidation()] = time.monotonic
+
+    _endpoints: list[Endpoint] = PrivateAttr(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def model_post_init(self, context: Any):
+        weights = self.weights or [1.0] * len(self.models)
+        if len(weights) != len(self.models):
+            raise ValueError("PooledChatModel needs one weight per model")
+        self._endpoints = [
+            Endpoint(
+                model, weight, CircuitBreaker(self.failure_threshold, self.reset_timeout, self.clock), getattr(model, "endpoint", str(i))
+            )
+            for i, (model, weight) in enumerate(zip(self.models, weights))
+        ]
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-chat-model"
+
+    def _acquire(self, exclude: set[int]) -> Endpoint | None:
+        with self._lock:
+            candidates = [endpoint for i, endpoint in enumerate(self._endpoints) if i not in exclude]
+            if not candidates:
+                return None
+            # a half-open endpoint gets a single trial request at a time
+            available = [
+                endpoint
+                for endpoint in candidates
+                if endpoint.breaker.allow() and (endpoint.breaker.state == "closed" or endpoint.outstanding == 0)
+            ]
+            if not available:
+                # all circuits are open, try the one that has been open the longest instead of failing right away
+                available = [min(candidates, key=lambda endpoint: endpoint.breaker.opened_at)]
+            # fewest outstanding requests relative to the weight, ties are spread by the number of requests served
+            endpoint = min(available, key=lambda endpoint: (endpoint.outstanding / endpoint.weight, endpoint.served / endpoint.weight))
+            endpoint.outstanding += 1
+            endpoint.served += 1
+            return endpoint
+
+    def _release(self, endpoint: Endpoint, error: Exception | None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                if endpoint.breaker.state != "closed":
+                    # a recovered endpoint continues with the same share as the others instead of catching up
+                    endpoint.served = max(e.served / e.weight for e in self._endpoints) * endpoint.weight
+                    logger.info("Endpoint %s recovered", endpoint.name)
+                endpoint.breaker.record_success()
+                return
+            was_open = endpoint.breaker.state == "open"
+            endpoint.breaker.record_failure(rate_limited="429" in str(error))
+            if endpoint.breaker.state == "open" and not was_open:
+                logger.warning("Endpoint %s failed, moving traffic away for %ss. Error: %s", endpoint.name, self.reset_timeout, error)
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tried = set()
+        last_error = None
+        while (endpoint := self._acquire(tried)) is not None:
+            tried.add(self._endpoints.index(endpoint))
+            try:
+                result = endpoint.model._generate(messages, stop=stop, **kwargs)
+            except httpx.HTTPError as e:
+                self._release(endpoint, e)
+                metrics.inc("taranis_ds_llm_endpoint_requests_total", endpoint=endpoint.name, status="ERROR")
+                last_error = e
+                continue
+            self._release(endpoint, None)
+            metrics.inc("taranis_ds_llm_endpoint_requests_total", endpoint=endpoint.name, status="OK")
+            return result
+        # every endpoint failed, the caller decides whether to retry
+        raise last_error
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # failover is only possible until the first chunk arrived, afterwards an error ends the stream
+        tried = set()
+        last_error = None
+        while (endpoint := self._acquire(tried)) is not None:
+            tried.add(self._endpoints.index(endpoint))
+            error = None
+            started = False
+            try:
+                for chunk in endpoint.model._stream(messages, stop=stop, **kwargs):
+                    started = True
+                    yield chunk
+            except httpx.HTTPError as e:
+                error = e
+                if started:
+                    raise
+                last_error = e
+                continue
+            finally:
+                self._release(endpoint, error)
+                metrics.inc("taranis_ds_llm_endpoint_requests_total", endpoint=endpoint.name, status="ERROR" if error else "OK")
+            return
+        raise last_error
+
+
+def get_endpoints(prefix: str) -> list[tuple[str, str, float]]:
+    # *_ENDPOINTS/*_API_KEYS take precedence over the single *_ENDPOINT/*_API_KEY, one API key may be shared by all endpoints
+    endpoints = getattr(Config, f"{prefix}_ENDPOINTS") or [getattr(Config, f"{prefix}_ENDPOINT")]
+    api_keys = getattr(Config, f"{prefix}_API_KEYS") or [getattr(Config, f"{prefix}_API_KEY")]
+    weights = getattr(Config, f"{prefix}_ENDPOINT_WEIGHTS") or [1.0] * len(endpoints)
+    if len(api_keys) == 1:
+        api_keys = api_keys * len(endpoints)
+
+    if len(api_keys) != len(endpoints) or len(weights) != len(endpoints):
+        logger.error("%s_API_KEYS and %s_ENDPOINT_WEIGHTS must have one entry per endpoint in %s_ENDPOINTS", prefix, prefix, prefix)
+        return []
+    if not all(endpoints) or not all(api_keys):
+        logger.error("Config %s_ENDPOINT(S) and %s_API_KEY(S) must be set", prefix, prefix)
+        return []
+    if any(weight <= 0 for weight in weights):
+        logger.error("Config %s_ENDPOINT_WEIGHTS must be positive", prefix)
+        return []
+    return list(zip(endpoints, api_keys, weights))
+
+
+def create_chat_model(model: str, endpoints: list[tuple[str, str, float]], callbacks: list | None = None, **kwargs) -> BaseChatModel:
+    if len(endpoints) > 1:
+        # a pooled model makes a single attempt (max_retries counts attempts), the pool fails over to the next endpoint
+        # instead of retrying connection errors of an unreachable endpoint with backoff
+        kwargs["max_retries"] = 1
+    chat_models = []
+    for endpoint, api_key, _ in endpoints:
+        client, async_client = create_llm_clients(endpoint, api_key)
+        chat_model = ChatMistralAI(model=model, api_key=api_key, endpoint=endpoint, client=client, async_client=async_client, **kwargs)
+        if Config.HEDGE_REQUESTS:
+            chat_model = HedgedChatModel(
+                model=chat_model,
+                endpoint=endpoint,
+                hedge_quantile=Config.HEDGE_QUANTILE,
+                max_hedge_ratio=Config.HEDGE_MAX_RATIO,
+                max_abandoned=Config.HEDGE_MAX_ABANDONED,
+                timeout_multiplier=Config.ADAPTIVE_TIMEOUT_MULTIPLIER,
+                min_timeout=Config.ADAPTIVE_TIMEOUT_MIN,
+                max_timeout=Config.HTTP_READ_TIMEOUT,
+            )
+        chat_models.append(chat_model)
+    if len(chat_models) == 1:
+        chat_models[0].callbacks = callbacks
+        return chat_models[0]
+    logger.info("Spreading requests across %s endpoints", len(chat_models))
+    return PooledChatModel(
+        models=chat_models,
+        weights=[weight for _, _, weight in endpoints],
+        failure_threshold=Config.ENDPOINT_FAILURE_THRESHOLD,
+        reset_timeout=Config.ENDPOINT_RESET_TIMEOUT,
+        callbacks=callbacks,
+    )
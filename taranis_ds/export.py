@@ -0,0 +1,165 @@
+"""
+export.py
+
+Export the results table as partitioned, compressed Parquet or Arrow IPC files for training and analysis jobs
+"""
+
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+from taranis_ds.config import Config
+from taranis_ds.log import get_logger
+from taranis_ds.metrics import record_item
+from taranis_ds.misc import check_config
+from taranis_ds.persist import check_table_exists
+
+
+logger = get_logger(__name__)
+
+EXPORT_FORMATS = ("parquet", "arrow")
+# marks a directory written by export_results, only such a directory is replaced by the next export
+EXPORT_MARKER = ".taranis_ds_export"
+SQLITE_TO_ARROW_TYPES = {"INTEGER": pa.int64(), "INT": pa.int64(), "REAL": pa.float64(), "FLOAT": pa.float64()}
+
+
+def get_arrow_schema(connection: sqlite3.Connection, table_name: str) -> pa.Schema:
+    # columns added by the steps (summary, cybersecurity, ...) are part of the table, every other declared type is exported as string
+    table_info = connection.execute(f"PRAGMA table_info({table_name})").fetchall()
+    return pa.schema([(entry[1], SQLITE_TO_ARROW_TYPES.get(entry[2].upper(), pa.string())) for entry in table_info])
+
+
+def iter_batches(connection: sqlite3.Connection, table_name: str, schema: pa.Schema, batch_size: int) -> Iterator[pa.RecordBatch]:
+    # only batch_size rows are held in memory at a time
+    cursor = connection.execute(f"SELECT {', '.join(schema.names)} FROM {table_name}")
+    while rows := cursor.fetchmany(batch_size):
+        columns = list(zip(*rows))
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+
+def get_file_format(export_format: str) -> ds.FileFormat:
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Export format must be one of {list(EXPORT_FORMATS)}")
+    return ds.ParquetFileFormat() if export_format == "parquet" else ds.IpcFileFormat()
+
+
+def check_export_path(output_path: Path):
+    if not output_path.exists():
+        return
+    if not output_path.is_dir() or (any(output_path.iterdir()) and not (output_path / EXPORT_MARKER).exists()):
+        raise RuntimeError(f"{output_path} is not empty and does not contain an earlier export")
+
+
+def replace_export(export_dir: Path, output_path: Path):
+    # the earlier export is only removed once the new one is complete
+    (export_dir / EXPORT_MARKER).touch()
+    if output_path.exists():
+        earlier_export = Path(tempfile.mkdtemp(prefix=f".{output_path.name}-old-", dir=output_path.parent))
+        output_path.rename(earlier_export / output_path.name)
+        export_dir.rename(output_path)
+        shutil.rmtree(earlier_export)
+    else:
+        export_dir.rename(output_path)
+
+
+def export_results(
+    db_path: str,
+    output_path: str,
+    table_name: str = "results",
+    export_format: str = "parquet",
+    partition_by: str = "",
+    batch_size: int = 50_000,
+    compression: str = "zstd",
+) -> int:
+    output = Path(output_path)
+    check_export_path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    # the export is written next to output_path and swapped in when it is complete
+    export_dir = Path(tempfile.mkdtemp(prefix=f".{output.name}-", dir=output.parent))
+    # write_dataset pulls the batches from one of its own threads
+    connection = sqlite3.Connection(db_path, check_same_thread=False)
+    try:
+        if not check_table_exists(connection, table_name):
+            raise RuntimeError(f"Table {table_name} does not exist.")
+        schema = get_arrow_schema(connection, table_name)
+        if partition_by and partition_by not in schema.names:
+            raise ValueError(f"Cannot partition by {partition_by}, table {table_name} has no such column")
+
+        file_format = get_file_format(export_format)
+        exported_rows = 0
+
+        def count_rows(batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+            nonlocal exported_rows
+            for batch in batches:
+                exported_rows += batch.num_rows
+                yield batch
+
+        # the batches are streamed into the files, one directory per partition value (e.g. language=de/part-0.parquet)
+        ds.write_dataset(
+            pa.RecordBatchReader.from_batches(schema, count_rows(iter_batches(connection, table_name, schema, batch_size))),
+            str(export_dir),
+            format=file_format,
+            file_options=file_format.make_write_options(compression=compression or None),
+            partitioning=[partition_by] if partition_by else None,
+            partitioning_flavor="hive",
+            basename_template=f"part-{{i}}.{export_format}",
+            max_rows_per_group=batch_size,
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        replace_export(export_dir, output)
+    finally:
+        connection.close()
+        shutil.rmtree(export_dir, ignore_errors=True)
+    return exported_rows
+
+
+def open_export(path: str, export_format: str = "parquet") -> ds.Dataset:
+    # the files are memory mapped, uncompressed Arrow files can then be read without copying them into memory
+    return ds.dataset(
+        str(Path(path).resolve()),
+        format=get_file_format(export_format),
+        partitioning="hive",
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def read_export(path: str, export_format: str = "parquet", columns: list[str] | None = None, filter: ds.Expression | None = None) -> pa.Table:
+    # e.g. read_export(path, columns=["content", "summary"], filter=ds.field("language") == "en")
+    return open_export(path, export_format).to_table(columns=columns, filter=filter)
+
+
+def run():
+    logger.info("Running export step")
+    if not check_config("EXPORT_PATH", str):
+        logger.error("Skipping export step")
+        return
+
+    if not Path(Config.DB_PATH).exists():
+        logger.error("%s does not exist", Config.DB_PATH)
+        return
+
+    try:
+        exported_rows = export_results(
+            Config.DB_PATH,
+            Config.EXPORT_PATH,
+            export_format=Config.EXPORT_FORMAT,
+            partition_by=Config.EXPORT_PARTITION_BY,
+            batch_size=Config.EXPORT_BATCH_SIZE,
+            compression=Config.EXPORT_COMPRESSION,
+        )
+    except (RuntimeError, ValueError, pa.ArrowException) as e:
+        logger.error("Could not export %s. Error: %s", Config.DB_PATH, e)
+        return
+
+    record_item("OK", exported_rows)
+    logger.info("Exported %s rows to %s", exported_rows, Config.EXPORT_PATH)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,69 @@
+"""
+http_client.py
+
+Shared HTTP clients with connection pooling and keep-alive for the Taranis AI API and the LLM endpoints
+"""
+
+import importlib.util
+from functools import lru_cache
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from taranis_ds.config import Config
+from taranis_ds.log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def http2_enabled() -> bool:
+    # httpx only speaks HTTP/2 with the optional h2 package (pip install httpx[http2])
+    return Config.HTTP2 and importlib.util.find_spec("h2") is not None
+
+
+def get_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=Config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_timeout() -> httpx.Timeout:
+    return httpx.Timeout(Config.HTTP_READ_TIMEOUT, connect=Config.HTTP_CONNECT_TIMEOUT)
+
+
+@lru_cache
+def get_transport() -> httpx.HTTPTransport:
+    # one connection pool for all LLM clients of the run, so every step reuses the open connections
+    logger.debug("Creating shared HTTP transport (HTTP/2: %s)", http2_enabled())
+    return httpx.HTTPTransport(limits=get_limits(), http2=http2_enabled())
+
+
+@lru_cache
+def get_async_transport() -> httpx.AsyncHTTPTransport:
+    return httpx.AsyncHTTPTransport(limits=get_limits(), http2=http2_enabled())
+
+
+def create_llm_clients(endpoint: str, api_key: str) -> tuple[httpx.Client, httpx.AsyncClient]:
+    # the same headers ChatMistralAI sets on its own clients, but on top of the shared transports
+    headers = {"Content-Type": "application/json", "Accept": "application/json", "Authorization": f"Bearer {api_key}"}
+    client = httpx.Client(base_url=endpoint, headers=headers, timeout=get_timeout(), transport=get_transport())
+    async_client = httpx.AsyncClient(base_url=endpoint, headers=headers, timeout=get_timeout(), transport=get_async_transport())
+    return client, async_client
+
+
+@lru_cache
+def get_session() -> requests.Session:
+    # requests has no HTTP/2 support, but keeps connections alive within a session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=Config.HTTP_MAX_CONNECTIONS, pool_maxsize=Config.HTTP_MAX_CONNECTIONS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_request_timeout() -> tuple[float, float]:
+    return Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT
@@ -4,30 +4,123 @@ llm_tools.py
 Common functions for interacting with the LLM
 """
 
+import asyncio
+import re
+import statistics
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Annotated, Any, Callable, Iterator
 
 import httpx
+from langchain.output_parsers import RetryWithErrorOutputParser
+from langchain.output_parsers.retry import NAIVE_RETRY_WITH_ERROR_PROMPT
 from langchain.prompts import PromptTemplate
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain_core.exceptions import OutputParserException
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import BaseOutputParser, StrOutputParser
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.prompt_values import PromptValue
 from langchain_core.runnables import RunnableLambda, RunnableParallel
 from langchain_core.runnables.base import RunnableSequence
+from pydantic import Field, PrivateAttr, SkipValidation
 
 from taranis_ds.log import get_logger
+from taranis_ds.metrics import current_stage, metrics, record_retry
 
 
 logger = get_logger(__name__)
 
+MARKDOWN_RE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$|^#+ .*\n|\*\*|__")
+QUOTES = "\"'`“”„«»"
 
-def create_chain(model: BaseChatModel, prompt: PromptTemplate, parser: BaseOutputParser):
-    completion_chain = prompt | model | RunnableLambda(lambda x: x.content)
+
+def strip_formatting(text: str) -> str:
+    # remove markdown code fences, headings, bold markers and surrounding quotes
+    return MARKDOWN_RE.sub("", text.strip()).strip().strip(QUOTES).strip()
+
+
+class RepairingOutputParser(BaseOutputParser):
+    # try to fix a rejected output with the deterministic repair() of the wrapped parser
+    # before the exception is passed on to the (paid) LLM retry of RetryWithErrorOutputParser
+    parser: Annotated[BaseOutputParser, SkipValidation()]
+    stats: dict = Field(default_factory=lambda: {"parsed": 0, "repaired": 0, "escalated": 0})
+
+    def parse(self, text: str):
+        try:
+            result = self.parser.parse(text)
+            self.stats["parsed"] += 1
+            return result
+        except OutputParserException as error:
+            repaired = self.parser.repair(text)
+            if repaired != text:
+                try:
+                    result = self.parser.parse(repaired)
+                    logger.debug("Repaired LLM output locally: %s", error)
+                    self.stats["repaired"] += 1
+                    return result
+                except OutputParserException:
+                    pass
+            raise error
+
+    def record_escalation(self, retry_inputs: dict) -> dict:
+        # called by the retry chain, the last rejection of RetryWithErrorOutputParser is not sent back to the LLM
+        self.stats["escalated"] += 1
+        record_retry("invalid_output")
+        return retry_inputs
+
+    def log_stats(self):
+        logger.info(
+            "Output parser: %s outputs valid, %s repaired locally, %s rejected and sent back to the LLM",
+            self.stats["parsed"],
+            self.stats["repaired"],
+            self.stats["escalated"],
+        )
+
+
+def create_retry_parser(parser: RepairingOutputParser, llm: BaseChatModel, max_retries: int = 3) -> RetryWithErrorOutputParser:
+    # same as RetryWithErrorOutputParser.from_llm, but every retry request is counted
+    retry_chain = RunnableLambda(parser.record_escalation) | NAIVE_RETRY_WITH_ERROR_PROMPT | llm | StrOutputParser()
+    return RetryWithErrorOutputParser(parser=parser, retry_chain=retry_chain, max_retries=max_retries)
+
+
+def stream_completion(model: BaseChatModel, prompt_value: PromptValue, create_abort_check: Callable[[], Callable[[str], bool]]) -> str:
+    # stop reading the completion as soon as the partial text is known to be invalid, closing the stream ends the generation
+    should_abort = create_abort_check()
+    text = ""
+    stream = model.stream(prompt_value)
+    try:
+        for chunk in stream:
+            text += chunk.content
+            if should_abort(text):
+                logger.debug("Aborted streamed completion after %s characters", len(text))
+                metrics.inc("taranis_ds_llm_aborted_streams_total", stage=current_stage.get())
+                break
+    finally:
+        stream.close()
+    return text
+
+
+def create_chain(
+    model: BaseChatModel,
+    prompt: PromptTemplate,
+    parser: BaseOutputParser,
+    create_abort_check: Callable[[], Callable[[str], bool]] | None = None,
+):
+    # with create_abort_check the completion is streamed and cut off early, the output parser then rejects it as usual
+    if create_abort_check is None:
+        completion_chain = prompt | model | RunnableLambda(lambda x: x.content)
+    else:
+        completion_chain = prompt | RunnableLambda(lambda prompt_value: stream_completion(model, prompt_value, create_abort_check))
     chain = RunnableParallel(completion=completion_chain, prompt_value=prompt) | RunnableLambda(lambda x: parser.parse_with_prompt(**x))
     return chain
 
 
 def prompt_model_with_retry(chain: RunnableSequence, model_inputs: dict, max_retries: int = 3) -> tuple[str, str]:
-    for _ in range(max_retries):
+    for attempt in range(max_retries):
         try:
             output, status = "", "OK"
             output = chain.invoke(model_inputs)
@@ -36,7 +129,9 @@ def prompt_model_with_retry(chain: RunnableSequence, model_inputs: dict, max_ret
             status = "ERROR"
 
             if "429" in str(e):
-                time.sleep(0.5)
+                record_retry("rate_limited")
+                if attempt < max_retries - 1:
+                    time.sleep(0.5)
             else:
                 break
         except OutputParserException as e:
@@ -47,3 +142,224 @@ def prompt_model_with_retry(chain: RunnableSequence, model_inputs: dict, max_ret
         status = "TOO_MANY_REQUESTS"
 
     return output, status
+
+
+class LatencyTracker:
+    # rolling window of the latencies of successful requests to one endpoint
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, q: float) -> float | None:
+        # None until there are enough samples for a meaningful estimate
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return statistics.quantiles(self.latencies, n=100, method="inclusive")[round(q * 100) - 1]
+
+
+class HedgedChatModel(BaseChatModel):
+    # sends a duplicate request if the first one is slower than the hedge_quantile of the recent latencies of the endpoint,
+    # uses whichever answer arrives first and gives up after an adaptive timeout derived from the same distribution
+    model: Annotated[BaseChatModel, SkipValidation()]
+    endpoint: str = ""
+    hedge_quantile: float = 0.95
+    # share of requests that may be duplicated, so a slow endpoint does not get twice the load
+    max_hedge_ratio: float = 0.1
+    # the timeout is timeout_multiplier * p99, clamped to [min_timeout, max_timeout]
+    timeout_multiplier: float = 3.0
+    min_timeout: float = 5.0
+    max_timeout: float = 120.0
+    window: int = 200
+    min_samples: int = 20
+    max_workers: int = 16
+    # no duplicates are sent while this many abandoned requests (lost the race or timed out) still occupy a worker
+    max_abandoned: int = 8
+
+    _tracker: LatencyTracker = PrivateAttr()
+    _executor: ThreadPoolExecutor | None = PrivateAttr(default=None)
+    _requests: int = PrivateAttr(default=0)
+    _hedges: int = PrivateAttr(default=0)
+    _abandoned: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def model_post_init(self, context: Any):
+        self._tracker = LatencyTracker(self.window, self.min_samples)
+        self.endpoint = self.endpoint or getattr(self.model, "endpoint", "") or self.model._llm_type
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat-model"
+
+    @property
+    def tracker(self) -> LatencyTracker:
+        return self._tracker
+
+    def get_timeout(self) -> float:
+        p99 = self._tracker.percentile(0.99)
+        if p99 is None:
+            return self.max_timeout
+        return min(max(p99 * self.timeout_multiplier, self.min_timeout), self.max_timeout)
+
+    def _get_hedge_delay(self) -> float | None:
+        with self._lock:
+            self._requests += 1
+            if self._hedges >= self.max_hedge_ratio * self._requests:
+                return None
+            if self._abandoned >= self.max_abandoned:
+                metrics.inc("taranis_ds_llm_skipped_hedges_total", endpoint=self.endpoint)
+                return None
+        return self._tracker.percentile(self.hedge_quantile)
+
+    def _count_hedge(self):
+        with self._lock:
+            self._hedges += 1
+
+    def _record_result(self, winner: str, start: float):
+        if winner == "hedge":
+            logger.debug("Hedged request to %s answered first after %.2fs", self.endpoint, time.perf_counter() - start)
+        metrics.inc("taranis_ds_llm_hedged_requests_total", endpoint=self.endpoint, winner=winner)
+
+    def _timeout_error(self, timeout: float) -> httpx.TimeoutException:
+        metrics.inc("taranis_ds_llm_timeouts_total", endpoint=self.endpoint)
+        return httpx.TimeoutException(f"No answer from {self.endpoint} within the adaptive timeout of {timeout:.1f}s")
+
+    def _request(self, messages: list[BaseMessage], stop: list[str] | None, kwargs: dict, abandoned: threading.Event) -> ChatResult | None:
+        # returns None if the answer is not needed anymore
+        if abandoned.is_set():
+            return None
+        if type(self.model)._stream is BaseChatModel._stream:
+            return self.model._generate(messages, stop=stop, **kwargs)
+
+        # a running httpx request cannot be interrupted from another thread, so the answer is streamed and the request is stopped
+        # between two chunks, closing the stream closes the HTTP response and the endpoint stops generating tokens for it
+        chunks = self.model._stream(messages, stop=stop, **kwargs)
+        received = []
+        try:
+            for chunk in chunks:
+                if abandoned.is_set():
+                    return None
+                received.append(chunk)
+        finally:
+            chunks.close()
+        return generate_from_stream(iter(received))
+
+    def _submit(self, messages: list[BaseMessage], stop: list[str] | None, kwargs: dict) -> tuple[Future, threading.Event]:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedged-request")
+        start = time.perf_counter()
+        abandoned = threading.Event()
+        future = self._executor.submit(self._request, messages, stop, kwargs, abandoned)
+        # latencies of requests that lost the race are recorded as well (up to the moment they were stopped),
+        # otherwise the tail would disappear from the window
+        future.add_done_callback(lambda f: f.cancelled() or f.exception() or self._tracker.record(time.perf_counter() - start))
+        return future, abandoned
+
+    def _abandon(self, future: Future, abandoned: threading.Event, reason: str):
+        abandoned.set()
+        if future.cancel():
+            # still queued, never sent
+            return
+        with self._lock:
+            self._abandoned += 1
+        metrics.inc("taranis_ds_llm_abandoned_requests_total", endpoint=self.endpoint, reason=reason)
+        future.add_done_callback(lambda _: self._release_abandoned())
+
+    def _release_abandoned(self):
+        with self._lock:
+            self._abandoned -= 1
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # the request that lost the race (or all of them after a timeout) is stopped at its next chunk
+        start = time.perf_counter()
+        timeout, hedge_delay = self.get_timeout(), self._get_hedge_delay()
+        deadline = start + timeout
+        hedge_at = start + hedge_delay if hedge_delay is not None and hedge_delay < timeout else None
+        future, abandoned = self._submit(messages, stop, kwargs)
+        pending = {future: ("primary", abandoned)}
+        error = None
+        while pending:
+            done, _ = wait(pending, timeout=max(min(deadline, hedge_at or deadline) - time.perf_counter(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                label, _ = pending.pop(future)
+                if future.exception() is None:
+                    for other, (_, other_abandoned) in pending.items():
+                        self._abandon(other, other_abandoned, "lost")
+                    self._record_result(label, start)
+                    return future.result()
+                error = future.exception()
+            if hedge_at is not None and time.perf_counter() >= hedge_at:
+                hedge_at = None
+                if pending:
+                    self._count_hedge()
+                    future, abandoned = self._submit(messages, stop, kwargs)
+                    pending[future] = ("hedge", abandoned)
+            elif not done and time.perf_counter() >= deadline:
+                for future, (_, abandoned) in pending.items():
+                    self._abandon(future, abandoned, "timeout")
+                raise self._timeout_error(timeout)
+        raise error
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        start = time.perf_counter()
+        timeout, hedge_delay = self.get_timeout(), self._get_hedge_delay()
+
+        async def timed_request() -> ChatResult:
+            request_start = time.perf_counter()
+            result = await self.model._agenerate(messages, stop=stop, **kwargs)
+            self._tracker.record(time.perf_counter() - request_start)
+            return result
+
+        pending = {asyncio.create_task(timed_request()): "primary"}
+        try:
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done:
+                    self._count_hedge()
+                    pending[asyncio.create_task(timed_request())] = "hedge"
+            error = None
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=max(start + timeout - time.perf_counter(), 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise self._timeout_error(timeout)
+                for task in done:
+                    label = pending.pop(task)
+                    if task.exception() is None:
+                        self._record_result(label, start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # cancel the request that lost the race (or all of them after a timeout)
+            for task in pending:
+                task.cancel()
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # streamed completions are not hedged, the consumer may abort them early anyway
+        yield from self.model._stream(messages, stop=stop, **kwargs)
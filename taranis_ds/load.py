@@ -4,16 +4,16 @@ load.py
 Load all news items from a Taranis AI instance
 """
 
-import json
 from json import JSONDecodeError
-from pathlib import Path
 from typing import Any
 
 import requests
 
 from taranis_ds.config import Config
+from taranis_ds.http_client import get_request_timeout, get_session
 from taranis_ds.log import get_logger
-from taranis_ds.misc import check_config
+from taranis_ds.metrics import record_item
+from taranis_ds.misc import check_config, check_dataset_path, write_stories
 
 
 logger = get_logger(__name__)
@@ -21,11 +21,11 @@ logger = get_logger(__name__)
 
 def fetch_taranis_stories(taranis_url: str, auth_endpoint: str, export_endpoint: str, username: str, password: str) -> list[dict[str, Any]]:
     try:
-        auth_response = requests.post(
+        auth_response = get_session().post(
             f"{taranis_url}{auth_endpoint}",
             headers={"Content-Type": "application/json", "Accept": "application/json"},
             json={"username": username, "password": password},
-            timeout=10,
+            timeout=get_request_timeout(),
         )
         auth_response.raise_for_status()
     except requests.HTTPError as e:
@@ -42,8 +42,10 @@ def fetch_taranis_stories(taranis_url: str, auth_endpoint: str, export_endpoint:
         return []
 
     try:
-        export_response = requests.get(
-            f"{taranis_url}{export_endpoint}", headers={"Accept": "application/json", "Authorization": f"Bearer {auth_token}"}, timeout=10
+        export_response = get_session().get(
+            f"{taranis_url}{export_endpoint}",
+            headers={"Accept": "application/json", "Authorization": f"Bearer {auth_token}"},
+            timeout=get_request_timeout(),
         )
         export_response.raise_for_status()
     except requests.HTTPError as e:
@@ -71,12 +73,7 @@ def run():
             logger.error("Skipping load step")
             return
 
-    if Path(Config.TARANIS_DATASET_PATH).exists():
-        logger.error("%s does already exist! Will not overwrite!", Config.TARANIS_DATASET_PATH)
-        return
-
-    if not Config.TARANIS_DATASET_PATH.endswith(".json"):
-        logger.error("%s must be in .json format", Config.TARANIS_DATASET_PATH)
+    if not check_dataset_path(Config.TARANIS_DATASET_PATH, exists=False):
         return
 
     logger.info("Fetching stories from %s", Config.TARANIS_INSTANCE_URL)
@@ -88,9 +85,9 @@ def run():
         Config.TARANIS_ADMIN_PASSWORD,
     )
 
+    record_item("OK", sum(len(story.get("news_items", [])) for story in stories))
     logger.info("Saving stories to %s", Config.TARANIS_DATASET_PATH)
-    with open(Config.TARANIS_DATASET_PATH, "w") as f:
-        json.dump(stories, f)
+    write_stories(stories, Config.TARANIS_DATASET_PATH)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+"""
+metrics.py
+
+Collect metrics of the pipeline steps and LLM requests, export them as Prometheus textfile or JSON
+and optionally profile the steps with cProfile and tracemalloc
+"""
+
+import bisect
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from taranis_ds.log import get_logger
+
+
+logger = get_logger(__name__)
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name of the running step, used as label of all metrics recorded while it runs
+current_stage: ContextVar[str] = ContextVar("current_stage", default="")
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # linear interpolation within the bucket, like histogram_quantile in Prometheus
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.gauges: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+
+    @staticmethod
+    def _key(labels: dict[str, str]) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = self._key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        with self.lock:
+            self.gauges.setdefault(name, {})[self._key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        with self.lock:
+            self.histograms.setdefault(name, {}).setdefault(self._key(labels), Histogram()).observe(value)
+
+    def total(self, name: str, **labels: str) -> float:
+        # sum of a counter over all series that match the given labels
+        with self.lock:
+            return sum(value for key, value in self.counters.get(name, {}).items() if set(labels.items()) <= set(key))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            report = {"counters": {}, "gauges": {}, "histograms": {}}
+            for kind in ["counters", "gauges"]:
+                for name, series in getattr(self, kind).items():
+                    report[kind][name] = [{"labels": dict(key), "value": value} for key, value in series.items()]
+            for name, series in self.histograms.items():
+                report["histograms"][name] = [
+                    {
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "p50": round(histogram.quantile(0.5), 6),
+                        "p95": round(histogram.quantile(0.95), 6),
+                        "buckets": dict(zip([*map(str, histogram.buckets), "+Inf"], histogram.counts)),
+                    }
+                    for key, histogram in series.items()
+                ]
+            return report
+
+    def to_prometheus(self) -> str:
+        def format_labels(key: tuple, extra: tuple = ()) -> str:
+            labels = [f'{name}="{value}"' for name, value in (*key, *extra)]
+            return "{" + ",".join(labels) + "}" if labels else ""
+
+        lines = []
+        with self.lock:
+            for kind, metric_type in [("counters", "counter"), ("gauges", "gauge")]:
+                for name, series in getattr(self, kind).items():
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    lines.extend(f"{name}{format_labels(key)} {value}" for key, value in series.items())
+            for name, series in self.histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip([*map(str, histogram.buckets), "+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(key, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # .json files get a JSON report, everything else the Prometheus text format (e.g. for the node exporter textfile collector)
+        content = json.dumps(self.to_dict(), indent=2) if path.endswith(".json") else self.to_prometheus()
+        tmp_path = Path(f"{path}.tmp")
+        tmp_path.write_text(content)
+        tmp_path.replace(path)
+
+
+metrics = MetricsRegistry()
+
+
+def record_item(status: str, count: int = 1):
+    metrics.inc("taranis_ds_items_total", count, stage=current_stage.get(), status=status)
+
+
+def record_retry(reason: str):
+    metrics.inc("taranis_ds_llm_retries_total", stage=current_stage.get(), reason=reason)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # records latency, status and token usage of every request sent to the chat model
+
+    def __init__(self, registry: MetricsRegistry = metrics):
+        self.registry = registry
+        self.requests: dict[UUID, tuple[float, str]] = {}
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: list[str], *, run_id: UUID, **kwargs: Any):
+        self.requests[run_id] = (time.perf_counter(), current_stage.get())
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list, *, run_id: UUID, **kwargs: Any):
+        self.requests[run_id] = (time.perf_counter(), current_stage.get())
+
+    def _finish(self, run_id: UUID, status: str) -> str:
+        start, stage = self.requests.pop(run_id, (time.perf_counter(), current_stage.get()))
+        self.registry.observe("taranis_ds_llm_request_seconds", time.perf_counter() - start, stage=stage)
+        self.registry.inc("taranis_ds_llm_requests_total", stage=stage, status=status)
+        return stage
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        stage = self._finish(run_id, "OK")
+        prompt_tokens, completion_tokens = 0, 0
+        for generation in (generation for generations in response.generations for generation in generations):
+            if usage := getattr(getattr(generation, "message", None), "usage_metadata", None):
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+        if not prompt_tokens and (token_usage := (response.llm_output or {}).get("token_usage")):
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        self.registry.inc("taranis_ds_llm_prompt_tokens_total", prompt_tokens, stage=stage)
+        self.registry.inc("taranis_ds_llm_completion_tokens_total", completion_tokens, stage=stage)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        if isinstance(error, GeneratorExit):
+            # the consumer stopped reading a streamed completion
+            self._finish(run_id, "ABORTED")
+            return
+        self._finish(run_id, "TOO_MANY_REQUESTS" if "429" in str(error) else "ERROR")
+
+
+def write_profile(profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot, peak: int, stage: str, profile_dir: str):
+    path = Path(profile_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(path / f"{stage}.prof")
+
+    stats_text = io.StringIO()
+    pstats.Stats(profiler, stream=stats_text).sort_stats("cumulative").print_stats(40)
+    (path / f"{stage}_cpu.txt").write_text(stats_text.getvalue())
+
+    memory_lines = [f"Peak traced memory: {peak / 2**20:.1f} MiB", "Top allocations by line:"]
+    memory_lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:25])
+    (path / f"{stage}_memory.txt").write_text("\n".join(memory_lines) + "\n")
+    logger.info("Wrote profile of %s step to %s", stage, path)
+
+
+@contextmanager
+def stage_metrics(stage: str, profile: bool = False, profile_dir: str = "profiles"):
+    token = current_stage.set(stage)
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            metrics.set("taranis_ds_stage_peak_memory_bytes", peak, stage=stage)
+            write_profile(profiler, snapshot, peak, stage, profile_dir)
+
+        items = metrics.total("taranis_ds_items_total", stage=stage)
+        metrics.set("taranis_ds_stage_seconds", round(duration, 3), stage=stage)
+        metrics.set("taranis_ds_stage_items_per_second", round(items / duration, 3) if duration else 0.0, stage=stage)
+        logger.info("Step %s took %.1fs for %d news items", stage, duration, items)
+        current_stage.reset(token)
@@ -5,7 +5,12 @@ Shared functionality across multiple modules
 e.g. Taranis Dataset loading
 """
 
+import gzip
+import importlib.util
+import json
 import sqlite3
+from pathlib import Path
+from typing import IO, Any
 
 import pandas as pd
 from iso639 import Lang
@@ -19,15 +24,24 @@ from taranis_ds.log import get_logger
 
 logger = get_logger(__name__)
 
+# JSON Lines datasets hold one story per line and can be written and read incrementally
+DATASET_SUFFIXES = (".json", ".jsonl", ".jsonl.gz", ".jsonl.zst")
+
 
 def save_df_to_table(df: pd.DataFrame, connection: sqlite3.Connection) -> int:
-    existing_df = pd.read_sql("SELECT * FROM results", connection, coerce_float=False)
-    new_df = df[~df["id"].isin(existing_df["id"])]  # get only rows that are not already in db
+    # news items are the rows of the results, the story id is shared by all news items of a story
+    key = "news_item_id" if "news_item_id" in df.columns else "id"
+    existing_df = pd.read_sql(f"SELECT {key} FROM results", connection, coerce_float=False)
+    new_df = df[~df[key].isin(existing_df[key])]  # get only rows that are not already in db
     if new_df.empty:
         logger.info("No new entries to save in database")
         return 0
 
-    return new_df.to_sql("results", connection, if_exists="append", index=False) or 0
+    try:
+        return new_df.to_sql("results", connection, if_exists="append", index=False) or 0
+    except sqlite3.IntegrityError as e:
+        # databases of earlier versions are keyed by story id and hold only one news item per story
+        raise RuntimeError(f"Cannot save news items to {Config.DB_PATH}, recreate it with the preprocess step. Error: {e}") from e
 
 
 def check_config(name: str, conf_type: type, required: bool = True):
@@ -42,6 +56,51 @@ def check_config(name: str, conf_type: type, required: bool = True):
     return True
 
 
+def check_dataset_path(path: str, exists: bool) -> bool:
+    # exists=True for datasets that are read, exists=False for datasets that are written and must not be overwritten
+    if exists and not Path(path).exists():
+        logger.error("%s does not exist", path)
+        return False
+    if not exists and Path(path).exists():
+        logger.error("%s does already exist! Will not overwrite!", path)
+        return False
+    if not path.endswith(DATASET_SUFFIXES):
+        logger.error("%s must be in one of the formats %s", path, ", ".join(DATASET_SUFFIXES))
+        return False
+    if path.endswith(".zst") and importlib.util.find_spec("zstandard") is None:
+        logger.error("Reading and writing %s requires the zstandard package (pip install taranis-dataset-tools[zstd])", path)
+        return False
+    return True
+
+
+def is_jsonl(path: str) -> bool:
+    return not path.endswith(".json")
+
+
+def open_dataset(path: str, mode: str = "rt") -> IO:
+    # (de)compresses while reading or writing, so the whole file is never held in memory
+    if path.endswith(".gz"):
+        # level 6 is about as small as the default 9 but several times faster to write
+        return gzip.open(path, mode, compresslevel=6, encoding="utf-8")
+    if path.endswith(".zst"):
+        import zstandard
+
+        return zstandard.open(path, mode, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def write_stories(stories: list[dict[str, Any]], path: str):
+    # written to a temporary file first, an interrupted write does not leave a truncated dataset behind
+    tmp_path = Path(path).with_name(f".tmp-{Path(path).name}")
+    with open_dataset(str(tmp_path), "wt") as f:
+        if not is_jsonl(path):
+            json.dump(stories, f)
+        else:
+            for story in stories:
+                f.write(json.dumps(story) + "\n")
+    tmp_path.replace(path)
+
+
 def convert_language(lang_code: str) -> str:
     try:
         language = Lang(lang_code).name.lower()
@@ -6,7 +6,7 @@ Deals with saving results from the pipeline to disk and loading them upon contin
 
 import sqlite3
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 
 from taranis_ds.log import get_logger
 
@@ -30,9 +30,11 @@ def init_db(db_path: str, table_name: str):
     if check_table_exists(connection, table_name):
         logger.info("Table %s already exists", table_name)
         connection.close()
+        return
 
+    # a story (id) has one row per news item
     connection.execute(
-        f"CREATE TABLE {table_name}(id TEXT PRIMARY KEY, news_item_id TEXT, title TEXT, content TEXT, tokens INTEGER, language TEXT)"
+        f"CREATE TABLE {table_name}(id TEXT, news_item_id TEXT PRIMARY KEY, title TEXT, content TEXT, tokens INTEGER, language TEXT)"
     )
     connection.close()
 
@@ -43,6 +45,13 @@ def get_db_connection(db_path: str, table_name) -> sqlite3.Connection:
     return sqlite3.Connection(db_path)
 
 
+def get_content_column(connection: sqlite3.Connection, table_name: str) -> str:
+    # prefer the cleaned text from preprocess if it was stored
+    if check_column_exists(connection, table_name, "clean_content"):
+        return "COALESCE(clean_content, content)"
+    return "content"
+
+
 def insert_column(connection: sqlite3.Connection, table_name: str, column_name: str, column_type: str):
     if not check_table_exists(connection, table_name):
         raise RuntimeError(f"Table {table_name} does not exist.")
@@ -56,20 +65,23 @@ def insert_column(connection: sqlite3.Connection, table_name: str, column_name:
         raise RuntimeError(f"Cannot add column {column_name} to table {table_name}. Error: {e}") from e
 
 
-def update_row(connection: sqlite3.Connection, table_name: str, row_id: str, columns: List[str], values: List[str | int]):
+def update_row(
+    connection: sqlite3.Connection, table_name: str, row_id: str, columns: List[str], values: List[str | int], id_column: str = "id"
+):
     update_statements = []
+    params = []
     for col, val in zip(columns, values):
-        if isinstance(val, int):
-            update_statements.append(f"{col} = {val}")
-        elif isinstance(val, str):
-            update_statements.append(f"{col} = '{val}'")
+        if isinstance(val, (int, str)):
+            update_statements.append(f"{col} = ?")
+            params.append(val)
     update_stmt = (", ").join(update_statements)
 
     with connection:
         try:
-            query = f"UPDATE {table_name} SET {update_stmt} WHERE id = '{row_id}'"
-            logger.debug("Running SQL query: %s", query)
-            result = connection.execute(query)
+            # values are bound as parameters since LLM outputs may contain quotes
+            query = f"UPDATE {table_name} SET {update_stmt} WHERE {id_column} = ?"
+            logger.debug("Running SQL query: %s with parameters %s", query, params)
+            result = connection.execute(query, [*params, row_id])
         except sqlite3.OperationalError as e:
             raise RuntimeError(f"Failed to update row with id {row_id}. Error: {e}") from e
 
@@ -77,10 +89,53 @@ def update_row(connection: sqlite3.Connection, table_name: str, row_id: str, col
             raise RuntimeError(f"Could not update row with id {row_id}.")
 
 
-def run_query(connection: sqlite3.Connection, query: str) -> List[Tuple]:
+def run_query(connection: sqlite3.Connection, query: str, params: Sequence = ()) -> List[Tuple]:
     try:
-        logger.debug("Running SQL query: %s", query)
-        result = connection.execute(query).fetchall()
+        logger.debug("Running SQL query: %s with parameters %s", query, params)
+        result = connection.execute(query, params).fetchall()
     except sqlite3.OperationalError as e:
         raise RuntimeError(f"Failed to execute query {query}. Error: {e}") from e
     return result
+
+
+def create_fts_index(connection: sqlite3.Connection, table_name: str):
+    # external content FTS5 index over title and content, the texts are not stored a second time
+    # the triggers keep it in sync with every insert, update and delete on the table
+    fts_table = f"{table_name}_fts"
+    if check_table_exists(connection, fts_table):
+        return
+
+    logger.info("Creating full-text index %s", fts_table)
+    with connection:
+        connection.execute(
+            f"CREATE VIRTUAL TABLE {fts_table} USING fts5(title, content, content='{table_name}', content_rowid='rowid', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        connection.execute(
+            f"CREATE TRIGGER {fts_table}_insert AFTER INSERT ON {table_name} BEGIN "
+            f"INSERT INTO {fts_table}(rowid, title, content) VALUES (new.rowid, new.title, new.content); END"
+        )
+        connection.execute(
+            f"CREATE TRIGGER {fts_table}_delete AFTER DELETE ON {table_name} BEGIN "
+            f"INSERT INTO {fts_table}({fts_table}, rowid, title, content) VALUES ('delete', old.rowid, old.title, old.content); END"
+        )
+        connection.execute(
+            f"CREATE TRIGGER {fts_table}_update AFTER UPDATE OF title, content ON {table_name} BEGIN "
+            f"INSERT INTO {fts_table}({fts_table}, rowid, title, content) VALUES ('delete', old.rowid, old.title, old.content); "
+            f"INSERT INTO {fts_table}(rowid, title, content) VALUES (new.rowid, new.title, new.content); END"
+        )
+        # index the rows that were written before the index existed
+        connection.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+
+def get_subset_filter(connection: sqlite3.Connection, table_name: str, subset_query: str, language: str = "") -> Tuple[str, List[str]]:
+    # SQL condition and parameters that restrict a step to the rows matching the FTS5 query and/or language
+    conditions, params = [], []
+    if subset_query:
+        create_fts_index(connection, table_name)
+        conditions.append(f"rowid IN (SELECT rowid FROM {table_name}_fts WHERE {table_name}_fts MATCH ?)")
+        params.append(subset_query)
+    if language:
+        conditions.append("language = ?")
+        params.append(language)
+    return "".join(f" AND {condition}" for condition in conditions), params
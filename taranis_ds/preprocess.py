@@ -5,19 +5,88 @@ Run pre-processing steps on raw data exported from Taranis-AI
 Save processed results to an SQLite DB
 """
 
-from pathlib import Path
+import hashlib
+import html
+import re
+from collections import defaultdict
+from functools import lru_cache
+from typing import Iterable
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import json as pa_json
 from transformers import AutoTokenizer
 
 from taranis_ds.config import Config
 from taranis_ds.log import get_logger
-from taranis_ds.misc import check_config, detect_language, save_df_to_table
-from taranis_ds.persist import check_table_exists, get_db_connection
+from taranis_ds.metrics import record_item
+from taranis_ds.misc import check_config, check_dataset_path, detect_language, is_jsonl, open_dataset, save_df_to_table
+from taranis_ds.persist import check_column_exists, check_table_exists, create_fts_index, get_db_connection, insert_column
 
 
 logger = get_logger(__name__)
 
+HTML_BLOCK_RE = re.compile(r"<(script|style|noscript|iframe)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+HTML_TAG_RE = re.compile(r"</?[a-zA-Z][^<>]*>")
+URL_RE = re.compile(r"https?://[^\s<>\"')\]]*[^\s<>\"')\].,;:!?]")
+TRACKING_PARAM_RE = re.compile(r"^(utm_[a-z]+|fbclid|gclid|mc_cid|mc_eid|_hsenc|_hsmi|ref_src)=", re.IGNORECASE)
+BOILERPLATE_LINE_RE = re.compile(
+    r"(this (web)?site uses cookies|we use cookies|accept (all )?cookies|cookie (policy|settings|preferences)"
+    r"|subscribe to (our|the) newsletter|sign up for (our|the) newsletter|all rights reserved|^\s*(©|\(c\)|copyright)\s"
+    r"|share (this|on) (article|story|facebook|twitter|x|linkedin)|follow us on|click here to|advertisement\s*$)",
+    re.IGNORECASE,
+)
+TRAILING_SPACE_RE = re.compile(r"[ \t]+$", re.MULTILINE)
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+# Arrow strings are stored in one buffer per column instead of one Python object per value
+STRING_DTYPE = pd.StringDtype("pyarrow")
+NEWS_ITEM_TYPE = pa.struct([("id", pa.string()), ("title", pa.string()), ("content", pa.string())])
+STORY_SCHEMA = pa.schema([("id", pa.string()), ("news_items", pa.list_(NEWS_ITEM_TYPE))])
+
+# lines longer than this are considered article text even if they contain a boilerplate phrase
+MAX_BOILERPLATE_LINE_WORDS = 30
+# repeated lines shorter than this (e.g. "Summary" headings) are kept
+MIN_REPEATED_LINE_LENGTH = 20
+
+
+def get_repeated_lines(texts: pd.Series, min_count: int, story_ids: Iterable[str] | None = None) -> set[str]:
+    # lines that appear in the news items of at least min_count different stories are footers, navigation, bylines, ...
+    # news items of one story often share whole paragraphs (syndicated wire copy), so a story counts only once,
+    # and lines longer than MAX_BOILERPLATE_LINE_WORDS are article text
+    line_stories = defaultdict(set)
+    for text, story_id in zip(texts, story_ids if story_ids is not None else range(len(texts))):
+        for line in {line.strip() for line in text.split("\n")}:
+            if len(line) >= MIN_REPEATED_LINE_LENGTH and len(line.split()) <= MAX_BOILERPLATE_LINE_WORDS:
+                line_stories[line].add(story_id)
+    return {line for line, stories in line_stories.items() if len(stories) >= min_count}
+
+
+def strip_tracking_params(match: re.Match) -> str:
+    url, _, fragment = match[0].partition("#")
+    base, _, query = url.partition("?")
+    params = [param for param in query.split("&") if param and not TRACKING_PARAM_RE.match(param)]
+    return base + ("?" + "&".join(params) if params else "") + ("#" + fragment if fragment else "")
+
+
+def clean_text(text: str, repeated_lines: set[str] | frozenset[str] = frozenset()) -> str:
+    text = HTML_BLOCK_RE.sub("", text)
+    text = HTML_COMMENT_RE.sub("", text)
+    text = HTML_TAG_RE.sub("", text)
+    text = html.unescape(text)
+    text = URL_RE.sub(strip_tracking_params, text)
+
+    lines = [
+        line
+        for line in text.split("\n")
+        if line.strip() not in repeated_lines and not (len(line.split()) <= MAX_BOILERPLATE_LINE_WORDS and BOILERPLATE_LINE_RE.search(line))
+    ]
+    text = TRAILING_SPACE_RE.sub("", "\n".join(lines))
+    return BLANK_LINES_RE.sub("\n\n", text).strip()
+
 
 def df_iterator(df: pd.DataFrame, bs: int):
     # yield batches of size bs from df
@@ -26,43 +95,130 @@ def df_iterator(df: pd.DataFrame, bs: int):
         yield df.iloc[i : i + bs]
 
 
-def get_tokens(df: pd.DataFrame, tokenizer_name: str) -> list:
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+@lru_cache
+def get_tokenizer(tokenizer_name: str):
+    # shared with the summary step, so chunking counts tokens the same way as preprocess
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def get_tokens(df: pd.DataFrame, tokenizer_name: str, column: str = "content") -> list:
+    tokenizer = get_tokenizer(tokenizer_name)
     token_lens = []
 
     text_iter = df_iterator(df, 32)
 
     for batch in text_iter:
-        texts = batch["content"].to_list()
+        texts = batch[column].to_list()
         tokens = tokenizer(texts)["input_ids"]
         token_lens.extend(list(map(len, tokens)))
     return token_lens
 
 
-def preprocess_taranis_dataset(ds_path: str, tokenizer_name: str, max_tokens: int | None = None) -> pd.DataFrame:
-    df = pd.read_json(ds_path)
+def explode_news_items(stories: pd.DataFrame) -> pd.DataFrame:
+    # collect id, news_item_id, title & content of the news items column by column instead of exploding the stories,
+    # NoneType and empty News items are skipped right away
+    columns = {"id": [], "news_item_id": [], "title": [], "content": []}
+    for story_id, news_items in zip(stories.get("id", []), stories.get("news_items", [])):
+        for item in news_items if isinstance(news_items, list) else []:
+            if item["content"] is None or item["content"] == "":
+                continue
+            columns["id"].append(story_id)
+            columns["news_item_id"].append(item["id"])
+            columns["title"].append(item["title"])
+            columns["content"].append(item["content"])
+    return pd.DataFrame({name: pd.Series(values, dtype=object).astype(STRING_DTYPE) for name, values in columns.items()})
 
-    df = df.explode("news_items", ignore_index=True)
 
-    # create columns for content, title & news_item_id from the news_item
-    df["content"] = df["news_items"].apply(lambda item: item["content"])
-    df["title"] = df["news_items"].apply(lambda item: item["title"])
-    df["news_item_id"] = df["news_items"].apply(lambda item: item["id"])
+def explode_news_item_batch(batch: pa.RecordBatch) -> pa.Table:
+    news_items = batch.column("news_items")
+    items = pc.list_flatten(news_items)
+    table = pa.table(
+        {
+            "id": pc.take(batch.column("id"), pc.list_parent_indices(news_items)),
+            "news_item_id": items.field("id"),
+            "title": items.field("title"),
+            "content": items.field("content"),
+        }
+    )
+    return table.filter(pc.and_kleene(pc.is_valid(table["content"]), pc.not_equal(table["content"], "")))
 
-    # remove NoneType, empty and duplicated News items
-    df = df[~df["news_items"].apply(lambda item: item["content"] is None or item["content"] == "")]
-    df = df[~df["content"].duplicated()]
 
-    df["tokens"] = get_tokens(df, tokenizer_name)
-    df["language"] = df["content"].apply(detect_language)
-    df = df[df["language"] != "err"]
+def read_taranis_dataset(ds_path: str, block_size: int = 16 * 2**20) -> pd.DataFrame:
+    # JSON Lines datasets are decompressed and parsed by Arrow block by block, only the needed fields of the news items are parsed
+    # and no Python string is created for them, the columns of the frame are backed by the Arrow buffers
+    if not is_jsonl(ds_path):
+        return explode_news_items(pd.read_json(ds_path))
+    # the JSON reader fails on a dataset without any story
+    with open_dataset(ds_path) as f:
+        if next((line for line in f if line.strip()), None) is None:
+            return explode_news_items(pd.DataFrame())
+    reader = pa_json.open_json(
+        ds_path,
+        read_options=pa_json.ReadOptions(block_size=block_size),
+        parse_options=pa_json.ParseOptions(explicit_schema=STORY_SCHEMA, unexpected_field_behavior="ignore"),
+    )
+    table = pa.concat_tables([explode_news_item_batch(batch) for batch in reader])
+    return table.to_pandas(types_mapper={pa.string(): STRING_DTYPE}.get)
+
+
+def first_occurrences(texts: Iterable[str]) -> np.ndarray:
+    # like ~Series.duplicated(), but only a digest of every text is held in memory instead of a hash table of the texts
+    seen = set()
+    mask = []
+    for text in texts:
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        mask.append(digest not in seen)
+        seen.add(digest)
+    return np.array(mask, dtype=bool)
+
+
+def process_news_items(
+    df: pd.DataFrame, tokenizer_name: str, max_tokens: int | None = None, clean: bool = False, repeated_line_min_count: int = 5
+) -> pd.DataFrame:
+    # the filters of a stage are combined into one mask, so every stage copies the frame only once
+    text_column = "content"
+    if clean:
+        # store the cleaned text alongside the original, tokens and language are computed on the cleaned text
+        repeated_lines = get_repeated_lines(df["content"], repeated_line_min_count, df["id"])
+        # a news item that consists of boilerplate only keeps its original text
+        df["clean_content"] = df["content"].map(lambda text: clean_text(text, repeated_lines) or text).astype(STRING_DTYPE)
+        df = df[first_occurrences(df["clean_content"])].reset_index(drop=True)
+        text_column = "clean_content"
+
+    df["tokens"] = get_tokens(df, tokenizer_name, text_column)
+    df["language"] = df[text_column].map(detect_language).astype(STRING_DTYPE)
+    keep = df["language"] != "err"
+
+    if clean:
+        # estimated from the character counts with the tokens per character of the cleaned text, tokenizing the raw text again
+        # would take as long as tokenizing the cleaned text
+        clean_tokens = df.loc[keep, "tokens"].sum()
+        raw_tokens = round(clean_tokens * df.loc[keep, "content"].str.len().sum() / max(df.loc[keep, "clean_content"].str.len().sum(), 1))
+        saved_tokens = raw_tokens - clean_tokens
+        logger.info("Cleaning removed about %s of %s tokens (%.1f%%)", saved_tokens, raw_tokens, 100 * saved_tokens / max(raw_tokens, 1))
 
     if max_tokens is not None:
-        df = df[df["tokens"] <= max_tokens]
+        keep &= df["tokens"] <= max_tokens
+    df = df[keep]
 
+    if clean:
+        return df[["id", "news_item_id", "title", "content", "clean_content", "tokens", "language"]]
     return df[["id", "news_item_id", "title", "content", "tokens", "language"]]
 
 
+def preprocess_taranis_dataset(
+    ds_path: str,
+    tokenizer_name: str,
+    max_tokens: int | None = None,
+    clean: bool = False,
+    repeated_line_min_count: int = 5,
+    block_size: int = 16 * 2**20,
+) -> pd.DataFrame:
+    df = read_taranis_dataset(ds_path, block_size)
+    df = df[first_occurrences(df["content"])].reset_index(drop=True)
+    return process_news_items(df, tokenizer_name, max_tokens, clean, repeated_line_min_count)
+
+
 def run():
     logger.info("Running preprocess step")
     for conf_name, conf_type in [("TARANIS_DATASET_PATH", str), ("PREPROCESS_TOKENIZER", str), ("CYBERSEC_CLASS_ENDPOINT", str)]:
@@ -70,28 +226,40 @@ def run():
             logger.error("Skipping preprocess step")
             return
 
-    if not Path(Config.TARANIS_DATASET_PATH).exists():
-        logger.error("%s does not exist", Config.TARANIS_DATASET_PATH)
-        return
-
-    if not Config.TARANIS_DATASET_PATH.endswith(".json"):
-        logger.error("%s must be in .json format")
+    if not check_dataset_path(Config.TARANIS_DATASET_PATH, exists=True):
         return
 
     if not check_config("PREPROCESS_MAX_TOKENS", int, required=False):
         logger.info("Config PREPROCESS_MAX_TOKENS was not set. Imposing no limit on maximum news item length")
 
     connection = get_db_connection(Config.DB_PATH, "results")
-    df = preprocess_taranis_dataset(Config.TARANIS_DATASET_PATH, Config.PREPROCESS_TOKENIZER, Config.PREPROCESS_MAX_TOKENS)
+    df = preprocess_taranis_dataset(
+        Config.TARANIS_DATASET_PATH,
+        Config.PREPROCESS_TOKENIZER,
+        Config.PREPROCESS_MAX_TOKENS,
+        Config.PREPROCESS_CLEAN_CONTENT,
+        Config.PREPROCESS_REPEATED_LINE_MIN_COUNT,
+        Config.PREPROCESS_BLOCK_SIZE,
+    )
+    record_item("OK", len(df))
     logger.info("Saving preprocessed data to %s", Config.DB_PATH)
 
     if check_table_exists(connection, "results"):
         logger.info("Table %s already exists, update it with new entries", "results")
-        written_rows = save_df_to_table(df, connection)
+        if "clean_content" in df.columns and not check_column_exists(connection, "results", "clean_content"):
+            insert_column(connection, "results", "clean_content", "TEXT")
+        try:
+            written_rows = save_df_to_table(df, connection)
+        except RuntimeError as e:
+            logger.error(e)
+            connection.close()
+            return
         logger.info("%s rows written to %s", written_rows, "results")
     else:
         logger.info("Creating new table %s", "results")
         df.to_sql("results", connection, index=False)
+    if Config.FTS_INDEX:
+        create_fts_index(connection, "results")
     connection.close()
 
 
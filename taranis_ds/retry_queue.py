@@ -0,0 +1,107 @@
+"""
+retry_queue.py
+
+Persistent queue of news items whose LLM request failed, retried later in the same run with exponential backoff
+while the remaining items keep flowing, and moved to DEAD_LETTER after too many attempts
+"""
+
+import sqlite3
+import time
+from typing import Iterator
+
+from taranis_ds.config import Config
+from taranis_ds.log import get_logger
+from taranis_ds.metrics import metrics
+
+
+logger = get_logger(__name__)
+
+RETRYABLE_STATUSES = ("ERROR", "TOO_MANY_REQUESTS")
+DEAD_LETTER = "DEAD_LETTER"
+
+
+class RetryQueue:
+    def __init__(self, connection: sqlite3.Connection, step: str, max_attempts: int = 5, base_delay: float = 5.0, max_delay: float = 120.0):
+        self.connection = connection
+        self.step = step
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # wall clock, the next_eligible timestamps are kept across runs
+        self.clock = time.time
+        self.sleep = time.sleep
+
+        # news items of this run that wait for their next attempt with the time they are eligible again
+        self._waiting: dict[str, tuple[float, dict]] = {}
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS retry_queue(step TEXT, item_id TEXT, attempts INTEGER, next_eligible REAL, last_status TEXT, "
+                "PRIMARY KEY (step, item_id))"
+            )
+
+    def _get_entry(self, item_id: str) -> tuple[int, float] | None:
+        return self.connection.execute(
+            "SELECT attempts, next_eligible FROM retry_queue WHERE step = ? AND item_id = ?", (self.step, item_id)
+        ).fetchone()
+
+    def delay(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+
+    def update(self, item_id: str, row: dict, status: str) -> str:
+        # returns the status to save for the item, DEAD_LETTER once it failed max_attempts times
+        if status not in RETRYABLE_STATUSES:
+            with self.connection:
+                self.connection.execute("DELETE FROM retry_queue WHERE step = ? AND item_id = ?", (self.step, item_id))
+            return status
+
+        attempts = (entry[0] if (entry := self._get_entry(item_id)) else 0) + 1
+        if attempts >= self.max_attempts:
+            logger.warning("News item %s failed %s times with %s, giving up", item_id, attempts, status)
+            metrics.inc("taranis_ds_dead_letter_items_total", step=self.step)
+            with self.connection:
+                self.connection.execute("DELETE FROM retry_queue WHERE step = ? AND item_id = ?", (self.step, item_id))
+            return DEAD_LETTER
+
+        next_eligible = self.clock() + self.delay(attempts)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO retry_queue (step, item_id, attempts, next_eligible, last_status) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (step, item_id) DO UPDATE SET attempts = excluded.attempts, next_eligible = excluded.next_eligible, "
+                "last_status = excluded.last_status",
+                (self.step, item_id, attempts, next_eligible, status),
+            )
+        self._waiting[item_id] = (next_eligible, row)
+        metrics.inc("taranis_ds_retry_queue_items_total", step=self.step, status=status)
+        return status
+
+    def _pop_due(self) -> list[dict]:
+        now = self.clock()
+        due = [item_id for item_id, (next_eligible, _) in self._waiting.items() if next_eligible <= now]
+        return [self._waiting.pop(item_id)[1] for item_id in due]
+
+    def iter_items(self, items: list[dict], id_column: str = "news_item_id") -> Iterator[dict]:
+        # fresh items keep flowing, a failed item is retried between them as soon as its backoff expired
+        # items whose backoff from an earlier run has not expired yet wait like the ones that failed in this run
+        for row in items:
+            yield from self._pop_due()
+            item_id = str(row[id_column])
+            if (entry := self._get_entry(item_id)) and entry[1] > self.clock():
+                self._waiting[item_id] = (entry[1], row)
+                continue
+            yield row
+
+        # only retries are left, wait for the next one to become due
+        while self._waiting:
+            if due := self._pop_due():
+                yield from due
+                continue
+            next_eligible = min(next_eligible for next_eligible, _ in self._waiting.values())
+            logger.info("Waiting %.1fs for %s news items to retry", next_eligible - self.clock(), len(self._waiting))
+            self.sleep(max(next_eligible - self.clock(), 0))
+
+
+def create_retry_queue(connection: sqlite3.Connection, step: str) -> RetryQueue | None:
+    if not Config.RETRY_QUEUE:
+        return None
+    return RetryQueue(connection, step, Config.RETRY_MAX_ATTEMPTS, Config.RETRY_BASE_DELAY, Config.RETRY_MAX_DELAY)
@@ -0,0 +1,161 @@
+"""
+scheduler.py
+
+Pace LLM requests so they stay within tokens-per-minute and requests-per-minute budgets
+"""
+
+import time
+from collections import deque
+
+from taranis_ds.log import get_logger
+
+
+logger = get_logger(__name__)
+
+WINDOW = 60.0
+MAX_BACKOFF = 10.0
+
+
+def estimate_tokens(text: str) -> int:
+    # rough estimate of ~4 characters per token, used where no tokenizer count is available
+    return len(text) // 4 + 1
+
+
+class TokenBudgetScheduler:
+    def __init__(
+        self,
+        tokens_per_minute: int = 0,
+        requests_per_minute: int = 0,
+        min_wait: float = 0.0,
+        prompt_overhead: int = 0,
+        completion_tokens: int = 0,
+    ):
+        # a budget of 0 means no limit
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.min_wait = min_wait
+        self.prompt_overhead = prompt_overhead
+        self.completion_tokens = completion_tokens
+
+        self.clock = time.monotonic
+        self.sleep = time.sleep
+
+        self._window: deque[tuple[float, int]] = deque()
+        self._window_tokens = 0
+        self._last_request: float | None = None
+        self._attempt = 0
+        self._cooldown_count = 0
+
+    def request_cost(self, item: dict) -> int:
+        tokens = item.get("tokens") or estimate_tokens(item.get("content") or "")
+        return int(tokens) + self.prompt_overhead + self.completion_tokens
+
+    def order(self, items: list[dict]) -> list[dict]:
+        # bin items into one-minute windows, each filled with the largest remaining item topped up with the smallest ones,
+        # so every window uses as much of the token budget as possible without exceeding it
+        if not self.tokens_per_minute or len(items) < 2:
+            return list(items)
+
+        by_cost = sorted(items, key=self.request_cost, reverse=True)
+        max_requests = self.requests_per_minute or len(items)
+        ordered = []
+        lo, hi = 0, len(by_cost) - 1
+        while lo <= hi:
+            budget = self.tokens_per_minute - self.request_cost(by_cost[lo])
+            ordered.append(by_cost[lo])
+            lo += 1
+            requests = 1
+            while lo <= hi and requests < max_requests and self.request_cost(by_cost[hi]) <= budget:
+                budget -= self.request_cost(by_cost[hi])
+                ordered.append(by_cost[hi])
+                hi -= 1
+                requests += 1
+        return ordered
+
+    def estimate(self, items: list[dict]) -> dict:
+        requests = len(items)
+        prompt_tokens = sum(self.request_cost(item) - self.completion_tokens for item in items)
+        completion_tokens = requests * self.completion_tokens
+        total_tokens = prompt_tokens + completion_tokens
+
+        seconds = requests * self.min_wait
+        if self.tokens_per_minute:
+            seconds = max(seconds, total_tokens / self.tokens_per_minute * WINDOW)
+        if self.requests_per_minute:
+            seconds = max(seconds, requests / self.requests_per_minute * WINDOW)
+
+        return {
+            "requests": requests,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "estimated_seconds": round(seconds, 1),
+        }
+
+    def log_estimate(self, items: list[dict], step_name: str):
+        estimate = self.estimate(items)
+        logger.info(
+            "DRY RUN %s: %s requests, %s prompt tokens, %s completion tokens (max), %s total tokens, estimated duration %s s",
+            step_name,
+            estimate["requests"],
+            estimate["prompt_tokens"],
+            estimate["completion_tokens"],
+            estimate["total_tokens"],
+            estimate["estimated_seconds"],
+        )
+        return estimate
+
+    def _interval(self) -> float:
+        return min(MAX_BACKOFF, max(self.min_wait, self.min_wait * (2**self._attempt)))
+
+    def _expire(self, now: float):
+        while self._window and now - self._window[0][0] >= WINDOW:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _time_until_allowed(self, cost: int, now: float) -> float:
+        wait = 0.0
+        if self._last_request is not None:
+            wait = self._last_request + self._interval() - now
+
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            wait = max(wait, self._window[0][0] + WINDOW - now)
+
+        if self.tokens_per_minute and self._window:
+            # free the oldest requests until the new one fits; a single request above the budget is sent into an empty window
+            excess = self._window_tokens + cost - self.tokens_per_minute
+            for timestamp, tokens in self._window:
+                if excess <= 0:
+                    break
+                excess -= tokens
+                wait = max(wait, timestamp + WINDOW - now)
+        return wait
+
+    def wait(self, item: dict):
+        cost = self.request_cost(item)
+        while True:
+            now = self.clock()
+            self._expire(now)
+            wait = self._time_until_allowed(cost, now)
+            if wait <= 0:
+                break
+            logger.debug("Waiting %s s before next request", round(wait, 3))
+            self.sleep(wait)
+
+        self._last_request = now
+        self._window.append((now, cost))
+        self._window_tokens += cost
+
+    def report(self, status: str):
+        # back off exponentially on rate limiting and recover after 5 requests without it
+        if status == "TOO_MANY_REQUESTS":
+            logger.error("Got TOO_MANY_REQUESTS response. Continuing to next item and increasing the wait time.")
+            self._attempt += 1
+            self._cooldown_count = 0
+            return
+
+        self._cooldown_count += 1
+        if self._cooldown_count == 5:
+            self._cooldown_count = 0
+            if self._attempt > 0:
+                self._attempt -= 1
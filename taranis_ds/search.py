@@ -0,0 +1,60 @@
+"""
+search.py
+
+Full-text search over the results table with the FTS5 index, e.g. to build targeted datasets
+"""
+
+import json
+import sqlite3
+from pathlib import Path
+
+from taranis_ds.config import Config
+from taranis_ds.log import get_logger
+from taranis_ds.misc import check_config
+from taranis_ds.persist import create_fts_index, run_query
+
+
+logger = get_logger(__name__)
+
+
+def search_results(connection: sqlite3.Connection, query: str, language: str = "", limit: int = 0) -> list[dict]:
+    # best matches first, with the matching part of the content as snippet
+    create_fts_index(connection, "results")
+    conditions, params = ["results_fts MATCH ?"], [query]
+    if language:
+        conditions.append("results.language = ?")
+        params.append(language)
+    rows = run_query(
+        connection,
+        "SELECT results.id, results.news_item_id, results.title, results.language, snippet(results_fts, 1, '[', ']', '...', 16) "
+        f"FROM results_fts JOIN results ON results.rowid = results_fts.rowid WHERE {' AND '.join(conditions)} ORDER BY rank LIMIT ?",
+        [*params, limit or -1],
+    )
+    return [{"id": row[0], "news_item_id": row[1], "title": row[2], "language": row[3], "snippet": row[4]} for row in rows]
+
+
+def run():
+    if not check_config("SUBSET_QUERY", str):
+        logger.error("Skipping search")
+        return
+
+    if not Path(Config.DB_PATH).exists():
+        logger.error("%s does not exist", Config.DB_PATH)
+        return
+
+    connection = sqlite3.Connection(Config.DB_PATH)
+    try:
+        matches = search_results(connection, Config.SUBSET_QUERY, Config.SUBSET_LANGUAGE, Config.SEARCH_LIMIT)
+    except RuntimeError as e:
+        logger.error(e)
+        return
+    finally:
+        connection.close()
+
+    logger.info("%s news items match %s", len(matches), Config.SUBSET_QUERY)
+    for match in matches:
+        print(json.dumps(match, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    run()
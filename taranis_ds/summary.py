@@ -4,26 +4,37 @@ summary.py
 Automatically create summaries for news items from an LLM
 """
 
+import re
 import sqlite3
-import time
-from typing import Dict, List
+from typing import Callable, Dict, List
 
-import torch
 from langchain.globals import set_debug
-from langchain.output_parsers import RetryWithErrorOutputParser
 from langchain.prompts import PromptTemplate
 from langchain.schema import OutputParserException
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.output_parsers import BaseOutputParser
-from langchain_mistralai import ChatMistralAI
+from langchain_core.output_parsers import BaseOutputParser, StrOutputParser
+from langchain_core.runnables.base import RunnableSequence
 from pydantic import Field
-from sentence_transformers import SentenceTransformer
 
 from taranis_ds.config import Config
-from taranis_ds.llm_tools import create_chain, prompt_model_with_retry
+from taranis_ds.embeddings import cosine_similarity, get_embedding_model
+from taranis_ds.endpoint_pool import create_chat_model, get_endpoints
+from taranis_ds.llm_tools import RepairingOutputParser, create_chain, create_retry_parser, prompt_model_with_retry, strip_formatting
 from taranis_ds.log import get_logger
+from taranis_ds.metrics import MetricsCallbackHandler, record_item
 from taranis_ds.misc import check_config, convert_language, detect_language
-from taranis_ds.persist import check_column_exists, get_db_connection, insert_column, run_query, update_row
+from taranis_ds.persist import (
+    check_column_exists,
+    get_content_column,
+    get_db_connection,
+    get_subset_filter,
+    insert_column,
+    run_query,
+    update_row,
+)
+from taranis_ds.preprocess import get_tokenizer
+from taranis_ds.retry_queue import RetryQueue, create_retry_queue
+from taranis_ds.scheduler import TokenBudgetScheduler, estimate_tokens
 
 
 logger = get_logger(__name__)
@@ -34,6 +45,19 @@ SUMMARY_PROMPT_TEMPLATE = (
     "Your response must contain only the summary, no other words, headings or tags."
 )
 
+CHUNK_SUMMARY_PROMPT_TEMPLATE = (
+    "Please write me a summary of the following part of a longer text:\n{text}. Your response must be in {language}. \n"
+    "Your response must not be longer than {max_words} words. "
+    "Your response must contain only the summary, no other words, headings or tags."
+)
+
+SUMMARY_PREFIX_RE = re.compile(
+    r"^(here is (the|a|your) summary( of the text)?|summary|zusammenfassung|résumé|resumen|riassunto|samenvatting)\s*:\s*", re.IGNORECASE
+)
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+# words of a streamed summary after which its language is checked
+LANGUAGE_CHECK_MIN_WORDS = 12
+
 
 class SummaryParser(BaseOutputParser):
     desired_lang: str = Field(default="", description="Desired summary language")
@@ -54,15 +78,103 @@ class SummaryParser(BaseOutputParser):
 
         return text
 
+    def create_abort_check(self) -> Callable[[str], bool]:
+        # check for a streamed summary: abort once it is too long, or in the wrong language after LANGUAGE_CHECK_MIN_WORDS words
+        # the language is only detected once per completion, langdetect is too slow to run on every token
+        language_checked = False
+
+        def should_abort(text: str) -> bool:
+            nonlocal language_checked
+            word_count = len(text.split(" "))
+            if word_count > self.max_words * 1.5:
+                return True
+            if not language_checked and word_count >= LANGUAGE_CHECK_MIN_WORDS:
+                language_checked = True
+                language = detect_language(strip_formatting(SUMMARY_PREFIX_RE.sub("", strip_formatting(text))))
+                return language not in (self.desired_lang, "err")
+            return False
+
+        return should_abort
+
+    def repair(self, text: str) -> str:
+        text = strip_formatting(SUMMARY_PREFIX_RE.sub("", strip_formatting(text)))
+        if len(text.split(" ")) <= self.max_words * 1.5:
+            return text
+
+        # trim a summary that is too long at the last sentence boundary within the limit
+        trimmed = ""
+        for sentence in SENTENCE_END_RE.split(text):
+            candidate = f"{trimmed} {sentence}" if trimmed else sentence
+            if len(candidate.split(" ")) > self.max_words * 1.5:
+                break
+            trimmed = candidate
+        return trimmed or text
+
 
 def assess_summary_quality(original_text: str, summary_text: str) -> float:
     # assess the quality of the summary by calculating the similarity of its embeddings
     # with the embeddings of the full text
+    embedding_model = get_embedding_model(Config.SUMMARY_QUALITY_BACKEND, cache_dir=Config.SUMMARY_QUALITY_CACHE_DIR)
+    return cosine_similarity(embedding_model, original_text, summary_text)
+
+
+def split_into_chunks(text: str, tokenizer, chunk_tokens: int) -> list[str]:
+    # pack paragraphs into chunks of at most chunk_tokens tokens
+    # paragraphs that are longer than that on their own are split on token boundaries
+    paragraphs = [paragraph for paragraph in text.split("\n") if paragraph.strip()]
+    if not paragraphs:
+        return []
+    paragraph_ids = tokenizer(paragraphs, add_special_tokens=False)["input_ids"]
+
+    chunks = []
+    current, current_len = [], 0
+    for paragraph, ids in zip(paragraphs, paragraph_ids):
+        if current and current_len + len(ids) > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, current_len = [], 0
+
+        if len(ids) > chunk_tokens:
+            chunks.extend(tokenizer.decode(ids[i : i + chunk_tokens]) for i in range(0, len(ids), chunk_tokens))
+            continue
+
+        current.append(paragraph)
+        current_len += len(ids)
+
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
 
-    embedding_model = SentenceTransformer("sentence-transformers/xlm-r-100langs-bert-base-nli-stsb-mean-tokens")
-    ref_embedding = torch.tensor(embedding_model.encode(original_text)).squeeze(0)
-    summary_embedding = torch.tensor(embedding_model.encode(summary_text)).squeeze(0)
-    return torch.nn.CosineSimilarity(dim=0)(ref_embedding, summary_embedding).item()
+def summarize_long_text(
+    chat_model: BaseChatModel,
+    chain: RunnableSequence,
+    text: str,
+    prompt_lang: str,
+    tokenizer,
+    chunk_tokens: int,
+    max_length: int,
+    max_concurrency: int,
+    max_retries: int = 3,
+) -> tuple[str, str]:
+    # map: summarize all chunks in parallel, reduce: summarize the concatenated chunk summaries with the regular chain
+    chunks = split_into_chunks(text, tokenizer, chunk_tokens)
+    logger.info("Summarizing %s chunks of at most %s tokens", len(chunks), chunk_tokens)
+
+    chunk_prompt = PromptTemplate(
+        template=CHUNK_SUMMARY_PROMPT_TEMPLATE, input_variables=["text", "language"], partial_variables={"max_words": max_length}
+    )
+    chunk_chain = chunk_prompt | chat_model | StrOutputParser()
+    chunk_summaries = chunk_chain.batch(
+        [{"text": chunk, "language": prompt_lang} for chunk in chunks],
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True,
+    )
+
+    if errors := [e for e in chunk_summaries if isinstance(e, Exception)]:
+        logger.error("Could not summarize %s of %s chunks. Error: %s", len(errors), len(chunks), errors[0])
+        return "", "TOO_MANY_REQUESTS" if any("429" in str(e) for e in errors) else "ERROR"
+
+    return prompt_model_with_retry(chain, {"text": "\n".join(chunk_summaries), "language": prompt_lang}, max_retries)
 
 
 def create_summaries_for_news_items(
@@ -73,83 +185,110 @@ def create_summaries_for_news_items(
     quality_threshold: float,
     min_wait: float,
     debug: bool = False,
+    scheduler: TokenBudgetScheduler | None = None,
+    long_doc_threshold: int = 0,
+    tokenizer_name: str = "",
+    chunk_tokens: int = 2000,
+    chunk_concurrency: int = 4,
+    streaming: bool = False,
+    retry_queue: RetryQueue | None = None,
 ):
     if debug:
         set_debug(True)
 
+    scheduler = scheduler or TokenBudgetScheduler(min_wait=min_wait)
     summary_parser = SummaryParser(max_words=max_length)
-    retry_parser = RetryWithErrorOutputParser.from_llm(parser=summary_parser, llm=chat_model, max_retries=3)
+    repairing_parser = RepairingOutputParser(parser=summary_parser)
+    retry_parser = create_retry_parser(repairing_parser, chat_model, max_retries=3)
 
     prompt = PromptTemplate(
         template=SUMMARY_PROMPT_TEMPLATE, input_variables=["text", "language"], partial_variables={"max_words": max_length}
     )
 
-    attempt = 0
-    cooldown_count = 0
-
-    for i, row in enumerate(news_items):
+    # with a retry queue a failed news item is retried later instead of blocking the others
+    max_retries = 1 if retry_queue else 3
+    items = retry_queue.iter_items(scheduler.order(news_items)) if retry_queue else scheduler.order(news_items)
+    for i, row in enumerate(items):
         logger.info("Creating summary for news item %s/%s", i + 1, len(news_items))
+        scheduler.wait(row)
         prompt_lang = convert_language(row["language"])
-        retry_parser.parser.desired_lang = row["language"]
-        chain = create_chain(chat_model, prompt, retry_parser)
-
-        summary, status = prompt_model_with_retry(chain, {"text": row["content"], "language": prompt_lang})
-
-        if status == "TOO_MANY_REQUESTS":
-            logger.error("Got TOO_MANY_REQUESTS response. Continuing to next item and increasing the wait time.")
-            attempt += 1
-            cooldown_count = 0
-
-        if summary and assess_summary_quality(row["content"], summary) < quality_threshold:
+        summary_parser.desired_lang = row["language"]
+        chain = create_chain(chat_model, prompt, retry_parser, summary_parser.create_abort_check if streaming else None)
+
+        if long_doc_threshold and (row.get("tokens") or 0) > long_doc_threshold:
+            summary, status = summarize_long_text(
+                chat_model,
+                chain,
+                row["content"],
+                prompt_lang,
+                get_tokenizer(tokenizer_name),
+                chunk_tokens,
+                max_length,
+                chunk_concurrency,
+                max_retries,
+            )
+        else:
+            summary, status = prompt_model_with_retry(chain, {"text": row["content"], "language": prompt_lang}, max_retries)
+        scheduler.report(status)
+        if retry_queue:
+            status = retry_queue.update(str(row["news_item_id"]), row, status)
+
+        if summary and quality_threshold > 0 and assess_summary_quality(row["content"], summary) < quality_threshold:
             status = "LOW_QUALITY"
 
         logger.info("STATUS: %s", status)
+        record_item(status)
         try:
-            update_row(connection, "results", row["id"], ["summary", "summary_status"], [summary, status])
+            update_row(connection, "results", row["news_item_id"], ["summary", "summary_status"], [summary, status], "news_item_id")
         except RuntimeError as e:
             logger.error(e)
 
-        sleep_time = min(10.0, max(min_wait, min_wait * (2**attempt)))
-        logger.debug("Waiting %s s before next request", sleep_time)
-        time.sleep(sleep_time)
-        cooldown_count += 1
-        if cooldown_count == 5:
-            cooldown_count = 0
-            if attempt > 0:
-                attempt -= 1
-
+    repairing_parser.log_stats()
     set_debug(False)
 
 
 def run():
     logger.info("Running summary step")
-    for conf_name, conf_type in [("SUMMARY_MODEL", str), ("SUMMARY_API_KEY", str), ("SUMMARY_ENDPOINT", str), ("SUMMARY_MAX_LENGTH", int)]:
+    for conf_name, conf_type in [("SUMMARY_MODEL", str), ("SUMMARY_MAX_LENGTH", int)]:
         if not check_config(conf_name, conf_type):
             logger.error("Skipping summary step")
             return
+    if not (endpoints := get_endpoints("SUMMARY")):
+        logger.error("Skipping summary step")
+        return
 
-    connection = get_db_connection(Config.DB_PATH, init=True)
+    connection = get_db_connection(Config.DB_PATH, "results")
 
     for col in ["summary", "summary_status"]:
         if not check_column_exists(connection, "results", col):
             insert_column(connection, "results", col, "TEXT")
-            return
     try:
+        subset_filter, params = get_subset_filter(connection, "results", Config.SUBSET_QUERY, Config.SUBSET_LANGUAGE)
         query_result = run_query(
             connection,
-            "SELECT id, content, language FROM results WHERE summary_status IS NOT 'OK'",
+            f"SELECT id, news_item_id, {get_content_column(connection, 'results')}, language, tokens FROM results "
+            f"WHERE (summary_status IS NULL OR summary_status NOT IN ('OK', 'DEAD_LETTER')){subset_filter}",
+            params,
         )
     except RuntimeError as e:
         logger.error(e)
         return
     logger.info("Creating summaries for %s news items", len(query_result))
-    news_items = [{"id": row[0], "content": row[1], "language": row[2]} for row in query_result]
+    news_items = [{"id": row[0], "news_item_id": row[1], "content": row[2], "language": row[3], "tokens": row[4]} for row in query_result]
+
+    scheduler = TokenBudgetScheduler(
+        tokens_per_minute=Config.SUMMARY_TOKENS_PER_MINUTE,
+        requests_per_minute=Config.SUMMARY_REQUESTS_PER_MINUTE,
+        min_wait=Config.SUMMARY_MIN_WAIT_TIME,
+        prompt_overhead=estimate_tokens(SUMMARY_PROMPT_TEMPLATE),
+        completion_tokens=Config.SUMMARY_MAX_LENGTH * 2,
+    )
+    if Config.DRY_RUN:
+        scheduler.log_estimate(news_items, "summary")
+        return
 
-    chat_model = ChatMistralAI(
-        model=Config.SUMMARY_MODEL,
-        api_key=Config.SUMMARY_API_KEY,
-        endpoint=Config.SUMMARY_ENDPOINT,
-        max_tokens=Config.SUMMARY_MAX_LENGTH * 2,
+    chat_model = create_chat_model(
+        Config.SUMMARY_MODEL, endpoints, callbacks=[MetricsCallbackHandler()], max_tokens=Config.SUMMARY_MAX_LENGTH * 2
     )
 
     create_summaries_for_news_items(
@@ -158,8 +297,15 @@ def run():
         connection,
         Config.SUMMARY_MAX_LENGTH,
         Config.SUMMARY_QUALITY_THRESHOLD,
-        Config.SUMMARY_REQUEST_WAIT_TIME,
+        Config.SUMMARY_MIN_WAIT_TIME,
         Config.DEBUG,
+        scheduler,
+        Config.SUMMARY_LONG_DOC_THRESHOLD,
+        Config.PREPROCESS_TOKENIZER,
+        Config.SUMMARY_CHUNK_TOKENS,
+        Config.SUMMARY_CHUNK_CONCURRENCY,
+        Config.SUMMARY_STREAMING,
+        create_retry_queue(connection, "summary"),
     )
 
 
@@ -0,0 +1,233 @@
+"""
+summary_cybersec_class.py
+
+Create summaries and classify news items in Cybersecurity/Non-Cybersecurity with a single LLM request per news item
+"""
+
+import json
+import re
+import sqlite3
+from typing import Dict, List
+
+from langchain.globals import set_debug
+from langchain.prompts import PromptTemplate
+from langchain.schema import OutputParserException
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.output_parsers import BaseOutputParser
+from pydantic import Field
+
+from taranis_ds.config import Config
+from taranis_ds.cybersec_class import CategoryOutputParser
+from taranis_ds.endpoint_pool import create_chat_model, get_endpoints
+from taranis_ds.llm_tools import RepairingOutputParser, create_chain, create_retry_parser, prompt_model_with_retry, strip_formatting
+from taranis_ds.log import get_logger
+from taranis_ds.metrics import MetricsCallbackHandler, record_item
+from taranis_ds.misc import check_config, convert_language
+from taranis_ds.persist import (
+    check_column_exists,
+    get_content_column,
+    get_db_connection,
+    get_subset_filter,
+    insert_column,
+    run_query,
+    update_row,
+)
+from taranis_ds.retry_queue import RetryQueue, create_retry_queue
+from taranis_ds.scheduler import TokenBudgetScheduler, estimate_tokens
+from taranis_ds.summary import SummaryParser, assess_summary_quality
+
+
+logger = get_logger(__name__)
+
+
+SUMMARY_CYBERSEC_CLASS_PROMPT_TEMPLATE = (
+    "Please do two things with the following text:\n"
+    "1. Write a summary of the text. The summary must be in {language} and must not be longer than {max_words} words.\n"
+    "2. Classify the text into one of two categories: 'cybersecurity' or 'non-cybersecurity'.\n"
+    'Respond only with a JSON object of the form {{"summary": "<summary>", "category": "<category>"}}. '
+    "Do not use any formatting, do not include anything other than this JSON object.\n"
+    "Text: {text}"
+)
+
+RESULT_COLUMNS = ["summary", "summary_status", "cybersecurity", "cybersecurity_status"]
+# results with these statuses are kept, e.g. from the separate summary or cybersecurity classification step
+FINAL_STATUSES = ("OK", "PROPAGATED", "DEAD_LETTER")
+
+
+class SummaryCategoryParser(BaseOutputParser):
+    desired_lang: str = Field(default="", description="Desired summary language")
+    max_words: int = Field(default=None, description="Desired summary length in words")
+
+    def parse(self, text: str):
+        if not (match := re.search(r"\{.*\}", text, re.DOTALL)):
+            raise OutputParserException(f"Invalid output: {text}. The output should be a JSON object with the keys 'summary' and 'category'")
+
+        try:
+            answer = json.loads(match[0])
+        except json.JSONDecodeError as e:
+            raise OutputParserException(f"Invalid JSON in output: {e}") from e
+
+        if not isinstance(answer, dict) or not isinstance(answer.get("summary"), str) or not isinstance(answer.get("category"), str):
+            raise OutputParserException("The JSON object must contain the string keys 'summary' and 'category'")
+
+        summary = SummaryParser(desired_lang=self.desired_lang, max_words=self.max_words).parse(answer["summary"])
+        category = CategoryOutputParser().parse(answer["category"])
+        return {"summary": summary, "category": category}
+
+    def repair(self, text: str) -> str:
+        # extract the values even from broken JSON (e.g. unescaped quotes in the summary) and repair them individually
+        text = strip_formatting(text).replace("“", '"').replace("”", '"')
+        summary = re.search(r'"summary"\s*:\s*"(.*?)"\s*[,}]', text, re.DOTALL)
+        category = re.search(r'"category"\s*:\s*"(.*?)"\s*[,}]', text, re.DOTALL)
+        if not summary or not category:
+            return text
+
+        return json.dumps(
+            {
+                "summary": SummaryParser(desired_lang=self.desired_lang, max_words=self.max_words).repair(summary[1]),
+                "category": CategoryOutputParser().repair(category[1]),
+            },
+            ensure_ascii=False,
+        )
+
+
+def summarize_and_classify_news_items(
+    chat_model: BaseChatModel,
+    news_items: List[Dict],
+    connection: sqlite3.Connection,
+    max_length: int,
+    quality_threshold: float,
+    min_wait: float,
+    debug: bool = False,
+    scheduler: TokenBudgetScheduler | None = None,
+    retry_queue: RetryQueue | None = None,
+):
+    if debug:
+        set_debug(True)
+
+    scheduler = scheduler or TokenBudgetScheduler(min_wait=min_wait)
+    combined_parser = SummaryCategoryParser(max_words=max_length)
+    repairing_parser = RepairingOutputParser(parser=combined_parser)
+    retry_parser = create_retry_parser(repairing_parser, chat_model, max_retries=3)
+
+    prompt = PromptTemplate(
+        template=SUMMARY_CYBERSEC_CLASS_PROMPT_TEMPLATE, input_variables=["text", "language"], partial_variables={"max_words": max_length}
+    )
+
+    # with a retry queue a failed news item is retried later instead of blocking the others
+    max_retries = 1 if retry_queue else 3
+    items = retry_queue.iter_items(scheduler.order(news_items)) if retry_queue else scheduler.order(news_items)
+    for i, row in enumerate(items):
+        logger.info("Creating summary and classifying news item %s/%s", i + 1, len(news_items))
+        scheduler.wait(row)
+        prompt_lang = convert_language(row["language"])
+        combined_parser.desired_lang = row["language"]
+        chain = create_chain(chat_model, prompt, retry_parser)
+
+        result, status = prompt_model_with_retry(chain, {"text": row["content"], "language": prompt_lang}, max_retries)
+        scheduler.report(status)
+        if retry_queue:
+            status = retry_queue.update(str(row["news_item_id"]), row, status)
+
+        summary, category = (result["summary"], result["category"]) if result else ("", "")
+        summary_status = category_status = status
+
+        if summary and quality_threshold > 0 and assess_summary_quality(row["content"], summary) < quality_threshold:
+            summary_status = "LOW_QUALITY"
+
+        logger.info("STATUS: summary %s, cybersecurity %s", summary_status, category_status)
+        record_item(summary_status if summary_status != "OK" else category_status)
+        # only the missing results are written, a failed request must not replace a summary or label that is already done
+        columns, values = [], []
+        if row.get("summary_status") not in FINAL_STATUSES:
+            columns += ["summary", "summary_status"]
+            values += [summary, summary_status]
+        if row.get("cybersecurity_status") not in FINAL_STATUSES:
+            columns += ["cybersecurity", "cybersecurity_status"]
+            values += [category, category_status]
+        try:
+            update_row(connection, "results", row["news_item_id"], columns, values, "news_item_id")
+        except RuntimeError as e:
+            logger.error(e)
+
+    repairing_parser.log_stats()
+    set_debug(False)
+
+
+def run():
+    logger.info("Running combined summary and cybersecurity classification step")
+    for conf_name, conf_type in [("SUMMARY_CYBERSEC_CLASS_MODEL", str), ("SUMMARY_MAX_LENGTH", int)]:
+        if not check_config(conf_name, conf_type):
+            logger.error("Skipping combined summary and cybersecurity classification step")
+            return
+    if not (endpoints := get_endpoints("SUMMARY_CYBERSEC_CLASS")):
+        logger.error("Skipping combined summary and cybersecurity classification step")
+        return
+
+    connection = get_db_connection(Config.DB_PATH, "results")
+
+    for col in RESULT_COLUMNS:
+        if not check_column_exists(connection, "results", col):
+            insert_column(connection, "results", col, "TEXT")
+    try:
+        subset_filter, params = get_subset_filter(connection, "results", Config.SUBSET_QUERY, Config.SUBSET_LANGUAGE)
+        query_result = run_query(
+            connection,
+            f"SELECT id, news_item_id, {get_content_column(connection, 'results')}, language, tokens, summary_status, cybersecurity_status "
+            "FROM results WHERE (summary_status IS NULL OR summary_status NOT IN ('OK', 'PROPAGATED', 'DEAD_LETTER') "
+            f"OR cybersecurity_status IS NULL OR cybersecurity_status NOT IN ('OK', 'PROPAGATED', 'DEAD_LETTER')){subset_filter}",
+            params,
+        )
+    except RuntimeError as e:
+        logger.error(e)
+        return
+    logger.info("Creating summaries and classifying %s news items", len(query_result))
+    news_items = [
+        {
+            "id": row[0],
+            "news_item_id": row[1],
+            "content": row[2],
+            "language": row[3],
+            "tokens": row[4],
+            "summary_status": row[5],
+            "cybersecurity_status": row[6],
+        }
+        for row in query_result
+    ]
+
+    # the completion contains the summary and the label wrapped in JSON
+    max_tokens = Config.SUMMARY_MAX_LENGTH * 2 + 30
+    scheduler = TokenBudgetScheduler(
+        tokens_per_minute=Config.SUMMARY_CYBERSEC_CLASS_TOKENS_PER_MINUTE,
+        requests_per_minute=Config.SUMMARY_CYBERSEC_CLASS_REQUESTS_PER_MINUTE,
+        min_wait=Config.SUMMARY_CYBERSEC_CLASS_MIN_WAIT_TIME,
+        prompt_overhead=estimate_tokens(SUMMARY_CYBERSEC_CLASS_PROMPT_TEMPLATE),
+        completion_tokens=max_tokens,
+    )
+    if Config.DRY_RUN:
+        scheduler.log_estimate(news_items, "combined summary and cybersecurity classification")
+        return
+
+    chat_model = create_chat_model(
+        Config.SUMMARY_CYBERSEC_CLASS_MODEL,
+        endpoints,
+        callbacks=[MetricsCallbackHandler()],
+        temperature=Config.SUMMARY_CYBERSEC_CLASS_TEMPERATURE,
+        max_tokens=max_tokens,
+    )
+
+    summarize_and_classify_news_items(
+        chat_model,
+        news_items,
+        connection,
+        Config.SUMMARY_MAX_LENGTH,
+        Config.SUMMARY_QUALITY_THRESHOLD,
+        Config.SUMMARY_CYBERSEC_CLASS_MIN_WAIT_TIME,
+        Config.DEBUG,
+        scheduler,
+        create_retry_queue(connection, "summary_cybersec_class"),
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -4,6 +4,7 @@ import json
 import pandas as pd
 from dotenv import load_dotenv
 import sqlite3
+from taranis_ds import preprocess
 from .testdata import REF_NEWS_ITEM_DE, REF_NEWS_ITEM_EN
 
 
@@ -29,6 +30,16 @@ def test_db_path():
 def tokenizer():
     yield os.getenv("PREPROCESS_TOKENIZER")
 
+@pytest.fixture(scope="function")
+def word_tokenizer(monkeypatch):
+    # splits on whitespace instead of downloading a tokenizer from the Hugging Face Hub
+    class WordTokenizer:
+        def __call__(self, texts):
+            return {"input_ids": [text.split() for text in texts]}
+
+    monkeypatch.setattr(preprocess, "get_tokenizer", lambda tokenizer_name: WordTokenizer())
+    yield "words"
+
 @pytest.fixture(scope="session")
 def taranis_dataset_json(taranis_dataset_path):
     yield json.loads(taranis_dataset_path)
@@ -49,7 +60,7 @@ def test_db(test_db_path):
 @pytest.fixture(scope="function")
 def results_db(results_db_path):
     conn = sqlite3.Connection(results_db_path)
-    conn.execute("CREATE TABLE results(id TEXT PRIMARY KEY, news_item_id TEXT, title TEXT, content TEXT, tokens INTEGER, language TEXT, summary TEXT, summary_status TEXT)")
+    conn.execute("CREATE TABLE results(id TEXT, news_item_id TEXT PRIMARY KEY, title TEXT, content TEXT, tokens INTEGER, language TEXT, summary TEXT, summary_status TEXT)")
     conn.execute(f"INSERT INTO results (id, news_item_id, title, content, tokens, language) VALUES ('1', '1', 'German News', '{REF_NEWS_ITEM_DE}', 501, 'de')")
     conn.execute(f"INSERT INTO results (id, news_item_id, title, content, tokens, language) VALUES ('2', '2', 'English News', '{REF_NEWS_ITEM_EN}', 500, 'en')")
     yield conn
@@ -0,0 +1,149 @@
+import random
+import sqlite3
+import pandas as pd
+from taranis_ds import cybersec_class, preprocess
+from taranis_ds.misc import save_df_to_table
+from taranis_ds.persist import get_db_connection, insert_column
+from taranis_ds.retry_queue import RetryQueue
+from unittest.mock import patch, Mock
+from langchain.chat_models.base import BaseChatModel
+
+
+def test_process_answer():
+    assert cybersec_class.process_answer("cybersecurity") == "cybersecurity"
+    assert cybersec_class.process_answer("The text is about Non-Cyber Security") is None
+    assert cybersec_class.process_answer("'non-cybersecurity'") == "non-cybersecurity"
+    assert cybersec_class.process_answer("sports") is None
+
+
+def test_select_propagation_items():
+    stories = cybersec_class.group_by_story([
+        {"id": "s1", "news_item_id": "1", "tokens": 300},
+        {"id": "s2", "news_item_id": "2", "tokens": 100},
+        {"id": "s1", "news_item_id": "3", "tokens": 10},
+        {"id": "s1", "news_item_id": "4", "tokens": 200},
+    ])
+    assert [[row["news_item_id"] for row in story] for story in stories] == [["1", "3", "4"], ["2"]]
+
+    representatives, samples = cybersec_class.select_propagation_items(stories, 0.0, random.Random(0))
+    assert [row["news_item_id"] for row in representatives] == ["4", "2"]
+    assert samples == []
+
+    representatives, samples = cybersec_class.select_propagation_items(stories, 1.0, random.Random(0))
+    assert len(samples) == 1
+    assert samples[0]["news_item_id"] in {"1", "3"}
+
+
+@patch("taranis_ds.cybersec_class.prompt_model_with_retry")
+def test_classify_news_item_cybersecurity_propagate(mock_llm_response, tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT, tokens INTEGER, cybersecurity TEXT, cybersecurity_status TEXT)")
+    news_items = [
+        {"id": "s1", "news_item_id": "1", "content": "a", "language": "en", "tokens": 1},
+        {"id": "s1", "news_item_id": "2", "content": "b", "language": "en", "tokens": 2},
+        {"id": "s1", "news_item_id": "3", "content": "c", "language": "en", "tokens": 3},
+        {"id": "s2", "news_item_id": "4", "content": "d", "language": "en", "tokens": 4},
+        {"id": "s2", "news_item_id": "5", "content": "e", "language": "en", "tokens": 5},
+    ]
+    with connection:
+        connection.executemany(
+            "INSERT INTO results (id, news_item_id, content, tokens) VALUES (?, ?, ?, ?)",
+            [(row["id"], row["news_item_id"], row["content"], row["tokens"]) for row in news_items],
+        )
+
+    chat_model = Mock(spec=BaseChatModel)
+    mock_llm_response.side_effect = lambda chain, inputs, max_retries=3: ("cybersecurity", "OK") if inputs["text"] != "d" else ("", "ERROR")
+
+    stats = cybersec_class.classify_news_item_cybersecurity(chat_model, news_items, connection, 0.0, propagate=True, sample_rate=1.0, rng=random.Random(1))
+
+    # one representative and one sampled sibling per story
+    assert mock_llm_response.call_count == 4
+    assert stats == {"classified": 4, "propagated": 1, "sampled": 1, "agreeing": 1}
+
+    saved_results = dict(
+        (row[0], (row[1], row[2])) for row in connection.execute("SELECT news_item_id, cybersecurity, cybersecurity_status FROM results")
+    )
+    assert saved_results["2"] == ("cybersecurity", "OK")
+    assert sorted(status for _, status in [saved_results["1"], saved_results["3"]]) == ["OK", "PROPAGATED"]
+    # the representative of story s2 failed, so no label is propagated and its sample is not counted
+    assert saved_results["4"] == ("", "ERROR")
+    assert saved_results["5"] == ("cybersecurity", "OK")
+    connection.close()
+
+
+
+@patch("taranis_ds.cybersec_class.prompt_model_with_retry")
+def test_classify_preprocessed_news_items_propagate(mock_llm_response, tmp_path, word_tokenizer):
+    # the news items of a story share the story id, all of them are saved and receive the story label
+    df = pd.DataFrame({
+        "id": ["s1", "s1", "s1", "s2"],
+        "news_item_id": ["1", "2", "3", "4"],
+        "title": ["Ransomware attack", "Ransomware attack", "Ransomware attack", "Football results"],
+        "content": [
+            "A ransomware group encrypted the servers of the city administration.",
+            "The city administration was hit by a ransomware attack on Monday.",
+            "Hackers demand a ransom after the attack on the city administration.",
+            "The home team won the football match against the visitors on Sunday.",
+        ],
+    }).astype(preprocess.STRING_DTYPE)
+    df = preprocess.process_news_items(df, word_tokenizer)
+
+    connection = get_db_connection(str(tmp_path / "results.db"), "results")
+    assert save_df_to_table(df, connection) == 4
+    for col in ["cybersecurity", "cybersecurity_status"]:
+        insert_column(connection, "results", col, "TEXT")
+    news_items = [
+        {"id": row[0], "news_item_id": row[1], "content": row[2], "language": row[3], "tokens": row[4]}
+        for row in connection.execute("SELECT id, news_item_id, content, language, tokens FROM results")
+    ]
+
+    chat_model = Mock(spec=BaseChatModel)
+    mock_llm_response.side_effect = lambda chain, inputs, max_retries=3: (
+        ("cybersecurity", "OK") if "ransom" in inputs["text"] else ("non-cybersecurity", "OK")
+    )
+    stats = cybersec_class.classify_news_item_cybersecurity(chat_model, news_items, connection, 0.0, propagate=True, sample_rate=0.0)
+
+    assert mock_llm_response.call_count == 2
+    assert stats["propagated"] == 2
+    saved_results = dict((row[0], (row[1], row[2])) for row in connection.execute("SELECT news_item_id, cybersecurity, cybersecurity_status FROM results"))
+    assert [saved_results[news_item_id][0] for news_item_id in "123"] == ["cybersecurity"] * 3
+    assert sorted(saved_results[news_item_id][1] for news_item_id in "123") == ["OK", "PROPAGATED", "PROPAGATED"]
+    assert saved_results["4"] == ("non-cybersecurity", "OK")
+    connection.close()
+
+
+def test_category_output_parser_repair():
+    parser = cybersec_class.CategoryOutputParser()
+    assert parser.parse(parser.repair("**Cyber Security**")) == "cybersecurity"
+    assert parser.parse(parser.repair("Category: non cyber-security")) == "non-cybersecurity"
+    assert parser.repair("sports") == "sports"
+
+
+@patch("taranis_ds.cybersec_class.prompt_model_with_retry")
+def test_classify_news_item_cybersecurity_retry_queue(mock_llm_response, tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT, tokens INTEGER, cybersecurity TEXT, cybersecurity_status TEXT)")
+    news_items = [{"id": f"s{i}", "news_item_id": str(i), "content": text, "language": "en", "tokens": 1} for i, text in enumerate("abc")]
+    with connection:
+        connection.executemany(
+            "INSERT INTO results (id, news_item_id, content, tokens) VALUES (?, ?, ?, ?)",
+            [(row["id"], row["news_item_id"], row["content"], row["tokens"]) for row in news_items],
+        )
+
+    retry_queue = RetryQueue(connection, "cybersec_class", max_attempts=2, base_delay=10.0)
+    waited = []
+    retry_queue.clock = lambda: sum(waited)
+    retry_queue.sleep = waited.append
+    # "a" is rate limited once, "b" always fails
+    responses = {"a": [("", "TOO_MANY_REQUESTS"), ("cybersecurity", "OK")], "b": [("", "ERROR"), ("", "ERROR")], "c": [("non-cybersecurity", "OK")]}
+    mock_llm_response.side_effect = lambda chain, inputs, max_retries=3: responses[inputs["text"]].pop(0)
+
+    cybersec_class.classify_news_item_cybersecurity(Mock(spec=BaseChatModel), news_items, connection, 0.0, retry_queue=retry_queue)
+
+    # every request is sent without inline retries, the failed news items after the fresh ones
+    assert [call.args[1]["text"] for call in mock_llm_response.call_args_list] == ["a", "b", "c", "a", "b"]
+    assert all(call.args[2] == 1 for call in mock_llm_response.call_args_list)
+    assert waited == [10.0]
+    saved_results = dict((row[0], row[1]) for row in connection.execute("SELECT news_item_id, cybersecurity_status FROM results"))
+    assert saved_results == {"0": "OK", "1": "DEAD_LETTER", "2": "OK"}
+    connection.close()
@@ -0,0 +1,37 @@
+import pytest
+import torch
+from taranis_ds import embeddings
+
+
+class FakeEmbeddingModel:
+    def encode(self, texts, convert_to_tensor=False):
+        return torch.tensor([[len(text), 1.0] for text in texts])
+
+
+def test_quantize_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(32, 32), torch.nn.ReLU(), torch.nn.Linear(32, 4))
+    quantized = embeddings.quantize_model(model)
+    assert isinstance(model[0], torch.nn.Linear)  # the original model is left untouched
+    assert not isinstance(quantized[0], torch.nn.Linear)
+
+    inputs = torch.randn(8, 32)
+    assert torch.allclose(model(inputs), quantized(inputs), atol=0.05)
+
+
+def test_get_embedding_model_invalid_backend():
+    with pytest.raises(ValueError):
+        embeddings.get_embedding_model("fp16")
+
+
+def test_backend_available(monkeypatch):
+    assert embeddings.backend_available("int8")
+    monkeypatch.setattr(embeddings.importlib.util, "find_spec", lambda name: None)
+    assert not embeddings.backend_available("onnx")
+    assert embeddings.backend_available("torch")
+
+
+def test_cosine_similarity():
+    model = FakeEmbeddingModel()
+    assert embeddings.cosine_similarity(model, "abc", "abc") == pytest.approx(1.0)
+    assert embeddings.cosine_similarity(model, "a", "abcdefgh") < 0.9
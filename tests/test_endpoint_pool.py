@@ -0,0 +1,109 @@
+import socket
+from collections import Counter
+from langchain_core.messages import HumanMessage
+from langchain_mistralai import ChatMistralAI
+from benchmarks.stub_server import StubLLMServer
+from taranis_ds.endpoint_pool import CircuitBreaker, PooledChatModel, create_chat_model, get_endpoints
+from taranis_ds.config import Config
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def create_pool(servers, weights=None, clock=None):
+    models = [ChatMistralAI(model="stub", api_key="stub", endpoint=server.url, max_tokens=10) for server in servers]
+    return PooledChatModel(models=models, weights=weights or [], failure_threshold=2, reset_timeout=30.0, clock=clock or FakeClock())
+
+
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10.0, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    clock.now = 10.0
+    assert breaker.allow() and breaker.state == "half-open"
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now = 20.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+    breaker.record_failure(rate_limited=True)
+    assert breaker.state == "open"
+
+
+def test_pool_spreads_by_weight():
+    with StubLLMServer(latency_median=0.0, seed=0) as first, StubLLMServer(latency_median=0.0, seed=1) as second:
+        pool = create_pool([first, second], weights=[3.0, 1.0])
+        for _ in range(20):
+            pool.invoke([HumanMessage("classify the following text:\nText: malware")])
+        assert (first.stats["requests"], second.stats["requests"]) == (15, 5)
+
+
+def test_pool_fails_over_and_recovers():
+    clock = FakeClock()
+    with (
+        StubLLMServer(latency_median=0.0, rate_limit_rate=1.0, seed=0) as limited,
+        StubLLMServer(latency_median=0.0, error_rate=1.0, seed=1) as failing,
+        StubLLMServer(latency_median=0.0, seed=2) as healthy,
+    ):
+        pool = create_pool([limited, failing, healthy], clock=clock)
+        answers = [pool.invoke([HumanMessage("classify the following text:\nText: phishing")]).content for _ in range(10)]
+        assert answers == ["cybersecurity"] * 10
+        # the 429 endpoint is skipped after its first answer, the failing one after failure_threshold errors
+        assert limited.stats["requests"] == 1
+        assert failing.stats["requests"] == 2
+        assert healthy.stats["requests"] == 10
+        assert Counter(endpoint.breaker.state for endpoint in pool._endpoints) == Counter({"open": 2, "closed": 1})
+
+        # after the reset timeout the recovered endpoint gets a trial request and its share of the traffic again
+        limited.rate_limit_rate = 0.0
+        clock.now = 30.0
+        for _ in range(4):
+            pool.invoke([HumanMessage("classify the following text:\nText: phishing")])
+        assert pool._endpoints[0].breaker.state == "closed"
+        # trial request, then the recovered and the healthy endpoint take turns, the failing one fails its trial
+        assert limited.stats["requests"] == 4
+        assert failing.stats["requests"] == 3
+        assert healthy.stats["requests"] == 11
+
+
+def test_pool_fails_over_from_closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        closed_url = f"http://127.0.0.1:{sock.getsockname()[1]}/v1"
+
+    with StubLLMServer(latency_median=0.0, seed=0) as healthy:
+        pool = create_chat_model("stub", [(closed_url, "stub", 1.0), (healthy.url, "stub", 1.0)], max_tokens=10)
+        # the pool fails over right away instead of the client retrying the connection with backoff
+        assert all(endpoint.model.max_retries == 1 for endpoint in pool._endpoints)
+        answers = [pool.invoke([HumanMessage("classify the following text:\nText: phishing")]).content for _ in range(3)]
+        assert answers == ["cybersecurity"] * 3
+        assert healthy.stats["requests"] == 3
+        assert pool._endpoints[0].breaker.state == "open"
+
+
+def test_get_endpoints(monkeypatch):
+    monkeypatch.setattr(Config, "SUMMARY_ENDPOINT", "http://single/v1")
+    monkeypatch.setattr(Config, "SUMMARY_API_KEY", "key")
+    assert get_endpoints("SUMMARY") == [("http://single/v1", "key", 1.0)]
+
+    monkeypatch.setattr(Config, "SUMMARY_ENDPOINTS", ["http://a/v1", "http://b/v1"])
+    assert get_endpoints("SUMMARY") == [("http://a/v1", "key", 1.0), ("http://b/v1", "key", 1.0)]
+
+    monkeypatch.setattr(Config, "SUMMARY_API_KEYS", ["key_a", "key_b"])
+    monkeypatch.setattr(Config, "SUMMARY_ENDPOINT_WEIGHTS", [2.0, 1.0])
+    assert get_endpoints("SUMMARY") == [("http://a/v1", "key_a", 2.0), ("http://b/v1", "key_b", 1.0)]
+
+    monkeypatch.setattr(Config, "SUMMARY_ENDPOINT_WEIGHTS", [1.0])
+    assert get_endpoints("SUMMARY") == []
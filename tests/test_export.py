@@ -0,0 +1,66 @@
+import sqlite3
+import pyarrow.dataset as ds
+import pytest
+from taranis_ds import export
+
+
+@pytest.fixture
+def export_db(tmp_path):
+    db_path = str(tmp_path / "results.db")
+    connection = sqlite3.Connection(db_path)
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT PRIMARY KEY, content TEXT, tokens INTEGER, language TEXT, summary_status TEXT)")
+    rows = [(str(i), str(i), f"Text {i}", i * 10, "de" if i % 3 == 0 else "en", "OK" if i % 2 else None) for i in range(25)]
+    with connection:
+        connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)", rows)
+    connection.close()
+    yield db_path
+
+
+def test_get_arrow_schema(export_db):
+    connection = sqlite3.Connection(export_db)
+    schema = export.get_arrow_schema(connection, "results")
+    connection.close()
+    assert schema.names == ["id", "news_item_id", "content", "tokens", "language", "summary_status"]
+    assert str(schema.field("tokens").type) == "int64"
+    assert str(schema.field("content").type) == "string"
+
+
+@pytest.mark.parametrize("export_format", ["parquet", "arrow"])
+def test_export_results(export_db, tmp_path, export_format):
+    output_path = tmp_path / "export"
+    assert export.export_results(export_db, str(output_path), export_format=export_format, partition_by="language", batch_size=4) == 25
+    assert sorted(path.name for path in output_path.iterdir()) == [export.EXPORT_MARKER, "language=de", "language=en"]
+
+    table = export.read_export(str(output_path), export_format)
+    assert table.num_rows == 25
+    assert sorted(table.column("tokens").to_pylist()) == [i * 10 for i in range(25)]
+
+    german = export.read_export(str(output_path), export_format, columns=["id"], filter=ds.field("language") == "de")
+    assert sorted(german.column("id").to_pylist(), key=int) == [str(i) for i in range(0, 25, 3)]
+
+    # a second export replaces the files of the first one
+    assert export.export_results(export_db, str(output_path), export_format=export_format, partition_by="language") == 25
+    assert export.read_export(str(output_path), export_format).num_rows == 25
+
+
+def test_export_results_invalid_partition(export_db, tmp_path):
+    with pytest.raises(ValueError):
+        export.export_results(export_db, str(tmp_path / "export"), partition_by="cybersecurity")
+
+
+def test_export_results_keeps_unrelated_files(export_db, tmp_path):
+    # a directory that does not hold an earlier export is never emptied
+    (tmp_path / "important.txt").write_text("keep")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "y.txt").write_text("keep")
+    with pytest.raises(RuntimeError):
+        export.export_results(export_db, str(tmp_path))
+    assert (tmp_path / "important.txt").read_text() == "keep"
+    assert (tmp_path / "sub" / "y.txt").read_text() == "keep"
+
+    # only the export directory is replaced, its siblings survive
+    output_path = tmp_path / "export"
+    export.export_results(export_db, str(output_path))
+    export.export_results(export_db, str(output_path), partition_by="language")
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["export", "important.txt", "results.db", "sub"]
+    assert export.read_export(str(output_path)).num_rows == 25
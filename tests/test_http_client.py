@@ -0,0 +1,24 @@
+from langchain_core.messages import HumanMessage
+from benchmarks.stub_server import StubLLMServer
+from taranis_ds import http_client
+from taranis_ds.endpoint_pool import create_chat_model
+
+
+def test_llm_clients_share_connections():
+    with StubLLMServer(latency_median=0.0, seed=0) as server:
+        # two models of different steps/API keys on the same host use one pooled connection
+        first = create_chat_model("stub", [(server.url, "key_a", 1.0)], max_tokens=10)
+        second = create_chat_model("stub", [(server.url, "key_b", 1.0)], max_tokens=10)
+        for _ in range(3):
+            first.invoke([HumanMessage("classify the following text:\nText: malware")])
+            second.invoke([HumanMessage("classify the following text:\nText: weather")])
+        assert server.stats["requests"] == 6
+        assert server.stats["connections"] == 1
+        assert first.client.headers["Authorization"] == "Bearer key_a"
+        assert second.client.headers["Authorization"] == "Bearer key_b"
+
+
+def test_get_session():
+    session = http_client.get_session()
+    assert session is http_client.get_session()
+    assert session.get_adapter("https://taranis.example")._pool_maxsize == http_client.Config.HTTP_MAX_CONNECTIONS
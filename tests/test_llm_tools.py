@@ -1,5 +1,17 @@
+import asyncio
+import time
 import httpx
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.prompt_values import StringPromptValue
 from taranis_ds import llm_tools
+from taranis_ds.metrics import metrics
 from unittest.mock import patch, MagicMock
 
 
@@ -29,3 +41,140 @@ def test_prompt_model_with_retry(mock_create_chain):
     assert mock_chain.invoke.call_count == 5
     assert output == ""
     assert status == "TOO_MANY_REQUESTS"
+
+
+def test_strip_formatting():
+    assert llm_tools.strip_formatting(' "Some text" ') == "Some text"
+    assert llm_tools.strip_formatting("**Some** text") == "Some text"
+    assert llm_tools.strip_formatting("```json\n{\"a\": 1}\n```") == '{"a": 1}'
+    assert llm_tools.strip_formatting("# Summary\nSome text") == "Some text"
+
+
+def test_repairing_output_parser():
+    class UpperCaseParser(BaseOutputParser):
+        def parse(self, text: str):
+            if not text.isupper():
+                raise OutputParserException("Not upper case")
+            return text
+
+        def repair(self, text: str) -> str:
+            return text.upper()
+
+    parser = llm_tools.RepairingOutputParser(parser=UpperCaseParser())
+    assert parser.parse("VALID") == "VALID"
+    assert parser.parse("repairable") == "REPAIRABLE"
+    with pytest.raises(OutputParserException):
+        parser.parse("123")
+    assert parser.stats == {"parsed": 1, "repaired": 1, "escalated": 0}
+
+    # only the rejections that are sent back to the LLM are counted, not the final one
+    llm = FakeListChatModel(responses=["456", "789"])
+    retry_parser = llm_tools.create_retry_parser(parser, llm, max_retries=1)
+    with pytest.raises(OutputParserException):
+        retry_parser.parse_with_prompt("123", StringPromptValue(text="Answer in upper case"))
+    assert llm.i == 1
+    assert parser.stats == {"parsed": 1, "repaired": 1, "escalated": 1}
+
+
+class ScriptedChatModel(BaseChatModel):
+    # answers after the given delays, one per request
+    delays: list = []
+    cancelled: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delays.pop(0)
+        time.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=f"answer after {delay}"))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=f"answer after {delay}"))])
+
+
+def create_hedged_model(delays, **kwargs):
+    hedged_model = llm_tools.HedgedChatModel(model=ScriptedChatModel(delays=delays), min_samples=5, max_hedge_ratio=0.5, **kwargs)
+    for _ in range(5):
+        hedged_model.tracker.record(0.01)
+    return hedged_model
+
+
+def test_latency_tracker():
+    tracker = llm_tools.LatencyTracker(window=10, min_samples=3)
+    tracker.record(1.0)
+    assert tracker.percentile(0.95) is None
+    for latency in [2.0, 3.0, 4.0]:
+        tracker.record(latency)
+    assert tracker.percentile(0.5) == 2.5
+    for _ in range(10):
+        tracker.record(0.5)
+    assert tracker.percentile(0.99) == 0.5
+
+
+def test_hedged_chat_model():
+    # the first request hangs, the duplicate sent after p95 answers first
+    hedged_model = create_hedged_model([1.0, 0.0], min_timeout=0.5)
+    start = time.perf_counter()
+    assert hedged_model.invoke("question").content == "answer after 0.0"
+    assert time.perf_counter() - start < 0.5
+
+    # no answer within the adaptive timeout (p99 * 3, at least min_timeout)
+    hedged_model = create_hedged_model([1.0, 1.0], min_timeout=0.1)
+    assert hedged_model.get_timeout() == 0.1
+    with pytest.raises(httpx.TimeoutException):
+        hedged_model.invoke("question")
+
+
+def test_hedged_chat_model_async_cancels_loser():
+    hedged_model = create_hedged_model([1.0, 0.0], min_timeout=0.5)
+    assert asyncio.run(hedged_model.ainvoke("question")).content == "answer after 0.0"
+    assert hedged_model.model.cancelled == 1
+
+
+class StreamingScriptedChatModel(BaseChatModel):
+    # streams ten chunks per request, the given delay apart
+    delays: list = []
+    closed: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-streaming"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delays.pop(0)
+        try:
+            for i in range(10):
+                time.sleep(delay)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=f"{delay} "))
+        finally:
+            self.closed += 1
+
+
+def test_hedged_chat_model_stops_loser():
+    metrics.reset()
+    hedged_model = llm_tools.HedgedChatModel(model=StreamingScriptedChatModel(delays=[0.1, 0.0]), min_samples=5, max_hedge_ratio=0.5, min_timeout=2.0)
+    for _ in range(5):
+        hedged_model.tracker.record(0.01)
+    assert hedged_model.invoke("question").content == "0.0 " * 10
+
+    # the primary request stops at its next chunk instead of streaming all ten
+    time.sleep(0.3)
+    assert hedged_model.model.closed == 2
+    assert metrics.total("taranis_ds_llm_abandoned_requests_total", reason="lost") == 1
+    assert hedged_model._abandoned == 0
+
+    # no duplicates while too many abandoned requests are running
+    hedged_model = create_hedged_model([0.2], min_timeout=0.5, max_abandoned=0)
+    assert hedged_model.invoke("question").content == "answer after 0.2"
+    assert metrics.total("taranis_ds_llm_skipped_hedges_total") == 1
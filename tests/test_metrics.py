@@ -0,0 +1,62 @@
+import json
+import sqlite3
+from langchain_mistralai import ChatMistralAI
+from benchmarks.stub_server import StubLLMServer
+from taranis_ds import cybersec_class
+from taranis_ds.metrics import Histogram, MetricsCallbackHandler, MetricsRegistry, metrics, stage_metrics
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in [0.5, 0.5, 1.5, 3.0]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 0]
+    assert histogram.quantile(0.5) == 1.0
+    assert 2.0 < histogram.quantile(0.95) <= 4.0
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_metrics_registry(tmp_path):
+    registry = MetricsRegistry()
+    registry.inc("items_total", stage="summary", status="OK")
+    registry.inc("items_total", 2, stage="summary", status="ERROR")
+    registry.set("stage_seconds", 1.5, stage="summary")
+    registry.observe("request_seconds", 0.3, stage="summary")
+
+    assert registry.total("items_total", stage="summary") == 3
+    assert registry.total("items_total", status="ERROR") == 2
+
+    text = registry.to_prometheus()
+    assert "# TYPE items_total counter" in text
+    assert 'items_total{stage="summary",status="ERROR"} 2' in text
+    assert 'request_seconds_bucket{stage="summary",le="0.5"} 1' in text
+    assert 'request_seconds_count{stage="summary"} 1' in text
+
+    registry.write(str(tmp_path / "metrics.json"))
+    report = json.loads((tmp_path / "metrics.json").read_text())
+    assert report["gauges"]["stage_seconds"] == [{"labels": {"stage": "summary"}, "value": 1.5}]
+    registry.write(str(tmp_path / "metrics.prom"))
+    assert (tmp_path / "metrics.prom").read_text() == text
+
+
+def test_stage_metrics_with_stub_server(tmp_path):
+    metrics.reset()
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT, cybersecurity TEXT, cybersecurity_status TEXT)")
+    news_items = [{"id": str(i), "news_item_id": str(i), "content": f"Ransomware attack number {i}", "language": "en"} for i in range(3)]
+    with connection:
+        connection.executemany("INSERT INTO results (id, news_item_id, content) VALUES (?, ?, ?)", [(r["id"], r["news_item_id"], r["content"]) for r in news_items])
+
+    with StubLLMServer(latency_median=0.0, seed=0) as server, stage_metrics("cybersec_class", profile=True, profile_dir=str(tmp_path / "profiles")):
+        chat_model = ChatMistralAI(model="stub", api_key="stub", endpoint=server.url, max_tokens=10, callbacks=[MetricsCallbackHandler()])
+        cybersec_class.classify_news_item_cybersecurity(chat_model, news_items, connection, 0.0)
+    connection.close()
+
+    assert metrics.total("taranis_ds_items_total", stage="cybersec_class", status="OK") == 3
+    assert metrics.total("taranis_ds_llm_requests_total", stage="cybersec_class", status="OK") == 3
+    assert metrics.total("taranis_ds_llm_prompt_tokens_total", stage="cybersec_class") > 0
+    assert metrics.total("taranis_ds_llm_completion_tokens_total", stage="cybersec_class") > 0
+    assert metrics.histograms["taranis_ds_llm_request_seconds"][(("stage", "cybersec_class"),)].count == 3
+    assert metrics.gauges["taranis_ds_stage_items_per_second"][(("stage", "cybersec_class"),)] > 0
+    assert {path.name for path in (tmp_path / "profiles").iterdir()} == {"cybersec_class.prof", "cybersec_class_cpu.txt", "cybersec_class_memory.txt"}
+    metrics.reset()
@@ -1,7 +1,9 @@
 import logging
 import pandas as pd
 from taranis_ds.config import Config
-from taranis_ds.misc import save_df_to_table, check_config, convert_language
+from taranis_ds.persist import get_db_connection
+import pytest
+from taranis_ds.misc import save_df_to_table, check_config, check_dataset_path, convert_language, open_dataset, write_stories
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +16,19 @@ def test_save_df_to_table(test_db):
     assert save_df_to_table(df, test_db) == 3
     assert save_df_to_table(df, test_db) == 0
 
+
+def test_save_df_to_table_news_items(tmp_path):
+    connection = get_db_connection(str(tmp_path / "results.db"), "results")
+    df = pd.DataFrame([{"id": "s1", "news_item_id": "1", "title": "a", "content": "a", "tokens": 1, "language": "en"},
+                       {"id": "s1", "news_item_id": "2", "title": "b", "content": "b", "tokens": 1, "language": "en"},
+                       ])
+    # all news items of a story are saved, each only once
+    assert save_df_to_table(df, connection) == 2
+    assert save_df_to_table(df, connection) == 0
+    df.loc[2] = ["s1", "3", "c", "c", 1, "en"]
+    assert save_df_to_table(df, connection) == 1
+    connection.close()
+
 def test_check_config():
     assert check_config("PREPROCESS_MAX_TOKENS", int)
     assert check_config("DB_PATH", str)
@@ -26,3 +41,25 @@ def test_convert_language():
     assert convert_language("de") == "german"
     assert convert_language("en") == "english"
     assert convert_language("ru") == "russian"
+
+
+def test_check_dataset_path(tmp_path):
+    existing = tmp_path / "stories.jsonl.gz"
+    existing.touch()
+    assert check_dataset_path(str(existing), exists=True)
+    assert not check_dataset_path(str(existing), exists=False)
+    assert not check_dataset_path(str(tmp_path / "missing.json"), exists=True)
+    assert check_dataset_path(str(tmp_path / "new.jsonl.zst"), exists=False)
+    assert not check_dataset_path(str(tmp_path / "new.csv"), exists=False)
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".jsonl.gz", ".jsonl.zst"])
+def test_write_stories(tmp_path, suffix):
+    stories = [{"id": str(i), "news_items": [{"id": str(i), "title": "Title", "content": "Text ü"}]} for i in range(3)]
+    path = str(tmp_path / f"stories{suffix}")
+    write_stories(stories, path)
+    assert [p.name for p in tmp_path.iterdir()] == [f"stories{suffix}"]
+    with open_dataset(path) as f:
+        written = f.read()
+    assert (written.count("\n") == 3) == (suffix != ".json")
+    assert pd.read_json(path, lines=suffix != ".json")["id"].astype(str).to_list() == ["0", "1", "2"]
@@ -46,4 +46,29 @@ def test_run_query(test_db):
         test_db.execute("INSERT INTO results (id, col1, col2) VALUES (1, 'test', 55)")
     result = persist.run_query(test_db, "SELECT * FROM results")
     assert isinstance(result, list)
-    assert result[0] == (1, "test", 55)
\ No newline at end of file
+    assert result[0] == (1, "test", 55)
+    assert persist.run_query(test_db, "SELECT col1 FROM results WHERE col2 > ?", [50]) == [("test",)]
+
+
+def test_create_fts_index(results_db):
+    # rows written before the index exists are indexed on creation, later changes through the triggers
+    persist.create_fts_index(results_db, "results")
+    assert persist.check_table_exists(results_db, "results_fts")
+    match_query = "SELECT rowid FROM results_fts WHERE results_fts MATCH ?"
+    assert len(persist.run_query(results_db, match_query, ["dementia"])) == 1
+
+    with results_db:
+        results_db.execute("INSERT INTO results (id, news_item_id, title, content) VALUES ('3', '3', 'Ransomware', 'A new strain')")
+        results_db.execute("UPDATE results SET content = 'Nothing about care' WHERE id = '2'")
+    assert len(persist.run_query(results_db, match_query, ["ransomware"])) == 1
+    assert persist.run_query(results_db, match_query, ["dementia"]) == []
+    with results_db:
+        results_db.execute("DELETE FROM results WHERE id = '3'")
+    assert persist.run_query(results_db, match_query, ["ransomware"]) == []
+    persist.create_fts_index(results_db, "results")  # does nothing if the index exists
+
+
+def test_get_subset_filter(results_db):
+    assert persist.get_subset_filter(results_db, "results", "", "") == ("", [])
+    subset_filter, params = persist.get_subset_filter(results_db, "results", "trump OR dementia", "de")
+    assert persist.run_query(results_db, f"SELECT id FROM results WHERE 1{subset_filter}", params) == [("1",)]
@@ -1,4 +1,5 @@
 from taranis_ds import preprocess
+from taranis_ds.misc import write_stories
 import pandas as pd
 
 def test_get_tokens(tokenizer):
@@ -23,3 +24,71 @@ def test_preprocess_taranis_dataset(taranis_dataset_path, tokenizer):
     df = preprocess.preprocess_taranis_dataset(taranis_dataset_path, tokenizer, 300)
     assert df["tokens"].max() <= 300
 
+
+def test_clean_text():
+    text = (
+        "<html><head><style>p {color: red}</style></head><p>Attackers exploited a flaw in <b>Exchange</b> &amp; Outlook.</p>\n"
+        "Read the advisory at https://example.com/advisory?id=5&utm_source=twitter&utm_medium=social.\n"
+        "This website uses cookies to improve your experience. Accept all cookies\n\n\n\n"
+        "Subscribe to our newsletter for weekly updates!\n"
+        "Visit our partner site for more news and offers today\n"
+        "© 2025 Example Media. All rights reserved."
+    )
+    repeated_lines = {"Visit our partner site for more news and offers today"}
+    assert preprocess.clean_text(text, repeated_lines) == (
+        "Attackers exploited a flaw in Exchange & Outlook.\n"
+        "Read the advisory at https://example.com/advisory?id=5."
+    )
+    assert preprocess.clean_text("Nothing to clean here.") == "Nothing to clean here."
+
+
+def test_get_repeated_lines():
+    texts = pd.Series([
+        "First article\nRead more stories at our website",
+        "Second article\nRead more stories at our website",
+        "Third article\nShort",
+    ])
+    assert preprocess.get_repeated_lines(texts, 2) == {"Read more stories at our website"}
+    assert preprocess.get_repeated_lines(texts, 3) == set()
+
+    # news items of one story only count once
+    assert preprocess.get_repeated_lines(texts, 2, ["story", "story", "other"]) == set()
+
+
+def test_process_news_items_keeps_syndicated_copy(word_tokenizer):
+    wire_copy = (
+        "Attackers are exploiting a critical vulnerability in a widely used VPN appliance to gain access to corporate networks.\n"
+        "The vendor has released patches and urges all customers to update their devices as soon as possible."
+    )
+    df = pd.DataFrame({
+        "id": ["story"] * 5 + ["other"],
+        "news_item_id": [str(i) for i in range(6)],
+        "title": ["VPN flaw exploited"] * 6,
+        "content": [f"Outlet {i} reports\n{wire_copy}" for i in range(5)] + ["Read more stories at our website"],
+    }).astype(preprocess.STRING_DTYPE)
+
+    df = preprocess.process_news_items(df, word_tokenizer, clean=True, repeated_line_min_count=2)
+    assert len(df) == 6
+    assert all(wire_copy in text for text in df["clean_content"][:5])
+    # a news item that is boilerplate only keeps its content
+    assert df.iloc[-1]["clean_content"] == "Read more stories at our website"
+
+
+def test_read_taranis_dataset(taranis_dataset_path, tmp_path):
+    df = preprocess.read_taranis_dataset(taranis_dataset_path)
+    assert list(df.columns) == ["id", "news_item_id", "title", "content"]
+    assert all(dtype == preprocess.STRING_DTYPE for dtype in df.dtypes)
+
+    # the same stories as compressed JSON Lines, parsed in small blocks
+    stories = pd.read_json(taranis_dataset_path).to_dict(orient="records")
+    jsonl_path = str(tmp_path / "stories.jsonl.gz")
+    write_stories(stories, jsonl_path)
+    jsonl_df = preprocess.read_taranis_dataset(jsonl_path, block_size=2**14)
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), jsonl_df)
+
+    # a dataset without stories results in an empty frame with the same columns
+    for empty_path in [str(tmp_path / "empty.jsonl.gz"), str(tmp_path / "empty.json")]:
+        write_stories([], empty_path)
+        empty_df = preprocess.read_taranis_dataset(empty_path)
+        assert empty_df.empty
+        pd.testing.assert_series_equal(empty_df.dtypes, df.dtypes)
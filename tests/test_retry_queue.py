@@ -0,0 +1,65 @@
+import sqlite3
+
+from taranis_ds.retry_queue import RetryQueue
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_retry_queue(connection, **kwargs):
+    retry_queue = RetryQueue(connection, "summary", **kwargs)
+    clock = FakeClock()
+    retry_queue.clock = clock
+    retry_queue.sleep = clock.sleep
+    return retry_queue, clock
+
+
+def test_delay():
+    retry_queue = RetryQueue(sqlite3.Connection(":memory:"), "summary", base_delay=5.0, max_delay=30.0)
+    assert [retry_queue.delay(attempts) for attempts in range(1, 6)] == [5.0, 10.0, 20.0, 30.0, 30.0]
+
+
+def test_retry_later_in_the_same_run():
+    connection = sqlite3.Connection(":memory:")
+    retry_queue, clock = make_retry_queue(connection, max_attempts=3, base_delay=10.0)
+    items = [{"news_item_id": str(i)} for i in range(4)]
+    # item 0 fails until the last attempt, item 2 fails once
+    failures = {"0": ["TOO_MANY_REQUESTS", "ERROR", "ERROR"], "2": ["ERROR"]}
+
+    processed, statuses = [], {}
+    for row in retry_queue.iter_items(items):
+        processed.append((row["news_item_id"], clock.now))
+        status = failures[row["news_item_id"]].pop(0) if failures.get(row["news_item_id"]) else "OK"
+        statuses[row["news_item_id"]] = retry_queue.update(row["news_item_id"], row, status)
+        clock.now += 1
+
+    # the fresh items are not blocked by the failed ones, the retries wait for their backoff
+    assert processed == [("0", 0.0), ("1", 1.0), ("2", 2.0), ("3", 3.0), ("0", 10.0), ("2", 12.0), ("0", 30.0)]
+    assert statuses == {"0": "DEAD_LETTER", "1": "OK", "2": "OK", "3": "OK"}
+    assert connection.execute("SELECT COUNT(*) FROM retry_queue").fetchone()[0] == 0
+    connection.close()
+
+
+def test_backoff_persists_across_runs():
+    connection = sqlite3.Connection(":memory:")
+    retry_queue, clock = make_retry_queue(connection, base_delay=60.0)
+    row = {"news_item_id": "1"}
+    assert list(retry_queue.iter_items([row])) == [row]
+    assert retry_queue.update("1", row, "ERROR") == "ERROR"
+    assert connection.execute("SELECT attempts, next_eligible, last_status FROM retry_queue").fetchall() == [(1, 60.0, "ERROR")]
+
+    # a new run before the backoff expired waits for it and keeps counting the attempts
+    retry_queue, new_clock = make_retry_queue(connection, base_delay=60.0)
+    new_clock.now = 30.0
+    assert [(item["news_item_id"], new_clock.now) for item in retry_queue.iter_items([row, {"news_item_id": "2"}])] == [("2", 30.0), ("1", 60.0)]
+    retry_queue.update("1", row, "ERROR")
+    assert connection.execute("SELECT attempts, next_eligible FROM retry_queue").fetchall() == [(2, 180.0)]
+    connection.close()
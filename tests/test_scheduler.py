@@ -0,0 +1,88 @@
+from taranis_ds.scheduler import TokenBudgetScheduler, estimate_tokens
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_scheduler(**kwargs):
+    scheduler = TokenBudgetScheduler(**kwargs)
+    clock = FakeClock()
+    scheduler.clock = clock
+    scheduler.sleep = clock.sleep
+    return scheduler, clock
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 1
+    assert estimate_tokens("a" * 400) == 101
+
+
+def test_request_cost():
+    scheduler = TokenBudgetScheduler(prompt_overhead=10, completion_tokens=5)
+    assert scheduler.request_cost({"tokens": 100}) == 115
+    assert scheduler.request_cost({"content": "a" * 40}) == 26
+
+
+def test_order():
+    items = [{"id": str(i), "tokens": tokens} for i, tokens in enumerate([10, 900, 50, 500, 450, 100])]
+
+    # without a token budget the order is unchanged
+    scheduler = TokenBudgetScheduler()
+    assert scheduler.order(items) == items
+
+    scheduler = TokenBudgetScheduler(tokens_per_minute=1000)
+    ordered = scheduler.order(items)
+    assert sorted(item["id"] for item in ordered) == sorted(item["id"] for item in items)
+    assert [item["tokens"] for item in ordered] == [900, 10, 50, 500, 100, 450]
+
+
+def test_estimate():
+    items = [{"tokens": 1000}, {"tokens": 2000}, {"tokens": 3000}]
+    scheduler = TokenBudgetScheduler(tokens_per_minute=3000, prompt_overhead=100, completion_tokens=100)
+    estimate = scheduler.estimate(items)
+    assert estimate["requests"] == 3
+    assert estimate["prompt_tokens"] == 6300
+    assert estimate["completion_tokens"] == 300
+    assert estimate["total_tokens"] == 6600
+    assert estimate["estimated_seconds"] == 132.0
+
+    scheduler = TokenBudgetScheduler(requests_per_minute=1, min_wait=1.0)
+    assert scheduler.estimate(items)["estimated_seconds"] == 180.0
+
+
+def test_wait_token_budget():
+    scheduler, clock = make_scheduler(tokens_per_minute=1000)
+    scheduler.wait({"tokens": 600})
+    assert clock.now == 0.0
+    scheduler.wait({"tokens": 300})
+    assert clock.now == 0.0
+
+    # does not fit into the current window anymore
+    scheduler.wait({"tokens": 300})
+    assert clock.now == 60.0
+
+    # larger than the whole budget, sent once the window is empty
+    scheduler.wait({"tokens": 5000})
+    assert clock.now == 120.0
+
+
+def test_wait_request_budget_and_backoff():
+    scheduler, clock = make_scheduler(requests_per_minute=2, min_wait=1.0)
+    scheduler.wait({"tokens": 1})
+    scheduler.wait({"tokens": 1})
+    assert clock.now == 1.0
+    scheduler.wait({"tokens": 1})
+    assert clock.now == 60.0
+
+    scheduler.report("TOO_MANY_REQUESTS")
+    scheduler.report("TOO_MANY_REQUESTS")
+    scheduler.wait({"tokens": 1})
+    assert clock.now == 64.0
@@ -0,0 +1,14 @@
+import pytest
+from taranis_ds import search
+
+
+def test_search_results(results_db):
+    matches = search.search_results(results_db, "trump OR dementia")
+    assert sorted(match["id"] for match in matches) == ["1", "2"]
+    assert search.search_results(results_db, "dementia", limit=1)[0]["snippet"].count("[dementia]") == 1
+
+    assert [match["id"] for match in search.search_results(results_db, "trump OR dementia", language="de")] == ["1"]
+    assert search.search_results(results_db, "title:News AND ransomware") == []
+
+    with pytest.raises(RuntimeError):
+        search.search_results(results_db, "AND OR")
@@ -0,0 +1,52 @@
+import json
+import sqlite3
+from langchain_mistralai import ChatMistralAI
+from benchmarks.stub_server import StubLLMServer, generate_answer
+from taranis_ds import cybersec_class, summary
+from taranis_ds.llm_tools import stream_completion
+from .testdata import REF_NEWS_ITEM_EN
+
+
+def test_generate_answer():
+    summary_prompt = summary.SUMMARY_PROMPT_TEMPLATE.format(text=REF_NEWS_ITEM_EN, language="english", max_words=10)
+    assert generate_answer(summary_prompt) == "Jayne Sibley, who lives in the United Kingdom,"
+
+    class_prompt = cybersec_class.CYBERSEC_CLASS_PROMPT_TEMPLATE.format(text="A new ransomware strain was found", language="english")
+    assert generate_answer(class_prompt) == "cybersecurity"
+    class_prompt = cybersec_class.CYBERSEC_CLASS_PROMPT_TEMPLATE.format(text=REF_NEWS_ITEM_EN, language="english")
+    assert generate_answer(class_prompt) == "non-cybersecurity"
+
+    combined_prompt = 'Respond only with a JSON object of the form {"summary": ..., "category": ...}\nText: Malware everywhere'
+    assert json.loads(generate_answer(combined_prompt)) == {"summary": "Malware everywhere", "category": "cybersecurity"}
+
+
+def test_classify_against_stub_server(tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT, cybersecurity TEXT, cybersecurity_status TEXT)")
+    news_items = [
+        {"id": "1", "news_item_id": "1", "content": "Attackers exploited a vulnerability in the VPN gateway", "language": "en"},
+        {"id": "2", "news_item_id": "2", "content": REF_NEWS_ITEM_EN, "language": "en"},
+    ]
+    with connection:
+        connection.executemany("INSERT INTO results (id, news_item_id, content) VALUES (?, ?, ?)", [(r["id"], r["news_item_id"], r["content"]) for r in news_items])
+
+    with StubLLMServer(latency_median=0.0, rate_limit_rate=0.0, malformed_rate=0.0, seed=0) as server:
+        chat_model = ChatMistralAI(model="stub", api_key="stub", endpoint=server.url, max_tokens=10)
+        cybersec_class.classify_news_item_cybersecurity(chat_model, news_items, connection, 0.0)
+        assert server.stats["requests"] == 2
+
+    saved_results = connection.execute("SELECT id, cybersecurity, cybersecurity_status FROM results ORDER BY id").fetchall()
+    assert saved_results == [("1", "cybersecurity", "OK"), ("2", "non-cybersecurity", "OK")]
+    connection.close()
+
+
+def test_stream_aborts_verbose_summary():
+    parser = summary.SummaryParser(desired_lang="en", max_words=10)
+    prompt_value = summary.SUMMARY_PROMPT_TEMPLATE.format(text=REF_NEWS_ITEM_EN, language="english", max_words=10)
+    with StubLLMServer(latency_median=0.0, verbose_rate=1.0, token_latency=0.01, seed=0) as server:
+        chat_model = ChatMistralAI(model="stub", api_key="stub", endpoint=server.url, streaming=True)
+        text = stream_completion(chat_model, prompt_value, parser.create_abort_check)
+
+    # reading stopped right after the completion got longer than 1.5 * max_words
+    assert len(text.split(" ")) == 16
+    assert server.stats["streamed_words"] < len(REF_NEWS_ITEM_EN.split())
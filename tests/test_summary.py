@@ -1,6 +1,12 @@
+import sqlite3
 from taranis_ds import summary
+from taranis_ds.retry_queue import RetryQueue
 from unittest.mock import patch, MagicMock, Mock
 from langchain.chat_models.base import BaseChatModel
+from langchain.output_parsers import RetryWithErrorOutputParser
+from langchain.prompts import PromptTemplate
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from taranis_ds.llm_tools import create_chain
 from .testdata import REF_NEWS_ITEM_DE, REF_SUMMARY_DE, NON_SUMMARY_DE
 
 
@@ -11,7 +17,7 @@ def test_create_summaries_for_news_items(mock_llm_response, results_db):
     chat_model = Mock(spec=BaseChatModel)
 
     # successful summary creation
-    news_items = [{"id": "1", "content": REF_NEWS_ITEM_DE, "language": "de"}]
+    news_items = [{"id": "1", "news_item_id": "1", "content": REF_NEWS_ITEM_DE, "language": "de"}]
     mock_llm_response.return_value = (REF_SUMMARY_DE, "OK")
     summary.create_summaries_for_news_items(chat_model, news_items, results_db, 300, 0.5, 1.)
     saved_results = results_db.execute("SELECT summary, summary_status FROM results WHERE id='1'").fetchall()
@@ -35,3 +41,81 @@ def test_create_summaries_for_news_items(mock_llm_response, results_db):
     saved_results = results_db.execute("SELECT summary, summary_status FROM results WHERE id='1'").fetchall()
     assert saved_results == [('', "TOO_MANY_REQUESTS")]
 
+
+
+class WhitespaceTokenizer:
+    def __call__(self, texts, add_special_tokens=True):
+        return {"input_ids": [text.split() for text in texts]}
+
+    def decode(self, ids):
+        return " ".join(ids)
+
+
+def test_split_into_chunks():
+    tokenizer = WhitespaceTokenizer()
+    text = "one two three\nfour five\n\nsix seven eight nine ten eleven twelve\nthirteen"
+
+    chunks = summary.split_into_chunks(text, tokenizer, 5)
+    assert chunks == ["one two three\nfour five", "six seven eight nine ten", "eleven twelve", "thirteen"]
+    assert summary.split_into_chunks(text, tokenizer, 100) == ["one two three\nfour five\nsix seven eight nine ten eleven twelve\nthirteen"]
+    assert summary.split_into_chunks("", tokenizer, 5) == []
+
+
+def test_summarize_long_text():
+    chat_model = FakeListChatModel(responses=["Erster Teil.", "Zweiter Teil.", REF_SUMMARY_DE])
+    summary_parser = RetryWithErrorOutputParser.from_llm(parser=summary.SummaryParser(desired_lang="de", max_words=30), llm=chat_model, max_retries=0)
+    prompt = PromptTemplate(template=summary.SUMMARY_PROMPT_TEMPLATE, input_variables=["text", "language"], partial_variables={"max_words": 30})
+    chain = create_chain(chat_model, prompt, summary_parser)
+
+    # the news item is split into two chunks of at most 100 words
+    result, status = summary.summarize_long_text(chat_model, chain, REF_NEWS_ITEM_DE, "german", WhitespaceTokenizer(), 100, 30, 1)
+    assert (result, status) == (REF_SUMMARY_DE, "OK")
+    assert chat_model.i == 0  # all three responses were used
+
+
+
+@patch("taranis_ds.summary.get_tokenizer")
+@patch("taranis_ds.summary.prompt_model_with_retry")
+def test_summarize_long_text_retry_queue(mock_llm_response, mock_get_tokenizer, tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT, summary TEXT, summary_status TEXT)")
+    with connection:
+        connection.execute("INSERT INTO results (id, news_item_id, content) VALUES ('s1', '1', ?)", (REF_NEWS_ITEM_DE,))
+    mock_get_tokenizer.return_value = WhitespaceTokenizer()
+    mock_llm_response.return_value = (REF_SUMMARY_DE, "OK")
+    chat_model = FakeListChatModel(responses=["Erster Teil.", "Zweiter Teil."])
+    news_items = [{"id": "s1", "news_item_id": "1", "content": REF_NEWS_ITEM_DE, "language": "de", "tokens": 200}]
+
+    # with a retry queue the reduce request of a long news item is not retried in place either
+    summary.create_summaries_for_news_items(
+        chat_model, news_items, connection, 30, 0.0, 0.0, long_doc_threshold=100, chunk_tokens=100,
+        retry_queue=RetryQueue(connection, "summary"),
+    )
+    assert mock_llm_response.call_count == 1
+    assert mock_llm_response.call_args.args[2] == 1
+    assert connection.execute("SELECT summary_status FROM results").fetchone() == ("OK",)
+    connection.close()
+
+
+def test_summary_parser_repair():
+    parser = summary.SummaryParser(desired_lang="de", max_words=10)
+    assert parser.repair('**Zusammenfassung:** "Die Plattform X zahlt zehn Millionen Dollar an Trump."') == (
+        "Die Plattform X zahlt zehn Millionen Dollar an Trump."
+    )
+
+    # too long, trimmed at the last sentence boundary within 1.5 * max_words
+    too_long = "Die Plattform X zahlt Geld an Trump. Das berichtet das Wall Street Journal. Trump hatte im Juli 2021 geklagt."
+    assert parser.repair(too_long) == "Die Plattform X zahlt Geld an Trump. Das berichtet das Wall Street Journal."
+    assert parser.parse(parser.repair(too_long))
+
+
+def test_summary_parser_abort_check():
+    parser = summary.SummaryParser(desired_lang="de", max_words=30)
+    should_abort = parser.create_abort_check()
+    assert not should_abort("Die Plattform X zahlt")
+    assert not should_abort(REF_SUMMARY_DE)
+    assert parser.create_abort_check()(" ".join(["Wort"] * 46))
+
+    # the language is checked once, as soon as enough words arrived
+    should_abort = summary.SummaryParser(desired_lang="en", max_words=100).create_abort_check()
+    assert should_abort(REF_SUMMARY_DE)
@@ -0,0 +1,132 @@
+import json
+import sqlite3
+import pytest
+from taranis_ds import summary_cybersec_class
+from taranis_ds.persist import insert_column
+from taranis_ds.retry_queue import RetryQueue
+from unittest.mock import patch, Mock
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import OutputParserException
+from .testdata import REF_NEWS_ITEM_DE, REF_SUMMARY_DE, REF_SUMMARY_EN
+
+
+def test_summary_category_parser():
+    parser = summary_cybersec_class.SummaryCategoryParser(desired_lang="de", max_words=30)
+
+    answer = json.dumps({"summary": REF_SUMMARY_DE, "category": "non-cybersecurity"})
+    assert parser.parse(answer) == {"summary": REF_SUMMARY_DE, "category": "non-cybersecurity"}
+    assert parser.parse(f"```json\n{answer}\n```") == {"summary": REF_SUMMARY_DE, "category": "non-cybersecurity"}
+
+    with pytest.raises(OutputParserException):
+        parser.parse(REF_SUMMARY_DE)
+
+    with pytest.raises(OutputParserException):
+        parser.parse(json.dumps({"summary": REF_SUMMARY_DE}))
+
+    with pytest.raises(OutputParserException):
+        parser.parse(json.dumps({"summary": REF_SUMMARY_DE, "category": "sports"}))
+
+    with pytest.raises(OutputParserException):
+        parser.parse(json.dumps({"summary": REF_SUMMARY_EN, "category": "cybersecurity"}))
+
+
+@patch("taranis_ds.summary_cybersec_class.prompt_model_with_retry")
+def test_summarize_and_classify_news_items(mock_llm_response, results_db):
+    for col in ["cybersecurity", "cybersecurity_status"]:
+        insert_column(results_db, "results", col, "TEXT")
+
+    chat_model = Mock(spec=BaseChatModel)
+    news_items = [{"id": "1", "news_item_id": "1", "content": REF_NEWS_ITEM_DE, "language": "de"}]
+
+    # 500 response
+    mock_llm_response.return_value = "", "ERROR"
+    summary_cybersec_class.summarize_and_classify_news_items(chat_model, news_items, results_db, 30, 0.5, 0.)
+    saved_results = results_db.execute(
+        "SELECT summary, summary_status, cybersecurity, cybersecurity_status FROM results WHERE id='1'"
+    ).fetchall()
+    assert saved_results == [("", "ERROR", "", "ERROR")]
+    assert mock_llm_response.call_count == 1
+
+
+def test_summary_category_parser_repair():
+    parser = summary_cybersec_class.SummaryCategoryParser(desired_lang="de", max_words=30)
+    # unescaped quotes in the summary and a spaced label
+    broken = '{"summary": "Summary: ' + REF_SUMMARY_DE.replace("\n", " ") + ' Das berichtet das "WSJ".", "category": "Cyber Security"}'
+    with pytest.raises(OutputParserException):
+        parser.parse(broken)
+    assert parser.parse(parser.repair(broken))["category"] == "cybersecurity"
+
+
+@patch("taranis_ds.summary_cybersec_class.prompt_model_with_retry")
+def test_summarize_and_classify_news_items_of_one_story(mock_llm_response, tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT)")
+    for col in summary_cybersec_class.RESULT_COLUMNS:
+        insert_column(connection, "results", col, "TEXT")
+    news_items = [{"id": "s1", "news_item_id": str(i), "content": text, "language": "de"} for i, text in enumerate(["a", "b"])]
+    with connection:
+        connection.executemany("INSERT INTO results (id, news_item_id, content) VALUES (?, ?, ?)", [("s1", "0", "a"), ("s1", "1", "b")])
+
+    # the results are saved per news item, not per story
+    mock_llm_response.side_effect = lambda chain, inputs, max_retries=3: (
+        ({"summary": f"summary {inputs['text']}", "category": "cybersecurity"}, "OK") if inputs["text"] == "a" else ("", "ERROR")
+    )
+    summary_cybersec_class.summarize_and_classify_news_items(Mock(spec=BaseChatModel), news_items, connection, 30, 0.0, 0.0)
+    saved_results = connection.execute("SELECT news_item_id, summary, summary_status, cybersecurity_status FROM results").fetchall()
+    assert saved_results == [("0", "summary a", "OK", "OK"), ("1", "", "ERROR", "ERROR")]
+    connection.close()
+
+
+@patch("taranis_ds.summary_cybersec_class.prompt_model_with_retry")
+def test_summarize_and_classify_news_items_retry_queue(mock_llm_response, tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT)")
+    for col in summary_cybersec_class.RESULT_COLUMNS:
+        insert_column(connection, "results", col, "TEXT")
+    # both news items of story s1 fail, each is retried on its own
+    news_items = [{"id": story_id, "news_item_id": str(i), "content": text, "language": "de"} for i, (story_id, text) in enumerate([("s1", "a"), ("s1", "b"), ("s2", "c")])]
+    with connection:
+        connection.executemany("INSERT INTO results (id, news_item_id, content) VALUES (?, ?, ?)", [(row["id"], row["news_item_id"], row["content"]) for row in news_items])
+
+    retry_queue = RetryQueue(connection, "summary_cybersec_class", max_attempts=3, base_delay=10.0)
+    waited = []
+    retry_queue.clock = lambda: sum(waited)
+    retry_queue.sleep = waited.append
+    result = {"summary": "summary", "category": "cybersecurity"}
+    responses = {"a": [("", "ERROR"), (result, "OK")], "b": [("", "ERROR"), ("", "ERROR"), ("", "ERROR")], "c": [(result, "OK")]}
+    mock_llm_response.side_effect = lambda chain, inputs, max_retries=3: responses[inputs["text"]].pop(0)
+
+    summary_cybersec_class.summarize_and_classify_news_items(Mock(spec=BaseChatModel), news_items, connection, 30, 0.0, 0.0, retry_queue=retry_queue)
+
+    assert [call.args[1]["text"] for call in mock_llm_response.call_args_list] == ["a", "b", "c", "a", "b", "b"]
+    assert waited == [10.0, 20.0]
+    saved_results = connection.execute("SELECT news_item_id, summary_status FROM results").fetchall()
+    assert saved_results == [("0", "OK"), ("1", "DEAD_LETTER"), ("2", "OK")]
+    assert connection.execute("SELECT COUNT(*) FROM retry_queue").fetchone()[0] == 0
+    connection.close()
+
+
+@patch("taranis_ds.summary_cybersec_class.prompt_model_with_retry")
+def test_summarize_and_classify_news_items_keeps_done_results(mock_llm_response, tmp_path):
+    connection = sqlite3.Connection(tmp_path / "results.db")
+    connection.execute("CREATE TABLE results(id TEXT, news_item_id TEXT, content TEXT)")
+    for col in summary_cybersec_class.RESULT_COLUMNS:
+        insert_column(connection, "results", col, "TEXT")
+    # both news items already have a summary from the summary step, only the label is missing
+    news_items = [
+        {"id": "s1", "news_item_id": str(i), "content": text, "language": "de", "summary_status": "OK", "cybersecurity_status": None}
+        for i, text in enumerate(["a", "b"])
+    ]
+    with connection:
+        connection.executemany(
+            "INSERT INTO results (id, news_item_id, content, summary, summary_status) VALUES (?, ?, ?, ?, 'OK')",
+            [("s1", "0", "a", "good summary a"), ("s1", "1", "b", "good summary b")],
+        )
+
+    mock_llm_response.side_effect = lambda chain, inputs, max_retries=3: (
+        ({"summary": "other summary", "category": "cybersecurity"}, "OK") if inputs["text"] == "a" else ("", "ERROR")
+    )
+    summary_cybersec_class.summarize_and_classify_news_items(Mock(spec=BaseChatModel), news_items, connection, 30, 0.0, 0.0)
+    saved_results = connection.execute("SELECT news_item_id, summary, summary_status, cybersecurity, cybersecurity_status FROM results").fetchall()
+    assert saved_results == [("0", "good summary a", "OK", "cybersecurity", "OK"), ("1", "good summary b", "OK", "", "ERROR")]
+    connection.close()
@@ -0,0 +1,22 @@
+import pytest
+from benchmarks.synthetic import generate_taranis_export, parse_language_mix, to_processed_df
+
+
+def test_parse_language_mix():
+    assert parse_language_mix("en=0.7,de=0.3") == {"en": 0.7, "de": 0.3}
+    assert parse_language_mix("fr") == {"fr": 1.0}
+    with pytest.raises(ValueError):
+        parse_language_mix("xx=1")
+
+
+def test_generate_taranis_export():
+    stories = generate_taranis_export(200, items_per_story=2, content_words=50, language_mix={"en": 1, "de": 1}, duplicate_rate=0.2, seed=1)
+    assert stories == generate_taranis_export(200, items_per_story=2, content_words=50, language_mix={"en": 1, "de": 1}, duplicate_rate=0.2, seed=1)
+    assert len(stories) == 200
+    assert all(set(item) >= {"id", "title", "content"} for story in stories for item in story["news_items"])
+
+    df = to_processed_df(stories)
+    assert 300 < len(df) < 500
+    assert set(df["language"]) == {"en", "de"}
+    assert 0.1 < df["content"].duplicated().mean() < 0.3
+    assert list(df.columns) == ["id", "news_item_id", "title", "content", "tokens", "language"]